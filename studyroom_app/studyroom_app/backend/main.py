@@ -1,69 +1,33 @@
-# 現在入室中リスト取得API
-@app.get("/api/admin/active_sessions")
-def admin_active_sessions(request: Request, _: Dict[str, Any] = Depends(require_admin)):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT s.id, u.student_no, u.name, u.nickname, s.checkin_at
-        FROM sessions s
-        JOIN users u ON u.id = s.user_id
-        WHERE s.checkout_at IS NULL
-        ORDER BY s.checkin_at ASC
-    """)
-    sessions = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return {"ok": True, "sessions": sessions}
-
-# 一括強制退室API
-@app.post("/api/admin/force_checkout_all")
-def admin_force_checkout_all(request: Request, _: Dict[str, Any] = Depends(require_admin)):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT id, checkin_at FROM sessions WHERE checkout_at IS NULL")
-    now = now_jst()
-    count = 0
-    for s in cur.fetchall():
-        ci = parse_iso(s["checkin_at"])
-        dur = max(0, int((now - ci).total_seconds()))
-        cur.execute("UPDATE sessions SET checkout_at=?, duration_sec=? WHERE id=?", (iso(now), dur, int(s["id"])))
-        count += 1
-    conn.commit()
-    conn.close()
-    return {"ok": True, "count": count}
-# 入退室状態確認API
-from fastapi import Body
-
-@app.post("/api/status")
-def status_check(data: dict = Body(...)):
-    student_no = data.get("student_no", "").strip()
-    pin = data.get("pin", "").strip()
-    try:
-        user = _verify_user(student_no, pin)
-    except HTTPException:
-        return {"status": "unknown"}
-    conn = db_connect()
-    open_sess = _open_session(conn, int(user["id"]))
-    conn.close()
-    if open_sess:
-        return {"status": "in"}
-    else:
-        return {"status": "out"}
-\
 from __future__ import annotations
 
 import os
+import sys
+import json
+import argparse
+import math
 import sqlite3
 import secrets
 from datetime import datetime, timezone, timedelta, date
-from typing import Optional, Literal, Dict, Any, List, Tuple
+from typing import Optional, Literal, Dict, Any, List, Tuple, Callable, Iterator, Iterable
 
-from fastapi import FastAPI, Request, Response, Depends, HTTPException
+from fastapi import FastAPI, Request, Response, Depends, HTTPException, Body, Query
 from fastapi.responses import HTMLResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from itsdangerous import URLSafeSerializer, BadSignature
 from passlib.context import CryptContext
 
+try:
+    import numpy as np  # optional: vectorized analytics
+except ImportError:  # pragma: no cover - pure Python fallback is used
+    np = None
+
+try:
+    import segno  # optional: QR codes for printed badges
+except ImportError:  # pragma: no cover - the badge token is shown as text instead
+    segno = None
+
 # =========================================================
 # Config
 # =========================================================
@@ -80,9 +44,61 @@ DB_PATH = os.getenv("STUDYROOM_DB_PATH") or os.path.join(os.path.dirname(__file_
 # 閉室時刻（例: "22:00"）と自動退室ON/OFF
 CLOSE_TIME = os.getenv("STUDYROOM_CLOSE_TIME", "22:00")
 AUTO_CHECKOUT = os.getenv("STUDYROOM_AUTO_CHECKOUT", "1") == "1"
+# 在室カウンタをDBと突き合わせる間隔（秒）
+OCCUPANCY_RECONCILE_SEC = int(os.getenv("STUDYROOM_OCCUPANCY_RECONCILE_SEC", "60"))
+# /api/me 結果キャッシュの最大ユーザー数（LRU）
+ME_CACHE_SIZE = int(os.getenv("STUDYROOM_ME_CACHE_SIZE", "512"))
+
+# PIN照合の前段レート制限（トークンバケット: バースト数 / 1秒あたり補充数）
+# 入口端末は1台=1IPで全員が使うので、IP側は学籍番号側より大きく取る
+RATE_IP_BURST = int(os.getenv("STUDYROOM_RATE_IP_BURST", "60"))
+RATE_IP_PER_SEC = float(os.getenv("STUDYROOM_RATE_IP_PER_SEC", "1.0"))
+RATE_STUDENT_BURST = int(os.getenv("STUDYROOM_RATE_STUDENT_BURST", "6"))
+RATE_STUDENT_PER_SEC = float(os.getenv("STUDYROOM_RATE_STUDENT_PER_SEC", "0.2"))
+# PIN失敗後の段階的バックオフ（許容回数を超えると 2^n 秒、上限あり）
+# IP側は共有の入口端末を止めないよう大きく取り、成功した打刻1回ごとに失敗を1回分減らす
+RATE_FAIL_FREE_STUDENT = int(os.getenv("STUDYROOM_RATE_FAIL_FREE_STUDENT", "3"))
+RATE_FAIL_FREE_IP = int(os.getenv("STUDYROOM_RATE_FAIL_FREE_IP", "50"))
+RATE_FAIL_MAX_SEC = float(os.getenv("STUDYROOM_RATE_FAIL_MAX_SEC", "300"))
+TRUST_PROXY = os.getenv("STUDYROOM_TRUST_PROXY", "0") == "1"
+# オフライン端末からの一括打刻（/api/punch/batch）: 受け付ける打刻の古さの上限と、重複判定の保持日数
+PUNCH_MAX_AGE_HOURS = int(os.getenv("STUDYROOM_PUNCH_MAX_AGE_HOURS", "72"))
+PUNCH_RECEIPT_DAYS = int(os.getenv("STUDYROOM_PUNCH_RECEIPT_DAYS", "30"))
+# この日数より前に退室済みのセッションを sessions_archive へ移す（0 = 自動では行わない）
+ARCHIVE_AFTER_DAYS = int(os.getenv("STUDYROOM_ARCHIVE_AFTER_DAYS", "0"))
+# 集計系の読み取り専用スナップショット（メモリ上のDBコピー）: 再取得間隔（秒, 0 = 使わない）と許容する古さ（秒）
+SNAPSHOT_SEC = int(os.getenv("STUDYROOM_SNAPSHOT_SEC", "30"))
+SNAPSHOT_MAX_AGE_SEC = int(os.getenv("STUDYROOM_SNAPSHOT_MAX_AGE_SEC", "60"))
+# オンラインバックアップ: 間隔（時間, 0 = 自動では行わない）・保存先・保持数・1ステップのページ数と休止（ミリ秒）
+BACKUP_INTERVAL_HOURS = float(os.getenv("STUDYROOM_BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_DIR = os.getenv("STUDYROOM_BACKUP_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups")
+BACKUP_KEEP = int(os.getenv("STUDYROOM_BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("STUDYROOM_BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP_MS = int(os.getenv("STUDYROOM_BACKUP_STEP_SLEEP_MS", "20"))
+# 列指向（NumPy）の集計エンジン: NumPyがあれば既定で使う（0 = 使わない）
+COLUMNAR = os.getenv("STUDYROOM_COLUMNAR", "1") != "0"
+# 打刻イベントログのスナップショット間隔（時間, 0 = 自動では取らない）
+EVENT_SNAPSHOT_HOURS = float(os.getenv("STUDYROOM_EVENT_SNAPSHOT_HOURS", "24"))
+# バッジの二度読み防止: 入室からこの秒数以内の読み取りでは退室しない
+BADGE_DEBOUNCE_SEC = int(os.getenv("STUDYROOM_BADGE_DEBOUNCE_SEC", "60"))
+# PINハッシュのbcryptコスト（2^N 回）。`python -m backend.main calibrate-bcrypt` で端末に合わせて決める
+# 既存ハッシュは照合成功時に現在のコストへ自動で再ハッシュされる
+BCRYPT_ROUNDS = int(os.getenv("STUDYROOM_BCRYPT_ROUNDS", "12"))
 
 serializer = URLSafeSerializer(SECRET_KEY, salt="studyroom-session")
-pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
+badge_serializer = URLSafeSerializer(SECRET_KEY, salt="studyroom-badge")
+
+def _make_pwd_ctx(rounds: int) -> CryptContext:
+    # min == max == default: any hash with a different cost reports needs_update
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+pwd_ctx = _make_pwd_ctx(BCRYPT_ROUNDS)
 
 # =========================================================
 # DB helpers
@@ -93,11 +109,19 @@ def db_connect() -> sqlite3.Connection:
     return conn
 
 
-def init_db() -> None:
-    conn = db_connect()
-    cur = conn.cursor()
+# =========================================================
+# Schema migrations (PRAGMA user_version)
+# =========================================================
+def _table_columns(cur: sqlite3.Cursor, table: str) -> List[str]:
+    cur.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in cur.fetchall()]
 
-    # 週目標（分単位）カラム追加
+def _table_names(cur: sqlite3.Cursor) -> List[str]:
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return [r[0] for r in cur.fetchall()]
+
+def _migrate_v1(cur: sqlite3.Cursor) -> None:
+    """Base schema (users / sessions). Safe on DBs created before versioning."""
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -105,16 +129,9 @@ def init_db() -> None:
         name TEXT NOT NULL,
         nickname TEXT NOT NULL,
         pin_hash TEXT NOT NULL,
-        created_at TEXT NOT NULL,
-        weekly_goal INTEGER DEFAULT 300 # 300分=5時間
+        created_at TEXT NOT NULL
     );
     """)
-    # 既存DBにカラムがなければ追加
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN weekly_goal INTEGER DEFAULT 300")
-    except Exception:
-        pass
-
     cur.execute("""
     CREATE TABLE IF NOT EXISTS sessions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -126,8 +143,288 @@ def init_db() -> None:
     );
     """)
 
-    conn.commit()
-    conn.close()
+def _migrate_v2(cur: sqlite3.Cursor) -> None:
+    """週目標（分単位、既定 300分=5時間）"""
+    if "weekly_goal" not in _table_columns(cur, "users"):
+        cur.execute("ALTER TABLE users ADD COLUMN weekly_goal INTEGER DEFAULT 300")
+
+def _migrate_v3(cur: sqlite3.Cursor) -> None:
+    """Per-user cumulative daily totals (closed sessions) for arbitrary date-range ranking."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_day_totals (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        sec INTEGER NOT NULL,
+        cum_sec INTEGER NOT NULL,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+    """)
+    _rebuild_day_index(cur)
+
+def _migrate_v4(cur: sqlite3.Cursor) -> None:
+    """Permanent cache of occupancy aggregates for fully closed weeks."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS occupancy_cache (
+        week_start TEXT NOT NULL,
+        bin_min INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (week_start, bin_min)
+    );
+    """)
+
+def _migrate_v5(cur: sqlite3.Cursor) -> None:
+    """Partial index over open sessions (occupancy count / active list without a table scan)."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_open ON sessions(checkin_at) WHERE checkout_at IS NULL")
+
+def _migrate_v6(cur: sqlite3.Cursor) -> None:
+    """Idempotency receipts for batch punches uploaded by offline kiosks."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS punch_receipts (
+        key TEXT PRIMARY KEY,
+        user_id INTEGER,
+        action TEXT NOT NULL,
+        at TEXT,
+        status TEXT NOT NULL,
+        message TEXT NOT NULL,
+        received_at TEXT NOT NULL
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_punch_receipts_received ON punch_receipts(received_at)")
+
+def _migrate_v7(cur: sqlite3.Cursor) -> None:
+    """Cold storage for old closed sessions (same columns and ids as `sessions`)."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sessions_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        checkin_at TEXT NOT NULL,
+        checkout_at TEXT NOT NULL,
+        duration_sec INTEGER
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_archive_checkin ON sessions_archive(checkin_at)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS archive_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        cutoff TEXT NOT NULL,
+        moved INTEGER NOT NULL DEFAULT 0,
+        started_at TEXT NOT NULL,
+        finished_at TEXT
+    )
+    """)
+
+def _migrate_v8(cur: sqlite3.Cursor) -> None:
+    """Per-user lifetime closed seconds (all-time totals / ranking without scanning history)."""
+    if "lifetime_sec" not in _table_columns(cur, "users"):
+        cur.execute("ALTER TABLE users ADD COLUMN lifetime_sec INTEGER NOT NULL DEFAULT 0")
+    _rebuild_lifetime(cur)
+
+def _migrate_v9(cur: sqlite3.Cursor) -> None:
+    """Per-user streak / personal-best state over the full history."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_streaks (
+        user_id INTEGER PRIMARY KEY,
+        run_start TEXT NOT NULL,
+        run_end TEXT NOT NULL,
+        longest INTEGER NOT NULL,
+        longest_end TEXT NOT NULL,
+        best_sec INTEGER NOT NULL,
+        best_day TEXT NOT NULL
+    )
+    """)
+    _rebuild_streaks(cur)
+
+def _migrate_v10(cur: sqlite3.Cursor) -> None:
+    """At most one open session per user (check-in is a single conditional INSERT against this index)."""
+    # punch races before this index could leave a user with two open sessions: close each
+    # extra one when the next one started, so totals stay continuous
+    cur.execute("SELECT id, user_id, checkin_at FROM sessions WHERE checkout_at IS NULL ORDER BY user_id, checkin_at")
+    by_user: Dict[int, List[sqlite3.Row]] = {}
+    for r in cur.fetchall():
+        by_user.setdefault(int(r["user_id"]), []).append(r)
+    for rows in by_user.values():
+        for sess, nxt in zip(rows, rows[1:]):
+            t = parse_iso(nxt["checkin_at"])
+            cur.execute(f"UPDATE sessions SET {_CLOSE_SET} WHERE id = ?2", (iso(t), int(sess["id"])))
+            _index_closed(cur, int(sess["user_id"]), parse_iso(sess["checkin_at"]), t)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_user_open ON sessions(user_id) WHERE checkout_at IS NULL")
+
+def _migrate_v11(cur: sqlite3.Cursor) -> None:
+    """Append-only punch event log (source of truth) and projection snapshots; backfilled from sessions."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS punch_events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        session_id INTEGER NOT NULL,
+        at TEXT NOT NULL,
+        checkin_at TEXT,
+        source TEXT NOT NULL,
+        recorded_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_punch_events_user ON punch_events(user_id, seq)")
+    for op in ("UPDATE", "DELETE"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS punch_events_no_{op.lower()} BEFORE {op} ON punch_events
+        BEGIN SELECT RAISE(ABORT, 'punch_events is append-only'); END
+        """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS event_snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        seq INTEGER NOT NULL,
+        max_session_id INTEGER NOT NULL,
+        taken_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS event_snapshot_days (
+        snapshot_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        sec INTEGER NOT NULL,
+        PRIMARY KEY (snapshot_id, user_id, day)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS event_snapshot_open (
+        snapshot_id INTEGER NOT NULL,
+        session_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        checkin_at TEXT NOT NULL,
+        PRIMARY KEY (snapshot_id, session_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("SELECT COUNT(*) FROM punch_events")
+    if int(cur.fetchone()[0]) == 0:
+        _backfill_events(cur)
+        _take_event_snapshot(cur)
+
+def _migrate_v12(cur: sqlite3.Cursor) -> None:
+    """User groups (classes, grades, ...): many-to-many with users."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS groups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL DEFAULT 'class',
+        created_at TEXT NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_groups (
+        group_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (group_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_groups_user ON user_groups(user_id)")
+
+def _migrate_v13(cur: sqlite3.Cursor) -> None:
+    """Per-process write counters, so each process can tell writes by other processes from its own."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS change_counter (
+        writer TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        bulk INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+
+def _migrate_v14(cur: sqlite3.Cursor) -> None:
+    """Badge key version: a badge token is valid while it carries the user's current value."""
+    if "badge_version" not in _table_columns(cur, "users"):
+        cur.execute("ALTER TABLE users ADD COLUMN badge_version INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_v15(cur: sqlite3.Cursor) -> None:
+    """Frozen leaderboards of closed days / weeks / months (header + ranked per-user totals)."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS period_snapshots (
+        period TEXT NOT NULL,
+        start_day TEXT NOT NULL,
+        end_day TEXT NOT NULL,
+        users INTEGER NOT NULL,
+        total_sec INTEGER NOT NULL,
+        frozen_at TEXT NOT NULL,
+        PRIMARY KEY (period, start_day)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS period_snapshot_users (
+        period TEXT NOT NULL,
+        start_day TEXT NOT NULL,
+        rank INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        total_sec INTEGER NOT NULL,
+        PRIMARY KEY (period, start_day, rank, user_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_period_snapshot_users_user ON period_snapshot_users(user_id, period, start_day)")
+
+def _migrate_v16(cur: sqlite3.Cursor) -> None:
+    """Bulk session imports: one row per run (and the index DDL to restore if it was interrupted)."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS import_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        started_at TEXT NOT NULL,
+        finished_at TEXT,
+        rows_read INTEGER NOT NULL DEFAULT 0,
+        accepted INTEGER NOT NULL DEFAULT 0,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        dropped_indexes TEXT
+    )
+    """)
+
+# (version, migration) — append only; never edit a released step
+MIGRATIONS: List[Tuple[int, Callable[[sqlite3.Cursor], None]]] = [
+    (1, _migrate_v1),
+    (2, _migrate_v2),
+    (3, _migrate_v3),
+    (4, _migrate_v4),
+    (5, _migrate_v5),
+    (6, _migrate_v6),
+    (7, _migrate_v7),
+    (8, _migrate_v8),
+    (9, _migrate_v9),
+    (10, _migrate_v10),
+    (11, _migrate_v11),
+    (12, _migrate_v12),
+    (13, _migrate_v13),
+    (14, _migrate_v14),
+    (15, _migrate_v15),
+    (16, _migrate_v16),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def init_db() -> None:
+    """
+    Bring the schema up to SCHEMA_VERSION.
+    When the DB is already current this is a single PRAGMA read (no DDL, no write lock).
+    """
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("PRAGMA user_version")
+        if int(cur.fetchone()[0]) >= SCHEMA_VERSION:
+            return
+        # another process may be migrating at the same time: take the write lock, then re-check
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("PRAGMA user_version")
+        current = int(cur.fetchone()[0])
+        for version, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            migrate(cur)
+            cur.execute(f"PRAGMA user_version = {int(version)}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 def iso(dt: datetime) -> str:
     return dt.astimezone(JST).isoformat()
@@ -189,6 +486,20 @@ class CheckReq(BaseModel):
     student_no: str = Field(min_length=1, max_length=64)
     pin: str = Field(min_length=4, max_length=32)
 
+PUNCH_BATCH_MAX = 500
+
+class PunchItem(BaseModel):
+    key: str = Field(min_length=8, max_length=64)  # client-generated idempotency key
+    # checked per item (rejected result), so one mistyped punch cannot block the whole queue
+    student_no: str = Field(max_length=256)
+    pin: str = Field(max_length=256)
+    action: Literal["in", "out"]
+    at: str = Field(min_length=1, max_length=40)  # client clock, ISO 8601
+
+class PunchBatchReq(BaseModel):
+    sent_at: Optional[str] = Field(default=None, max_length=40)  # client clock at upload (skew correction)
+    punches: List[PunchItem] = Field(min_length=1, max_length=PUNCH_BATCH_MAX)
+
 class LoginReq(BaseModel):
     student_no: str = Field(min_length=1, max_length=64)
     pin: str = Field(min_length=4, max_length=32)
@@ -217,6 +528,29 @@ class ResetPinReq(BaseModel):
 class ForceCheckoutReq(BaseModel):
     student_no: str = Field(min_length=1, max_length=64)
 
+class BadgeReq(BaseModel):
+    student_no: str = Field(min_length=1, max_length=64)
+
+class BadgePunchReq(BaseModel):
+    token: str = Field(min_length=8, max_length=256)
+    action: Literal["in", "out", "toggle"] = "toggle"
+
+class GroupCreateReq(BaseModel):
+    name: str = Field(min_length=1, max_length=64)
+    kind: str = Field(default="class", min_length=1, max_length=16)  # e.g. class / grade / club
+
+class GroupDeleteReq(BaseModel):
+    group_id: int
+
+class GroupMembersReq(BaseModel):
+    group_id: int
+    add: List[str] = Field(default_factory=list, max_length=1000)     # student numbers
+    remove: List[str] = Field(default_factory=list, max_length=1000)
+
+class ImportReq(BaseModel):
+    csv: str = Field(min_length=1, max_length=20 * 2**20)  # bigger files: python run.py import-sessions
+    dry_run: bool = True
+
 RangeName = Literal["today", "week", "month", "all"]
 
 # =========================================================
@@ -231,6 +565,18 @@ app.mount("/pages", StaticFiles(directory=os.path.join(BASE_DIR, "pages")), name
 
 import threading
 import time as pytime
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+import cProfile
+import csv
+import functools
+import io
+import marshal
+import pstats
+import tracemalloc
+from fastapi.routing import APIRoute
 
 def auto_checkout_loop():
     while True:
@@ -244,19 +590,433 @@ def auto_checkout_loop():
         if now > close_dt:
             conn = db_connect()
             cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")  # no punch may close one of these between the SELECT and the UPDATEs
             cur.execute("SELECT s.id, s.user_id, s.checkin_at FROM sessions s WHERE s.checkout_at IS NULL")
+            touched = []
             for s in cur.fetchall():
-                ci = parse_iso(s["checkin_at"])
-                dur = max(0, int((close_dt - ci).total_seconds()))
-                cur.execute("UPDATE sessions SET checkout_at=?, duration_sec=? WHERE id=?", (iso(close_dt), dur, int(s["id"])))
+                _close_session(cur, s, close_dt, "auto")
+                touched.append((int(s["user_id"]), parse_iso(s["checkin_at"]), close_dt))
             conn.commit()
             conn.close()
+            _after_punch(-len(touched), touched)
         pytime.sleep(60)
 
+def occupancy_reconcile_loop():
+    while True:
+        pytime.sleep(OCCUPANCY_RECONCILE_SEC)
+        try:
+            _occupancy_reconcile()
+        except sqlite3.Error:
+            pass  # DB busy / locked: try again next round
+
+def archive_loop():
+    while True:
+        try:
+            _archive_sessions(now_jst() - timedelta(days=ARCHIVE_AFTER_DAYS))
+        except sqlite3.Error:
+            pass  # DB busy / locked: the next run picks up where this one stopped
+        pytime.sleep(24 * 3600)
+
 @app.on_event("startup")
 def _startup():
     init_db()
+    _check_foreign_writes()  # baseline: caches are empty, nothing to invalidate yet
+    _occupancy_reconcile()
     threading.Thread(target=auto_checkout_loop, daemon=True).start()
+    threading.Thread(target=occupancy_reconcile_loop, daemon=True).start()
+    if ARCHIVE_AFTER_DAYS > 0:
+        threading.Thread(target=archive_loop, daemon=True).start()
+    if SNAPSHOT_SEC > 0:
+        threading.Thread(target=snapshot_loop, daemon=True).start()
+    if BACKUP_INTERVAL_HOURS > 0:
+        threading.Thread(target=backup_loop, daemon=True).start()
+    if EVENT_SNAPSHOT_HOURS > 0:
+        threading.Thread(target=event_snapshot_loop, daemon=True).start()
+    threading.Thread(target=period_freeze_loop, daemon=True).start()
+
+# =========================================================
+# Live occupancy counter
+# =========================================================
+# Maintained in-process by the punch paths (+1 on check-in, -n on checkout) so reads never
+# touch the DB, and reconciled against COUNT(open sessions) every OCCUPANCY_RECONCILE_SEC
+# (fixes drift from other workers / processes writing to the same DB).
+_occupancy_lock = threading.Lock()
+_occupancy: Dict[str, Any] = {"count": None, "reconciled_at": None, "last_drift": 0, "reconciles": 0}
+
+def _occupancy_add(delta: int) -> None:
+    if not delta:
+        return
+    with _occupancy_lock:
+        if _occupancy["count"] is not None:
+            _occupancy["count"] = max(0, _occupancy["count"] + delta)
+
+def _occupancy_reconcile() -> int:
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) AS c FROM sessions WHERE checkout_at IS NULL")
+        actual = int(cur.fetchone()["c"])
+    finally:
+        conn.close()
+    with _occupancy_lock:
+        if _occupancy["count"] is not None:
+            _occupancy["last_drift"] = actual - _occupancy["count"]
+        _occupancy["count"] = actual
+        _occupancy["reconciled_at"] = iso(now_jst())
+        _occupancy["reconciles"] += 1
+    return actual
+
+def _occupancy_current() -> int:
+    with _occupancy_lock:
+        count = _occupancy["count"]
+    return count if count is not None else _occupancy_reconcile()
+
+def _occupancy_stats() -> Dict[str, Any]:
+    with _occupancy_lock:
+        out = dict(_occupancy)
+    out["count"] = _occupancy_current() if out["count"] is None else out["count"]
+    return out
+
+# =========================================================
+# Data version (in-process punch change log)
+# =========================================================
+# Every committed punch bumps _data_version and records which user / JST days it touched.
+# Readers remember the version they saw and can ask "what changed since v?" instead of
+# recomputing everything. The log is bounded; a version older than the log means "unknown".
+BOOT_ID = secrets.token_hex(4)  # versions are only comparable within one process lifetime
+_data_lock = threading.Lock()
+_data_version = 0
+_change_log: deque = deque(maxlen=2048)  # (version, user_id, first_day, last_day)
+_change_log_floor = 0  # versions below this may have lost entries to eviction
+_user_versions: Dict[int, int] = {}  # per-user punch counter (dashboard cache invalidation)
+
+def _after_punch(occupancy_delta: int, touched: List[Tuple[int, datetime, datetime]]) -> None:
+    """
+    Post-commit hook for every punch path.
+    touched: (user_id, interval_start, interval_end) per changed session.
+    """
+    global _data_version, _change_log_floor
+    _occupancy_add(occupancy_delta)
+    if not touched:
+        return
+    with _data_lock:
+        _data_version += 1
+        for uid, t0, t1 in touched:
+            if len(_change_log) == _change_log.maxlen:
+                _change_log_floor = _change_log[0][0]
+            _change_log.append((_data_version, uid, t0.astimezone(JST).date(), t1.astimezone(JST).date()))
+            _user_versions[uid] = _user_versions.get(uid, 0) + 1
+    _snapshot_wake.set()
+
+def _current_data_version() -> int:
+    with _data_lock:
+        return _data_version
+
+def _changes_since(version: int) -> Optional[List[Tuple[int, date, date]]]:
+    """(user_id, first_day, last_day) changed after `version`, or None if the log can't tell."""
+    with _data_lock:
+        if version > _data_version:
+            return None
+        if version < _change_log_floor:
+            return None
+        return [(uid, d0, d1) for v, uid, d0, d1 in _change_log if v > version]
+
+# ---------------------------------------------------------
+# Writes by other processes (uvicorn workers, CLI commands)
+# ---------------------------------------------------------
+# The version above only counts this process's punches. Every write path also bumps this
+# process's row in change_counter inside its transaction; _check_foreign_writes() compares the
+# other processes' rows with what it saw last. PRAGMA data_version on a dedicated connection
+# tells in microseconds whether any other connection committed at all, so the counter rows
+# are only read after a commit somewhere. A foreign write bumps _data_version with an unknown
+# change set: every version-keyed cache (rank contexts, dashboards, group boards, analytics,
+# read snapshot) recomputes. A bulk write (replay, import) also drops the columnar store,
+# which otherwise catches up from the event log by itself.
+# The check runs on the event loop for every /api/ request, so the watch connection never
+# waits for a lock (timeout=0): while a writer holds the file, the next request checks
+# again. Only the invalidation itself, which reads the DB, goes to the thread pool.
+_coherence_lock = threading.Lock()
+_watch_conn: Optional[sqlite3.Connection] = None
+_coherence: Dict[str, Any] = {"pragma": None, "others": None, "checks": 0, "busy": 0, "foreign": 0, "bulk": 0,
+                              "last_foreign_at": None}
+_foreign_version = 0  # _data_version of the last foreign write (dashboard user parts key on it)
+
+def _bump_write_counter(cur: sqlite3.Cursor, bulk: bool = False) -> None:
+    """Count a write by this process (in the caller's transaction). bulk = a rewrite the event log does not describe."""
+    cur.execute("""
+        INSERT INTO change_counter (writer, version, bulk) VALUES (?, 1, ?)
+        ON CONFLICT (writer) DO UPDATE SET version = version + 1, bulk = bulk + excluded.bulk
+    """, (BOOT_ID, int(bulk)))
+
+def _foreign_write_seen() -> Optional[bool]:
+    """Whether another process wrote since the last look: None = no, else whether it was bulk. Never blocks."""
+    global _watch_conn
+    with _coherence_lock:
+        try:
+            if _watch_conn is None:
+                _watch_conn = sqlite3.connect(DB_PATH, timeout=0, check_same_thread=False)
+            pragma = _watch_conn.execute("PRAGMA data_version").fetchone()[0]
+            _coherence["checks"] += 1
+            if pragma == _coherence["pragma"]:
+                return None
+            others = tuple(_watch_conn.execute(
+                "SELECT COALESCE(SUM(version), 0), COALESCE(SUM(bulk), 0) FROM change_counter WHERE writer != ?",
+                (BOOT_ID,),
+            ).fetchone())
+        except sqlite3.Error:
+            _coherence["busy"] += 1
+            return None  # busy / not migrated yet: the next check catches up
+        _coherence["pragma"] = pragma
+        seen, _coherence["others"] = _coherence["others"], others
+        if seen is None or others == seen:
+            return None  # first look, or only this process's own connections committed
+        bulk = others[1] != seen[1]
+        _coherence["foreign"] += 1
+        _coherence["bulk"] += int(bulk)
+        _coherence["last_foreign_at"] = iso(now_jst())
+    return bulk
+
+def _check_foreign_writes() -> bool:
+    """Invalidate caches if another process wrote since the last check. Returns True when it did."""
+    bulk = _foreign_write_seen()
+    if bulk is None:
+        return False
+    _invalidate_caches(bulk)
+    return True
+
+def _invalidate_caches(bulk: bool) -> None:
+    """Forget everything derived before an unknown change set (another process's write, an import)."""
+    global _data_version, _change_log_floor, _foreign_version
+    with _data_lock:
+        _data_version += 1
+        _change_log_floor = _foreign_version = _data_version  # what changed before this is unknown
+    if bulk:
+        _columns_drop()
+    try:
+        _occupancy_reconcile()
+    except sqlite3.Error:
+        pass  # the reconcile loop fixes the count later
+    _snapshot_wake.set()
+
+class _ForeignWriteCheck:
+    """ASGI middleware: every /api/ request first picks up writes by other processes."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/api/"):
+            bulk = _foreign_write_seen()
+            if bulk is not None:
+                await run_in_threadpool(_invalidate_caches, bulk)
+        await self.app(scope, receive, send)
+
+app.add_middleware(_ForeignWriteCheck)
+
+def _coherence_metrics() -> Dict[str, Any]:
+    with _coherence_lock:
+        out = {k: v for k, v in _coherence.items() if k not in ("pragma", "others")}
+    out["writer"] = BOOT_ID
+    out["foreign_version"] = _foreign_version
+    return out
+
+# =========================================================
+# Read snapshot (in-memory copy of the DB for aggregate reads)
+# =========================================================
+# A background thread copies the DB file into a fresh :memory: connection with the sqlite3
+# backup API, shortly after punches (coalesced) and at least every SNAPSHOT_SEC, then swaps
+# it in. Aggregate endpoints read through _read_conn(): the snapshot when it is younger than
+# SNAPSHOT_MAX_AGE_SEC (and, for version-keyed caches, at least the requested data version),
+# otherwise the DB file. Kiosk writes then never wait behind long analytical reads.
+SNAPSHOT_MIN_GAP_SEC = 2.0  # coalesce bursts of punches into one copy
+_snapshot_lock = threading.Lock()
+_snapshot: Optional[Dict[str, Any]] = None  # conn / lock / version / taken (monotonic) / taken_at
+_snapshot_wake = threading.Event()
+_snapshot_stats: Dict[str, Any] = {"refreshes": 0, "errors": 0, "reads": 0, "fallbacks": 0, "last_copy_ms": None, "bytes": None}
+
+def _snapshot_refresh() -> None:
+    version = _current_data_version()  # taken first: the copy contains at least this version
+    t0 = pytime.perf_counter()
+    src = db_connect()
+    dst = sqlite3.connect(":memory:", check_same_thread=False)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+    dst.row_factory = sqlite3.Row
+    size = dst.execute("PRAGMA page_count").fetchone()[0] * dst.execute("PRAGMA page_size").fetchone()[0]
+    snap = {"conn": dst, "lock": threading.Lock(), "version": version,
+            "taken": pytime.monotonic(), "taken_at": iso(now_jst())}
+    with _snapshot_lock:
+        global _snapshot
+        _snapshot = snap  # the previous copy is freed once its last reader lets go
+        _snapshot_stats["refreshes"] += 1
+        _snapshot_stats["last_copy_ms"] = round((pytime.perf_counter() - t0) * 1000, 1)
+        _snapshot_stats["bytes"] = size
+
+def snapshot_loop():
+    while True:
+        try:
+            _snapshot_refresh()
+        except sqlite3.Error:
+            with _snapshot_lock:
+                _snapshot_stats["errors"] += 1
+        last = pytime.monotonic()
+        _snapshot_wake.wait(timeout=SNAPSHOT_SEC)
+        _snapshot_wake.clear()
+        gap = SNAPSHOT_MIN_GAP_SEC - (pytime.monotonic() - last)
+        if gap > 0:
+            pytime.sleep(gap)
+
+@contextmanager
+def _read_conn(min_version: Optional[int] = None):
+    """
+    Yields (conn, data_version) for read-only aggregates. data_version is what the
+    connection is known to include; never write through it and never close it.
+    """
+    snap = None
+    if SNAPSHOT_SEC > 0:
+        with _snapshot_lock:
+            snap = _snapshot
+            if snap is not None and (
+                pytime.monotonic() - snap["taken"] > SNAPSHOT_MAX_AGE_SEC
+                or (min_version is not None and snap["version"] < min_version)
+            ):
+                snap = None
+            _snapshot_stats["reads" if snap is not None else "fallbacks"] += 1
+    if snap is None:
+        version = _current_data_version()
+        conn = db_connect()
+        try:
+            yield conn, version
+        finally:
+            conn.close()
+        return
+    with snap["lock"]:
+        yield snap["conn"], snap["version"]
+
+def _snapshot_metrics() -> Dict[str, Any]:
+    with _snapshot_lock:
+        out: Dict[str, Any] = dict(_snapshot_stats)
+        snap = _snapshot
+    out["enabled"] = SNAPSHOT_SEC > 0
+    out["age_sec"] = round(pytime.monotonic() - snap["taken"], 1) if snap else None
+    out["taken_at"] = snap["taken_at"] if snap else None
+    out["version"] = snap["version"] if snap else None
+    out["data_version"] = _current_data_version()
+    return out
+
+# =========================================================
+# Rate limiting (token buckets in front of PIN verification)
+# =========================================================
+# Checked before any bcrypt or DB work: one bucket per client IP and one per student_no.
+# Failed PINs add an exponential block per student_no. The IP key also counts failures, but
+# with a much higher allowance and every success paying one back, so a shared kiosk where
+# students mistype now and then never locks itself out; only a spray of wrong PINs across
+# many students does. All state is in memory and bounded.
+RATE_MAX_KEYS = 20000
+RATE_FAIL_RESET_SEC = 15 * 60  # a failure streak is forgotten after this long without failures
+_rl_lock = threading.Lock()
+_rl_buckets: "OrderedDict[str, List[float]]" = OrderedDict()  # key -> [tokens, last_refill]
+_rl_fails: "OrderedDict[str, List[float]]" = OrderedDict()    # key -> [failures, blocked_until, last_failure]
+_rl_stats: Dict[str, int] = {"allowed": 0, "rejected_rate": 0, "rejected_backoff": 0, "failed_pins": 0}
+
+def _client_ip(request: Request) -> str:
+    if TRUST_PROXY:
+        fwd = request.headers.get("x-forwarded-for", "")
+        if fwd:
+            return fwd.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def _rl_touch(table: "OrderedDict[str, List[float]]", key: str, default: List[float]) -> List[float]:
+    entry = table.get(key)
+    if entry is None:
+        entry = table[key] = default
+        if len(table) > RATE_MAX_KEYS:
+            table.popitem(last=False)
+    else:
+        table.move_to_end(key)
+    return entry
+
+def _rl_take(keys: List[Tuple[str, int, float]], blocked_by: Tuple[str, ...] = ()) -> float:
+    """
+    Take one token from every (key, burst, per_sec) bucket; return seconds to wait (0 = allowed).
+    Keys in `blocked_by` only contribute their failure backoff (no token is taken).
+    """
+    now = pytime.monotonic()
+    wait = 0.0
+    with _rl_lock:
+        for key in [k[0] for k in keys] + list(blocked_by):
+            f = _rl_fails.get(key)
+            if f and f[1] > now:
+                wait = max(wait, f[1] - now)
+        if wait:
+            _rl_stats["rejected_backoff"] += 1
+            return wait
+        buckets = []
+        for key, burst, rate in keys:
+            b = _rl_touch(_rl_buckets, key, [float(burst), now])
+            b[0] = min(float(burst), b[0] + (now - b[1]) * rate)
+            b[1] = now
+            if b[0] < 1.0:
+                wait = max(wait, (1.0 - b[0]) / rate)
+            buckets.append(b)
+        if wait:
+            _rl_stats["rejected_rate"] += 1
+            return wait
+        for b in buckets:
+            b[0] -= 1.0
+        _rl_stats["allowed"] += 1
+    return 0.0
+
+def _rl_ip_key(request: Request) -> Tuple[str, int, float]:
+    return ("ip:" + _client_ip(request), RATE_IP_BURST, RATE_IP_PER_SEC)
+
+def _rl_student_key(student_no: str) -> Tuple[str, int, float]:
+    return ("sno:" + student_no, RATE_STUDENT_BURST, RATE_STUDENT_PER_SEC)
+
+def _raise_rate_limited(wait: float) -> None:
+    raise HTTPException(
+        status_code=429,
+        detail=f"試行回数が多すぎます。{math.ceil(wait)}秒後にもう一度お試しください",
+        headers={"Retry-After": str(math.ceil(wait))},
+    )
+
+def _rate_limit(request: Request, student_no: str) -> None:
+    """Raise 429 (with Retry-After) if this IP or student_no is over its budget or backing off."""
+    wait = _rl_take([_rl_ip_key(request), _rl_student_key(student_no)])
+    if wait:
+        _raise_rate_limited(wait)
+
+def _rl_record(request: Request, student_no: str, ok: bool) -> None:
+    now = pytime.monotonic()
+    sno_key, ip_key = "sno:" + student_no, "ip:" + _client_ip(request)
+    with _rl_lock:
+        if ok:
+            _rl_fails.pop(sno_key, None)
+            f = _rl_fails.get(ip_key)
+            if f:
+                f[0] = max(0.0, f[0] - 1)  # a success pays back one failure of the shared IP
+                if f[0] <= RATE_FAIL_FREE_IP:
+                    f[1] = 0.0
+            return
+        _rl_stats["failed_pins"] += 1
+        for key, free in ((ip_key, RATE_FAIL_FREE_IP), (sno_key, RATE_FAIL_FREE_STUDENT)):
+            f = _rl_touch(_rl_fails, key, [0.0, 0.0, now])
+            if now - f[2] > RATE_FAIL_RESET_SEC:
+                f[0] = 0.0
+            f[0] += 1
+            f[2] = now
+            over = int(f[0]) - free
+            if over > 0:
+                f[1] = now + min(RATE_FAIL_MAX_SEC, 2.0 ** (over - 1))
+
+def _rate_limit_metrics() -> Dict[str, Any]:
+    with _rl_lock:
+        out: Dict[str, Any] = dict(_rl_stats)
+        out["tracked_keys"] = len(_rl_buckets)
+        out["backing_off"] = sum(1 for f in _rl_fails.values() if f[1] > pytime.monotonic())
+    return out
 
 # =========================================================
 # Core helpers
@@ -267,10 +1027,63 @@ def _verify_user(student_no: str, pin: str) -> sqlite3.Row:
     cur.execute("SELECT * FROM users WHERE student_no = ?", (student_no,))
     row = cur.fetchone()
     conn.close()
-    if not row or not pwd_ctx.verify(pin, row["pin_hash"]):
+    if not row:
         raise HTTPException(status_code=401, detail="学籍番号またはPINが違います")
+    t0 = pytime.perf_counter()
+    ok, new_hash = pwd_ctx.verify_and_update(pin, row["pin_hash"])
+    _auth_record(pytime.perf_counter() - t0)
+    if not ok:
+        raise HTTPException(status_code=401, detail="学籍番号またはPINが違います")
+    if new_hash:
+        _rehash_pin(row["id"], row["pin_hash"], new_hash)
     return row
 
+def _rehash_pin(user_id: int, old_hash: str, new_hash: str) -> None:
+    """Store a hash upgraded to the current cost. Skipped if the PIN was reset meanwhile."""
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET pin_hash=? WHERE id=? AND pin_hash=?", (new_hash, user_id, old_hash))
+        conn.commit()
+        if cur.rowcount:
+            with _auth_lock:
+                _auth_stats["rehashed"] += 1
+    except sqlite3.Error:
+        pass  # best effort: retried on the next successful login
+    finally:
+        conn.close()
+
+_auth_lock = threading.Lock()
+_auth_stats: Dict[str, float] = {"verified": 0, "verify_sec": 0.0, "verify_max_sec": 0.0, "rehashed": 0}
+
+def _auth_record(elapsed: float) -> None:
+    with _auth_lock:
+        _auth_stats["verified"] += 1
+        _auth_stats["verify_sec"] += elapsed
+        _auth_stats["verify_max_sec"] = max(_auth_stats["verify_max_sec"], elapsed)
+
+def _auth_metrics() -> Dict[str, Any]:
+    with _auth_lock:
+        n = int(_auth_stats["verified"])
+        return {
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+            "verified": n,
+            "verify_avg_ms": round(_auth_stats["verify_sec"] * 1000 / n, 1) if n else None,
+            "verify_max_ms": round(_auth_stats["verify_max_sec"] * 1000, 1),
+            "rehashed": int(_auth_stats["rehashed"]),
+        }
+
+def _verify_user_limited(request: Request, student_no: str, pin: str) -> sqlite3.Row:
+    """_verify_user behind the rate limiter (429 before any hashing) with failure backoff."""
+    _rate_limit(request, student_no)
+    try:
+        user = _verify_user(student_no, pin)
+    except HTTPException:
+        _rl_record(request, student_no, False)
+        raise
+    _rl_record(request, student_no, True)
+    return user
+
 
 def _users_count(conn: sqlite3.Connection) -> int:
     cur = conn.cursor()
@@ -304,6 +1117,85 @@ def _open_session(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Ro
     """, (user_id,))
     return cur.fetchone()
 
+# checkout_at = ?1, duration in whole seconds computed from the stored checkin_at
+_CLOSE_SET = ("checkout_at = ?1, duration_sec = MAX(0, CAST(strftime('%s', ?1) AS INTEGER)"
+              " - CAST(strftime('%s', checkin_at) AS INTEGER))")
+
+def _index_closed(cur: sqlite3.Cursor, user_id: int, ci: datetime, t: datetime) -> None:
+    """Fold a just-closed [ci, t) into the day index, lifetime total and streak state."""
+    pieces = _add_to_day_index(cur, user_id, ci, t)
+    cur.execute("UPDATE users SET lifetime_sec = lifetime_sec + ? WHERE id = ?",
+                (sum(sec for _, sec in pieces), user_id))
+    _update_streak(cur, user_id, pieces)
+
+def _close_session(cur: sqlite3.Cursor, sess: sqlite3.Row, t: datetime, source: str) -> int:
+    """
+    Close one open session at `t` (caller commits).
+    Every checkout path goes through here or `_checkout_open`, so the event and the projections
+    are written in the same transaction. `sess` needs id / user_id / checkin_at.
+    """
+    cur.execute(f"UPDATE sessions SET {_CLOSE_SET} WHERE id = ?2 AND checkout_at IS NULL RETURNING duration_sec",
+                (iso(t), int(sess["id"])))
+    r = cur.fetchall()
+    if not r:
+        raise RuntimeError(f"session {sess['id']} is not open")
+    _append_event(cur, "out", int(sess["user_id"]), int(sess["id"]), t, source, checkin_at=sess["checkin_at"])
+    _index_closed(cur, int(sess["user_id"]), parse_iso(sess["checkin_at"]), t)
+    return int(r[0][0])
+
+def _checkin_open(cur: sqlite3.Cursor, user_id: int, t: datetime, source: str) -> Optional[int]:
+    """Open a session at `t` unless one is already open (idx_sessions_user_open). Returns its id; None = already in."""
+    cur.execute("""
+        INSERT INTO sessions (user_id, checkin_at, checkout_at, duration_sec)
+        VALUES (?, ?, NULL, NULL)
+        ON CONFLICT (user_id) WHERE checkout_at IS NULL DO NOTHING
+    """, (user_id, iso(t)))
+    if cur.rowcount != 1:
+        return None
+    sid = int(cur.lastrowid)
+    _append_event(cur, "in", user_id, sid, t, source)
+    return sid
+
+def _checkout_open(cur: sqlite3.Cursor, user_id: int, t: datetime, source: str) -> Optional[Tuple[datetime, int]]:
+    """
+    Close the user's open session at `t` with one conditional UPDATE (caller holds BEGIN IMMEDIATE and commits).
+    Returns (checkin time, duration sec), or None when the user is not checked in.
+    """
+    cur.execute(f"UPDATE sessions SET {_CLOSE_SET} WHERE user_id = ?2 AND checkout_at IS NULL RETURNING id, checkin_at, duration_sec",
+                (iso(t), user_id))
+    r = cur.fetchall()
+    if not r:
+        return None
+    sid, ci_s, dur = r[0]
+    _append_event(cur, "out", user_id, int(sid), t, source, checkin_at=ci_s)
+    ci = parse_iso(ci_s)
+    _index_closed(cur, user_id, ci, t)
+    return ci, int(dur)
+
+def _punch(user_id: int, action: str, source: str = "kiosk") -> Optional[Tuple[datetime, datetime, int]]:
+    """
+    Apply one live check-in ("in") or check-out ("out") in its own write transaction.
+    The punch time is read after the write lock is held, so punch times follow commit order.
+    Returns (checkin time, punch time, duration sec), or None on conflict (already in / not in).
+    """
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        t = now_jst()
+        if action == "in":
+            res = (t, t, 0) if _checkin_open(cur, user_id, t, source) is not None else None
+        else:
+            closed = _checkout_open(cur, user_id, t, source)
+            res = (closed[0], t, closed[1]) if closed else None
+        conn.commit()
+        return res
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 def _range_start_end(range_name: RangeName) -> tuple[datetime, datetime]:
     now = now_jst()
     if range_name == "all":
@@ -329,49 +1221,71 @@ def _range_start_end(range_name: RangeName) -> tuple[datetime, datetime]:
         return start, end
     raise ValueError("unknown range")
 
-def _fetch_sessions_overlapping(conn: sqlite3.Connection, start: datetime, end: datetime, user_id: Optional[int] = None):
+# Range scans stream: rows come off the cursor FETCH_BATCH at a time as plain tuples and are
+# folded into per-user sums as they arrive, so memory follows the number of users (and days),
+# never the number of sessions in the range.
+FETCH_BATCH = 10000
+
+def _iter_rows(cur: sqlite3.Cursor, batch: int = FETCH_BATCH) -> Iterator[Tuple[Any, ...]]:
+    """Stream the cursor's result set in fetchmany batches."""
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            return
+        yield from rows
+
+def _nicknames(conn: sqlite3.Connection) -> Dict[int, str]:
+    cur = conn.cursor()
+    cur.execute("SELECT id, nickname FROM users")
+    return {int(r[0]): r[1] for r in cur.fetchall()}
+
+def _fetch_sessions_overlapping(conn: sqlite3.Connection, start: datetime, end: datetime,
+                                user_id: Optional[int] = None) -> Iterator[Tuple[int, str, Optional[str]]]:
     """
-    Fetch sessions that overlap [start,end).
+    Stream sessions that overlap [start,end) as (user_id, checkin_at, checkout_at) tuples.
     IMPORTANT: This handles sessions that started before the range and ended inside/after.
+    Consume it before running other statements on the same connection's cursor.
     """
     cur = conn.cursor()
+    cur.row_factory = None  # plain tuples: no per-row Row object
+    src = _sessions_source(cur, start)
     if user_id is None:
-        cur.execute("""
-            SELECT u.id AS user_id, u.nickname AS nickname,
-                   s.checkin_at AS checkin_at, s.checkout_at AS checkout_at
-            FROM sessions s
-            JOIN users u ON u.id = s.user_id
+        cur.execute(f"""
+            SELECT s.user_id, s.checkin_at, s.checkout_at
+            FROM {src} s
             WHERE s.checkin_at < ?
               AND (s.checkout_at IS NULL OR s.checkout_at > ?)
         """, (iso(end), iso(start)))
     else:
-        cur.execute("""
-            SELECT u.id AS user_id, u.nickname AS nickname,
-                   s.checkin_at AS checkin_at, s.checkout_at AS checkout_at
-            FROM sessions s
-            JOIN users u ON u.id = s.user_id
+        cur.execute(f"""
+            SELECT s.user_id, s.checkin_at, s.checkout_at
+            FROM {src} s
             WHERE s.user_id = ?
               AND s.checkin_at < ?
               AND (s.checkout_at IS NULL OR s.checkout_at > ?)
         """, (user_id, iso(end), iso(start)))
-    return cur.fetchall()
+    return _iter_rows(cur)
+
+def _session_intervals(rows: Iterable[Tuple[int, str, Optional[str]]], now: datetime) -> Iterator[Tuple[int, datetime, datetime]]:
+    """(user_id, checkin, checkout) per row; open sessions run until `now`."""
+    for uid, ci, co in rows:
+        yield int(uid), parse_iso(ci), parse_iso(co) if co else now
 
 def _compute_totals_in_range(conn: sqlite3.Connection, start: datetime, end: datetime) -> Dict[int, Dict[str, Any]]:
     """
     Returns dict[user_id] = {"nickname": str, "total_sec": int}
     """
-    rows = _fetch_sessions_overlapping(conn, start, end, user_id=None)
-    now = now_jst()
+    if _columns_enabled():
+        totals = _columns_totals(conn, start, end)
+        if totals is not None:
+            return totals
+    nick = _nicknames(conn)
     totals: Dict[int, Dict[str, Any]] = {}
-    for r in rows:
-        uid = int(r["user_id"])
-        nick = r["nickname"]
-        ci = parse_iso(r["checkin_at"])
-        co = parse_iso(r["checkout_at"]) if r["checkout_at"] else now
-        sec = clamp_overlap_sec(ci, co, start, end)
-        if uid not in totals:
-            totals[uid] = {"nickname": nick, "total_sec": 0}
-        totals[uid]["total_sec"] += sec
+    for uid, ci, co in _session_intervals(_fetch_sessions_overlapping(conn, start, end), now_jst()):
+        t = totals.get(uid)
+        if t is None:
+            t = totals[uid] = {"nickname": nick.get(uid), "total_sec": 0}
+        t["total_sec"] += clamp_overlap_sec(ci, co, start, end)
     return totals
 
 def _rank_of_user(totals: Dict[int, Dict[str, Any]], user_id: int) -> Dict[str, Any]:
@@ -386,12 +1300,9 @@ def _rank_of_user(totals: Dict[int, Dict[str, Any]], user_id: int) -> Dict[str,
 
 def _all_time_total_sec(conn: sqlite3.Connection, user_id: int) -> int:
     cur = conn.cursor()
-    cur.execute("""
-        SELECT SUM(duration_sec) AS sec
-        FROM sessions
-        WHERE user_id = ? AND checkout_at IS NOT NULL
-    """, (user_id,))
-    sec = int(cur.fetchone()["sec"] or 0)
+    cur.execute("SELECT lifetime_sec FROM users WHERE id = ?", (user_id,))
+    r = cur.fetchone()
+    sec = int(r["lifetime_sec"]) if r else 0
     # plus active
     cur.execute("""
         SELECT checkin_at FROM sessions
@@ -418,30 +1329,28 @@ def _daily_series_for_all_users(conn: sqlite3.Connection, start: datetime, end:
         day_starts.append(d)
         d = d + timedelta(days=1)
 
-    rows = _fetch_sessions_overlapping(conn, start, end, user_id=None)
-    now = now_jst()
-
+    if _columns_enabled():
+        daily = _columns_daily(conn, start, end, labels, day_starts)
+        if daily is not None:
+            return daily
+    nick = _nicknames(conn)
     user_to_secs: Dict[int, List[int]] = {}
     user_to_nick: Dict[int, str] = {}
+    if not day_starts:
+        return labels, user_to_secs, user_to_nick
+    one_day = timedelta(days=1)
 
-    for r in rows:
-        uid = int(r["user_id"])
-        nick = r["nickname"]
-        user_to_nick[uid] = nick
-        if uid not in user_to_secs:
-            user_to_secs[uid] = [0 for _ in labels]
-
-        ci = parse_iso(r["checkin_at"])
-        co = parse_iso(r["checkout_at"]) if r["checkout_at"] else now
-
-        # distribute overlap into each day bin
-        for i, ds in enumerate(day_starts):
-            de = ds + timedelta(days=1)
-            if de <= ci or ds >= co:
-                continue
-            sec = clamp_overlap_sec(ci, co, ds, de)
-            if sec:
-                user_to_secs[uid][i] += sec
+    for uid, ci, co in _session_intervals(_fetch_sessions_overlapping(conn, start, end), now_jst()):
+        secs = user_to_secs.get(uid)
+        if secs is None:
+            secs = user_to_secs[uid] = [0 for _ in labels]
+            user_to_nick[uid] = nick.get(uid)
+
+        # distribute overlap into the day bins it touches
+        i = max(0, (ci - day_starts[0]) // one_day)
+        while i < len(day_starts) and day_starts[i] < co:
+            secs[i] += clamp_overlap_sec(ci, co, day_starts[i], day_starts[i] + one_day)
+            i += 1
 
     return labels, user_to_secs, user_to_nick
 
@@ -469,6 +1378,1191 @@ def _rank_series_for_user(labels: List[str], user_to_secs: Dict[int, List[int]],
         })
     return series
 
+# =========================================================
+# Day index (per-user cumulative daily totals of closed sessions)
+# =========================================================
+# user_day_totals(user_id, day, sec, cum_sec):
+#   sec     = closed-session seconds inside that JST day
+#   cum_sec = sum of sec over all days <= day (prefix sum)
+# => closed-day total for [d0, d1] = cum(d1) - cum(d0 - 1) : two index seeks per user.
+# Open sessions are never in the index; they are added live.
+
+def _day_start(d: date) -> datetime:
+    return datetime(d.year, d.month, d.day, tzinfo=JST)
+
+def _split_by_day(ci: datetime, co: datetime) -> List[Tuple[str, int]]:
+    """
+    Split [ci,co) into JST day bins -> [("YYYY-MM-DD", sec), ...].
+    Works in whole epoch seconds so the bins add up exactly to the interval length.
+    """
+    out: List[Tuple[str, int]] = []
+    a = int(ci.timestamp())
+    b = int(co.timestamp())
+    d = ci.astimezone(JST).date()
+    while True:
+        ds = int(_day_start(d).timestamp())
+        if ds >= b:
+            break
+        sec = min(b, ds + 86400) - max(a, ds)
+        if sec > 0:
+            out.append((d.isoformat(), sec))
+        d = d + timedelta(days=1)
+    return out
+
+def _add_to_day_index(cur: sqlite3.Cursor, user_id: int, ci: datetime, co: datetime) -> List[Tuple[str, int]]:
+    """
+    Add a closed interval to the index. Works for back-dated intervals too (shifts later prefix sums).
+    Returns the (day, sec) pieces added (users.lifetime_sec is kept equal to the user's last cum_sec).
+    """
+    pieces = _split_by_day(ci, co)
+    for day, sec in pieces:
+        cur.execute("""
+            INSERT INTO user_day_totals (user_id, day, sec, cum_sec)
+            VALUES (?, ?, 0, COALESCE((
+                SELECT cum_sec FROM user_day_totals
+                WHERE user_id = ? AND day < ?
+                ORDER BY day DESC LIMIT 1
+            ), 0))
+            ON CONFLICT(user_id, day) DO NOTHING
+        """, (user_id, day, user_id, day))
+        cur.execute("UPDATE user_day_totals SET sec = sec + ? WHERE user_id = ? AND day = ?", (sec, user_id, day))
+        cur.execute("UPDATE user_day_totals SET cum_sec = cum_sec + ? WHERE user_id = ? AND day >= ?", (sec, user_id, day))
+    return pieces
+
+def _rebuild_day_index(cur: sqlite3.Cursor) -> None:
+    """Recompute user_day_totals from all closed sessions, archived ones included (migration / repair)."""
+    per_user: Dict[int, Dict[str, int]] = {}
+    has_archive = "sessions_archive" in _table_names(cur)
+    cur.execute(
+        "SELECT user_id, checkin_at, checkout_at FROM sessions WHERE checkout_at IS NOT NULL"
+        + (" UNION ALL SELECT user_id, checkin_at, checkout_at FROM sessions_archive" if has_archive else "")
+    )
+    for uid, ci, co in _iter_rows(cur):
+        days = per_user.setdefault(int(uid), {})
+        for day, sec in _split_by_day(parse_iso(ci), parse_iso(co)):
+            days[day] = days.get(day, 0) + sec
+
+    def rows() -> Iterator[Tuple[int, str, int, int]]:
+        for uid, days in per_user.items():
+            cum = 0
+            for day in sorted(days):
+                cum += days[day]
+                yield uid, day, days[day], cum
+
+    cur.execute("DELETE FROM user_day_totals")
+    cur.executemany("INSERT INTO user_day_totals (user_id, day, sec, cum_sec) VALUES (?, ?, ?, ?)", rows())
+
+def _rebuild_lifetime(cur: sqlite3.Cursor) -> None:
+    """Recompute users.lifetime_sec from the day index (migration / repair; rebuild the index first)."""
+    cur.execute("""
+        UPDATE users SET lifetime_sec = COALESCE((
+            SELECT cum_sec FROM user_day_totals t
+            WHERE t.user_id = users.id
+            ORDER BY t.day DESC LIMIT 1
+        ), 0)
+    """)
+
+# ---------------------------------------------------------
+# Streaks / personal best (full history)
+# ---------------------------------------------------------
+# user_streaks keeps, per user, the latest run of consecutive study days (run_start..run_end),
+# the longest run ever and the best single day, all over closed sessions. Checkout extends it
+# in O(1); an interval back-dated before the current run (batch punches, imports) rebuilds
+# that user from the day index. Day rollover needs no write: a run is "current" only while
+# run_end is today, which is decided when the dashboard reads it.
+def _streak_row(user_id: int, days: List[Tuple[str, int]]) -> Optional[Tuple[Any, ...]]:
+    """user_streaks row from one user's (day, sec) study days in ascending order."""
+    run_start = run_end = longest_end = best_day = None
+    longest = best_sec = 0
+    for day, sec in days:
+        d = date.fromisoformat(day)
+        if run_end is not None and d == run_end + timedelta(days=1):
+            run_end = d
+        else:
+            run_start = run_end = d
+        length = (run_end - run_start).days + 1
+        if length > longest:
+            longest, longest_end = length, run_end
+        if sec > best_sec:
+            best_sec, best_day = sec, d
+    if run_start is None:
+        return None
+    return (user_id, run_start.isoformat(), run_end.isoformat(), longest, longest_end.isoformat(),
+            best_sec, best_day.isoformat())
+
+def _rebuild_streaks(cur: sqlite3.Cursor, user_id: Optional[int] = None) -> None:
+    """Recompute user_streaks from user_day_totals (all users, or one)."""
+    if user_id is None:
+        cur.execute("DELETE FROM user_streaks")
+        cur.execute("SELECT user_id, day, sec FROM user_day_totals WHERE sec > 0 ORDER BY user_id, day")
+    else:
+        cur.execute("DELETE FROM user_streaks WHERE user_id = ?", (user_id,))
+        cur.execute("SELECT user_id, day, sec FROM user_day_totals WHERE user_id = ? AND sec > 0 ORDER BY day", (user_id,))
+    per_user: Dict[int, List[Tuple[str, int]]] = {}
+    for uid, day, sec in cur.fetchall():
+        per_user.setdefault(int(uid), []).append((day, int(sec)))
+    rows = [r for r in (_streak_row(uid, days) for uid, days in per_user.items()) if r]
+    cur.executemany("INSERT INTO user_streaks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+def _update_streak(cur: sqlite3.Cursor, user_id: int, pieces: List[Tuple[str, int]]) -> None:
+    """Fold a just-closed interval (pieces from _add_to_day_index) into user_streaks."""
+    study = sorted(day for day, sec in pieces if sec > 0)
+    if not study:
+        return
+    cur.execute("SELECT * FROM user_streaks WHERE user_id = ?", (user_id,))
+    st = cur.fetchone()
+    if st is None or study[0] < st["run_start"]:
+        _rebuild_streaks(cur, user_id)
+        return
+    run_start, run_end = date.fromisoformat(st["run_start"]), date.fromisoformat(st["run_end"])
+    first, last = date.fromisoformat(study[0]), date.fromisoformat(study[-1])
+    if first > run_end + timedelta(days=1):
+        run_start = first
+    run_end = max(run_end, last)
+    longest, longest_end = int(st["longest"]), st["longest_end"]
+    length = (run_end - run_start).days + 1
+    if length > longest:
+        longest, longest_end = length, run_end.isoformat()
+    best_sec, best_day = int(st["best_sec"]), st["best_day"]
+    cur.execute(
+        f"SELECT day, sec FROM user_day_totals WHERE user_id = ? AND day IN ({','.join('?' * len(study))}) ORDER BY day",
+        (user_id, *study),
+    )
+    for day, sec in cur.fetchall():
+        if int(sec) > best_sec:
+            best_sec, best_day = int(sec), day
+    cur.execute("""
+        UPDATE user_streaks
+        SET run_start = ?, run_end = ?, longest = ?, longest_end = ?, best_sec = ?, best_day = ?
+        WHERE user_id = ?
+    """, (run_start.isoformat(), run_end.isoformat(), longest, longest_end, best_sec, best_day, user_id))
+
+def _open_session_starts(cur: sqlite3.Cursor) -> List[Tuple[int, datetime]]:
+    cur.execute("SELECT user_id, checkin_at FROM sessions WHERE checkout_at IS NULL")
+    return [(int(r[0]), parse_iso(r[1])) for r in cur.fetchall()]
+
+def _lifetime_totals(conn: sqlite3.Connection) -> Dict[int, Dict[str, Any]]:
+    """
+    All-time totals, same shape as _compute_totals_in_range:
+    users.lifetime_sec (closed sessions) + live time of open sessions. O(users), no history scan.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT id, nickname, lifetime_sec FROM users")
+    nick: Dict[int, str] = {}
+    totals: Dict[int, Dict[str, Any]] = {}
+    for r in cur.fetchall():
+        uid = int(r["id"])
+        nick[uid] = r["nickname"]
+        if int(r["lifetime_sec"]) > 0:
+            totals[uid] = {"nickname": r["nickname"], "total_sec": int(r["lifetime_sec"])}
+    now = now_jst()
+    for uid, ci in _open_session_starts(cur):
+        if uid not in nick:
+            continue
+        if uid not in totals:
+            totals[uid] = {"nickname": nick[uid], "total_sec": 0}
+        totals[uid]["total_sec"] += max(0, int((now - ci).total_seconds()))
+    return totals
+
+def _parse_day_range(start: Optional[str], end: Optional[str]) -> Tuple[date, date]:
+    """Validate ?start=YYYY-MM-DD&end=YYYY-MM-DD (inclusive). end defaults to today."""
+    if not start:
+        raise HTTPException(status_code=400, detail="start（YYYY-MM-DD）を指定してください")
+    try:
+        d0 = date.fromisoformat(start)
+        d1 = date.fromisoformat(end) if end else now_jst().date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付は YYYY-MM-DD 形式で指定してください")
+    if d1 < d0:
+        raise HTTPException(status_code=400, detail="end は start 以降の日付にしてください")
+    return d0, d1
+
+def _day_range_totals(conn: sqlite3.Connection, d0: date, d1: date) -> Dict[int, Dict[str, Any]]:
+    """
+    Totals for the inclusive day range [d0, d1], same shape as _compute_totals_in_range.
+    Closed sessions: prefix-sum difference from user_day_totals.
+    Open sessions: overlap with [d0 00:00, min(d1+1 00:00, now)) computed live.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT u.id AS user_id, u.nickname AS nickname,
+               COALESCE((SELECT cum_sec FROM user_day_totals t
+                         WHERE t.user_id = u.id AND t.day <= ?
+                         ORDER BY t.day DESC LIMIT 1), 0)
+             - COALESCE((SELECT cum_sec FROM user_day_totals t
+                         WHERE t.user_id = u.id AND t.day < ?
+                         ORDER BY t.day DESC LIMIT 1), 0) AS total_sec
+        FROM users u
+    """, (d1.isoformat(), d0.isoformat()))
+    totals: Dict[int, Dict[str, Any]] = {}
+    nick: Dict[int, str] = {}
+    for r in cur.fetchall():
+        uid = int(r["user_id"])
+        nick[uid] = r["nickname"]
+        if int(r["total_sec"]) > 0:
+            totals[uid] = {"nickname": r["nickname"], "total_sec": int(r["total_sec"])}
+
+    start = _day_start(d0)
+    end = _day_start(d1) + timedelta(days=1)
+    now = now_jst()
+    cur.execute("SELECT user_id, checkin_at FROM sessions WHERE checkout_at IS NULL AND checkin_at < ?", (iso(end),))
+    for r in cur.fetchall():
+        uid = int(r["user_id"])
+        sec = clamp_overlap_sec(parse_iso(r["checkin_at"]), now, start, end)
+        if uid not in nick:
+            continue
+        if uid not in totals:
+            totals[uid] = {"nickname": nick[uid], "total_sec": 0}
+        totals[uid]["total_sec"] += sec
+    return totals
+
+# =========================================================
+# Session archive (hot / cold)
+# =========================================================
+# Closed sessions that ended before a cutoff move from `sessions` to `sessions_archive`
+# (same ids and columns), so the hot table and its indexes only hold recent history.
+# user_day_totals already summarizes every closed session per user and day, so totals,
+# ranks and streaks never read the archive. Only readers of raw intervals that reach back
+# past the archive horizon (overlap queries, heatmap, timeline, index rebuild) union it in.
+SESSION_COLUMNS = "id, user_id, checkin_at, checkout_at, duration_sec"
+ARCHIVE_MIN_DAYS = 30  # never archive inside the offline-punch / recent-dashboard window
+ARCHIVE_BATCH = 5000   # rows moved per transaction (keeps the write lock short)
+
+def _archive_horizon(cur: sqlite3.Cursor) -> Optional[str]:
+    """ISO time before which closed sessions may live in sessions_archive (None = nothing archived)."""
+    cur.execute("SELECT MAX(cutoff) AS c FROM archive_runs")
+    return cur.fetchone()[0]
+
+def _sessions_source(cur: sqlite3.Cursor, start: datetime) -> str:
+    """FROM-clause for sessions overlapping [start, ...): the hot table, plus the archive if needed."""
+    horizon = _archive_horizon(cur)
+    if horizon is None or iso(start) >= horizon:
+        return "sessions"
+    return f"(SELECT {SESSION_COLUMNS} FROM sessions UNION ALL SELECT {SESSION_COLUMNS} FROM sessions_archive)"
+
+def _archive_sessions(before: datetime, batch: int = ARCHIVE_BATCH) -> int:
+    """Move sessions closed before `before` into sessions_archive. Returns the number moved."""
+    if before > now_jst() - timedelta(days=ARCHIVE_MIN_DAYS):
+        raise ValueError(f"cutoff must be at least {ARCHIVE_MIN_DAYS} days ago")
+    cutoff = iso(before)
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        # record the horizon first: readers start including the archive before any row moves
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("INSERT INTO archive_runs (cutoff, started_at) VALUES (?, ?)", (cutoff, iso(now_jst())))
+        run_id = cur.lastrowid
+        conn.commit()
+        moved = 0
+        while True:
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute(
+                "SELECT id FROM sessions WHERE checkout_at IS NOT NULL AND checkout_at < ? ORDER BY id LIMIT ?",
+                (cutoff, batch),
+            )
+            ids = [r[0] for r in cur.fetchall()]
+            if not ids:
+                conn.commit()
+                break
+            lo, hi = ids[0], ids[-1]
+            cur.execute(f"""
+                INSERT OR REPLACE INTO sessions_archive ({SESSION_COLUMNS})
+                SELECT {SESSION_COLUMNS} FROM sessions
+                WHERE id BETWEEN ? AND ? AND checkout_at IS NOT NULL AND checkout_at < ?
+            """, (lo, hi, cutoff))
+            cur.execute(
+                "DELETE FROM sessions WHERE id BETWEEN ? AND ? AND checkout_at IS NOT NULL AND checkout_at < ?",
+                (lo, hi, cutoff),
+            )
+            moved += cur.rowcount
+            cur.execute("UPDATE archive_runs SET moved = ? WHERE id = ?", (moved, run_id))
+            conn.commit()
+        cur.execute("UPDATE archive_runs SET finished_at = ? WHERE id = ?", (iso(now_jst()), run_id))
+        _bump_write_counter(cur)
+        conn.commit()
+        return moved
+    finally:
+        conn.close()
+
+def _archive_metrics() -> Dict[str, Any]:
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT cutoff, moved, started_at, finished_at FROM archive_runs ORDER BY id DESC LIMIT 1")
+        last = cur.fetchone()
+        return {
+            "horizon": _archive_horizon(cur),
+            "auto_after_days": ARCHIVE_AFTER_DAYS or None,
+            "last_run": dict(last) if last else None,
+        }
+    finally:
+        conn.close()
+
+# =========================================================
+# Online backup
+# =========================================================
+# The sqlite3 backup API copies BACKUP_PAGES_PER_STEP pages at a time and sleeps between
+# steps, so kiosk writes get the lock in between (a write during the copy makes SQLite
+# restart it, which is cheap at our DB size). Each copy goes to a .part file, must pass
+# PRAGMA integrity_check, and is then renamed into place; only the newest BACKUP_KEEP stay.
+BACKUP_PREFIX = "studyroom-"
+_backup_lock = threading.Lock()  # one backup at a time (scheduler, admin API, CLI); held for the whole copy
+_backup_stats_lock = threading.Lock()  # metrics never wait for a running backup
+_backup_stats: Dict[str, Any] = {"ok": 0, "failed": 0, "last": None, "last_error": None}
+
+def _backup_files() -> List[str]:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    names = [n for n in os.listdir(BACKUP_DIR) if n.startswith(BACKUP_PREFIX) and n.endswith(".sqlite3")]
+    return [os.path.join(BACKUP_DIR, n) for n in sorted(names)]  # timestamped names sort by age
+
+def _run_backup() -> Dict[str, Any]:
+    """Take one verified backup and apply retention. Raises RuntimeError on failure."""
+    with _backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        now = now_jst()
+        path = os.path.join(BACKUP_DIR, f"{BACKUP_PREFIX}{now.strftime('%Y%m%d-%H%M%S')}.sqlite3")
+        tmp = path + ".part"
+        steps = {"n": 0, "pages": 0}
+
+        def progress(status: int, remaining: int, total: int) -> None:
+            steps["n"] += 1
+            steps["pages"] = total
+            if remaining:
+                pytime.sleep(BACKUP_STEP_SLEEP_MS / 1000)
+
+        t0 = pytime.perf_counter()
+        try:
+            src = db_connect()
+            dst = sqlite3.connect(tmp)
+            try:
+                src.backup(dst, pages=max(1, BACKUP_PAGES_PER_STEP), progress=progress)
+            finally:
+                dst.close()
+                src.close()
+            elapsed = pytime.perf_counter() - t0
+            chk = sqlite3.connect(tmp)
+            try:
+                integrity = chk.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                chk.close()
+            if integrity != "ok":
+                raise RuntimeError(f"integrity_check: {integrity}")
+            os.replace(tmp, path)
+        except (sqlite3.Error, OSError, RuntimeError) as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            with _backup_stats_lock:
+                _backup_stats["failed"] += 1
+                _backup_stats["last_error"] = {"at": iso(now), "error": str(e)}
+            raise RuntimeError(f"backup failed: {e}") from e
+
+        removed = []
+        files = _backup_files()
+        for old in files[:max(0, len(files) - max(1, BACKUP_KEEP))]:
+            os.remove(old)
+            removed.append(os.path.basename(old))
+        result = {
+            "file": os.path.basename(path),
+            "at": iso(now),
+            "bytes": os.path.getsize(path),
+            "pages": steps["pages"],
+            "steps": steps["n"],
+            "duration_ms": round(elapsed * 1000, 1),
+            "pages_per_sec": round(steps["pages"] / elapsed) if elapsed > 0 else None,
+            "integrity": "ok",
+            "removed": removed,
+        }
+        with _backup_stats_lock:
+            _backup_stats["ok"] += 1
+            _backup_stats["last"] = result
+        return result
+
+def backup_loop():
+    interval = BACKUP_INTERVAL_HOURS * 3600
+    while True:
+        files = _backup_files()
+        age = pytime.time() - os.path.getmtime(files[-1]) if files else None
+        if age is None or age >= interval:
+            try:
+                _run_backup()
+            except RuntimeError:
+                pass  # recorded in _backup_stats; retry next round
+            age = 0.0
+        pytime.sleep(max(60.0, interval - age))
+
+def _backup_metrics() -> Dict[str, Any]:
+    with _backup_stats_lock:
+        out = dict(_backup_stats)
+    out["running"] = _backup_lock.locked()
+    out["dir"] = BACKUP_DIR
+    out["interval_hours"] = BACKUP_INTERVAL_HOURS or None
+    out["files"] = [os.path.basename(p) for p in _backup_files()]
+    return out
+
+# =========================================================
+# Punch event log
+# =========================================================
+# punch_events is the append-only record of every check-in/out (triggers reject UPDATE and
+# DELETE). sessions, user_day_totals, users.lifetime_sec and user_streaks are projections of
+# it: the write path appends the event and applies it to them in the same transaction, so
+# reads stay exact. Leaderboards and rankings read only those projections.
+# event_snapshots captures the projection state at an event seq (day totals + open sessions;
+# lifetime and streaks derive from the day totals), so a rebuild restores the latest snapshot
+# and replays only the events after it. Closed sessions never change, so sessions are
+# restored by dropping ids above the snapshot and reopening the ones open at that point.
+EVENT_SNAPSHOT_KEEP = 2
+
+def _append_event(cur: sqlite3.Cursor, kind: str, user_id: int, session_id: int, at: datetime, source: str,
+                  checkin_at: Optional[str] = None) -> None:
+    cur.execute("""
+        INSERT INTO punch_events (kind, user_id, session_id, at, checkin_at, source, recorded_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (kind, user_id, session_id, iso(at), checkin_at, source, iso(now_jst())))
+    _bump_write_counter(cur)  # every punch path logs an event, so this covers them all
+
+def _backfill_events(cur: sqlite3.Cursor) -> None:
+    """Derive the log from existing sessions (archive included), in punch-time order (migration)."""
+    has_archive = "sessions_archive" in _table_names(cur)
+    cur.execute(
+        "SELECT id, user_id, checkin_at, checkout_at FROM sessions"
+        + (" UNION ALL SELECT id, user_id, checkin_at, checkout_at FROM sessions_archive" if has_archive else "")
+    )
+    events = []
+    for sid, uid, ci, co in cur.fetchall():
+        events.append((ci, int(sid), 0, "in", int(uid), None))
+        if co:
+            events.append((co, int(sid), 1, "out", int(uid), ci))
+    events.sort(key=lambda e: (parse_iso(e[0]), e[1], e[2]))
+    now = iso(now_jst())
+    cur.executemany("""
+        INSERT INTO punch_events (kind, user_id, session_id, at, checkin_at, source, recorded_at)
+        VALUES (?, ?, ?, ?, ?, 'backfill', ?)
+    """, [(kind, uid, sid, at, ci, now) for at, sid, _o, kind, uid, ci in events])
+
+def _take_event_snapshot(cur: sqlite3.Cursor) -> int:
+    """Capture the projections at the current event seq (caller holds the write lock and commits)."""
+    cur.execute("SELECT COALESCE(MAX(seq), 0), COALESCE(MAX(session_id), 0) FROM punch_events")
+    seq, max_sid = (int(v) for v in cur.fetchone())
+    cur.execute("INSERT INTO event_snapshots (seq, max_session_id, taken_at) VALUES (?, ?, ?)",
+                (seq, max_sid, iso(now_jst())))
+    snap_id = int(cur.lastrowid)
+    cur.execute("INSERT INTO event_snapshot_days SELECT ?, user_id, day, sec FROM user_day_totals WHERE sec > 0", (snap_id,))
+    cur.execute("""
+        INSERT INTO event_snapshot_open
+        SELECT ?, id, user_id, checkin_at FROM sessions WHERE checkout_at IS NULL
+    """, (snap_id,))
+    cur.execute("SELECT id FROM event_snapshots ORDER BY id DESC LIMIT -1 OFFSET ?", (EVENT_SNAPSHOT_KEEP,))
+    for (old,) in cur.fetchall():
+        cur.execute("DELETE FROM event_snapshot_days WHERE snapshot_id = ?", (old,))
+        cur.execute("DELETE FROM event_snapshot_open WHERE snapshot_id = ?", (old,))
+        cur.execute("DELETE FROM event_snapshots WHERE id = ?", (old,))
+    return snap_id
+
+def _replay_events(cur: sqlite3.Cursor, use_snapshot: bool = True) -> Dict[str, Any]:
+    """
+    Rebuild sessions, user_day_totals, lifetime totals and streaks from the log
+    (latest snapshot + the events after it, or the whole log). Caller holds the write lock and commits.
+    From a snapshot, session rows closed before it are trusted as they are; use the whole log to repair those.
+    """
+    snap = None
+    if use_snapshot:
+        cur.execute("SELECT id, seq, max_session_id FROM event_snapshots ORDER BY id DESC LIMIT 1")
+        snap = cur.fetchone()
+    from_seq = int(snap["seq"]) if snap else 0
+    max_sid = int(snap["max_session_id"]) if snap else 0
+
+    days: Dict[int, Dict[str, int]] = {}
+    open_at_snap: Dict[int, Tuple[int, str]] = {}
+    if snap:
+        cur.execute("SELECT user_id, day, sec FROM event_snapshot_days WHERE snapshot_id = ?", (int(snap["id"]),))
+        for uid, day, sec in cur.fetchall():
+            days.setdefault(int(uid), {})[day] = int(sec)
+        cur.execute("SELECT session_id, user_id, checkin_at FROM event_snapshot_open WHERE snapshot_id = ?", (int(snap["id"]),))
+        open_at_snap = {int(r[0]): (int(r[1]), r[2]) for r in cur.fetchall()}
+
+    # archived ids stay in the archive; only their day totals are replayed
+    archived = set()
+    if "sessions_archive" in _table_names(cur):
+        low = min([max_sid + 1, *open_at_snap])
+        cur.execute("SELECT id FROM sessions_archive WHERE id >= ?", (low,))
+        archived = {int(r[0]) for r in cur.fetchall()}
+
+    new_rows: Dict[int, List[Any]] = {}   # sid -> [user_id, checkin_at, checkout_at]
+    closes: Dict[int, str] = {}           # sessions open at the snapshot that closed since
+    n = 0
+    cur.execute("SELECT kind, user_id, session_id, at, checkin_at FROM punch_events WHERE seq > ? ORDER BY seq", (from_seq,))
+    for kind, uid, sid, at, ci in cur.fetchall():
+        n += 1
+        if kind == "in":
+            new_rows[int(sid)] = [int(uid), at, None]
+            continue
+        if int(sid) in new_rows:
+            new_rows[int(sid)][2] = at
+        else:
+            closes[int(sid)] = at
+        per_day = days.setdefault(int(uid), {})
+        for day, sec in _split_by_day(parse_iso(ci), parse_iso(at)):
+            per_day[day] = per_day.get(day, 0) + sec
+
+    cur.execute("DELETE FROM sessions WHERE id > ?", (max_sid,))
+    cur.executemany("UPDATE sessions SET checkout_at = NULL, duration_sec = NULL WHERE id = ?",
+                    [(sid,) for sid in open_at_snap])
+    cur.executemany(f"UPDATE sessions SET {_CLOSE_SET} WHERE id = ?2",
+                    [(co, sid) for sid, co in closes.items() if sid not in archived])
+    cur.executemany("INSERT INTO sessions (id, user_id, checkin_at, checkout_at) VALUES (?, ?, ?, ?)",
+                    [(sid, *row) for sid, row in new_rows.items() if sid not in archived])
+    cur.execute("""
+        UPDATE sessions
+        SET duration_sec = MAX(0, CAST(strftime('%s', checkout_at) AS INTEGER) - CAST(strftime('%s', checkin_at) AS INTEGER))
+        WHERE id > ? AND checkout_at IS NOT NULL
+    """, (max_sid,))
+
+    rows: List[Tuple[int, str, int, int]] = []
+    for uid, per_day in days.items():
+        cum = 0
+        for day in sorted(per_day):
+            cum += per_day[day]
+            rows.append((uid, day, per_day[day], cum))
+    cur.execute("DELETE FROM user_day_totals")
+    cur.executemany("INSERT INTO user_day_totals (user_id, day, sec, cum_sec) VALUES (?, ?, ?, ?)", rows)
+    _rebuild_lifetime(cur)
+    _rebuild_streaks(cur)
+    cur.execute("DELETE FROM occupancy_cache")  # derived from sessions
+    return {"snapshot_id": int(snap["id"]) if snap else None, "from_seq": from_seq, "replayed": n}
+
+def _projection_fingerprint(cur: sqlite3.Cursor) -> Dict[str, Any]:
+    """
+    Compact digest of every projection, to compare a replay against the live tables.
+    duration_sec is left out: rows written before the log existed rounded it differently.
+    """
+    out: Dict[str, Any] = {}
+    for name, sql in (
+        ("sessions", "SELECT id, user_id, checkin_at, checkout_at FROM sessions ORDER BY id"),
+        ("day_totals", "SELECT user_id, day, sec, cum_sec FROM user_day_totals WHERE sec > 0 ORDER BY user_id, day"),
+        ("lifetime", "SELECT id, lifetime_sec FROM users ORDER BY id"),
+        ("streaks", "SELECT * FROM user_streaks ORDER BY user_id"),
+    ):
+        cur.execute(sql)
+        out[name] = hash(tuple(tuple(r) for r in cur.fetchall()))
+    return out
+
+def event_snapshot_loop():
+    while True:
+        pytime.sleep(EVENT_SNAPSHOT_HOURS * 3600)
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            _finish_import_runs(cur)  # repairs an interrupted import
+            if not _import_unfinished(cur):  # mid-import the totals lag the log
+                _take_event_snapshot(cur)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()  # DB busy / locked: next round
+        finally:
+            conn.close()
+
+def _event_metrics() -> Dict[str, Any]:
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(seq), 0) FROM punch_events")
+        last_seq = int(cur.fetchone()[0])
+        cur.execute("SELECT id, seq, taken_at FROM event_snapshots ORDER BY id DESC LIMIT 1")
+        snap = cur.fetchone()
+        return {
+            "last_seq": last_seq,
+            "snapshot": dict(snap) if snap else None,
+            "events_since_snapshot": last_seq - (int(snap["seq"]) if snap else 0),
+            "snapshot_every_hours": EVENT_SNAPSHOT_HOURS or None,
+        }
+    finally:
+        conn.close()
+
+# =========================================================
+# Occupancy analytics (weekday x time-of-day heatmap, daily peaks)
+# =========================================================
+OCCUPANCY_BINS = (5, 10, 15, 20, 30, 60)  # minutes; must divide a day evenly
+WEEKDAY_LABELS = ["月", "火", "水", "木", "金", "土", "日"]
+
+def _session_epochs(conn: sqlite3.Connection, t0: int, t1: int, now_ts: int) -> Tuple[List[int], List[int]]:
+    """
+    (start, end) epoch seconds of sessions overlapping [t0,t1), clipped to it.
+    Open sessions end at `now`. Timestamps are converted by SQLite, so no per-row datetime parsing.
+    """
+    cur = conn.cursor()
+    src = _sessions_source(cur, datetime.fromtimestamp(t0, JST))
+    cur.execute(f"""
+        SELECT MAX(CAST(strftime('%s', checkin_at) AS INTEGER), ?) AS a,
+               MIN(COALESCE(CAST(strftime('%s', checkout_at) AS INTEGER), ?), ?) AS b
+        FROM {src}
+        WHERE checkin_at < ?
+          AND (checkout_at IS NULL OR checkout_at > ?)
+    """, (t0, now_ts, t1, iso(datetime.fromtimestamp(t1, JST)), iso(datetime.fromtimestamp(t0, JST))))
+    starts: List[int] = []
+    ends: List[int] = []
+    for a, b in cur.fetchall():
+        if b > a:
+            starts.append(int(a))
+            ends.append(int(b))
+    return starts, ends
+
+def _bin_person_seconds(starts: List[int], ends: List[int], t0: int, n_bins: int, bin_sec: int) -> List[int]:
+    """
+    Person-seconds present in each bin [t0 + k*bin_sec, ...).
+    NumPy: partial first/last bins via bincount, full bins in between via a difference array.
+    """
+    if np is not None:
+        a = np.asarray(starts, dtype=np.int64) - t0
+        b = np.asarray(ends, dtype=np.int64) - t0
+        ka = a // bin_sec
+        kb = b // bin_sec
+        same = ka == kb
+        out = np.bincount(ka[same], weights=(b - a)[same], minlength=n_bins + 1).astype(np.int64)
+        m = ~same
+        ka, kb, a, b = ka[m], kb[m], a[m], b[m]
+        out += np.bincount(ka, weights=(ka + 1) * bin_sec - a, minlength=n_bins + 1).astype(np.int64)
+        out += np.bincount(kb, weights=b - kb * bin_sec, minlength=n_bins + 1).astype(np.int64)
+        diff = np.bincount(ka + 1, minlength=n_bins + 2)[: n_bins + 1] - np.bincount(kb, minlength=n_bins + 1)
+        out += np.cumsum(diff) * bin_sec
+        return [int(x) for x in out[:n_bins]]
+
+    out_py = [0] * (n_bins + 1)
+    for a, b in zip(starts, ends):
+        a -= t0
+        b -= t0
+        k = a // bin_sec
+        while a < b:
+            e = min(b, (k + 1) * bin_sec)
+            out_py[k] += e - a
+            a = e
+            k += 1
+    return out_py[:n_bins]
+
+def _daily_peaks(starts: List[int], ends: List[int], t0: int, n_days: int) -> List[int]:
+    """
+    Peak simultaneous occupancy per day (sweep over sorted +1/-1 events).
+    A day-start marker carries the level over midnight; at equal times exits sort before entries.
+    """
+    marks = [t0 + i * 86400 for i in range(n_days)]
+    if np is not None:
+        times = np.concatenate([np.asarray(ends, dtype=np.int64), np.asarray(marks, dtype=np.int64), np.asarray(starts, dtype=np.int64)])
+        delta = np.concatenate([np.full(len(ends), -1), np.zeros(len(marks), dtype=np.int64), np.ones(len(starts), dtype=np.int64)])
+        prio = np.concatenate([np.zeros(len(ends), dtype=np.int64), np.ones(len(marks), dtype=np.int64), np.full(len(starts), 2)])
+        order = np.lexsort((prio, times))
+        level = np.cumsum(delta[order])
+        day = (times[order] - t0) // 86400
+        keep = (day >= 0) & (day < n_days)
+        peaks = np.zeros(n_days, dtype=np.int64)
+        np.maximum.at(peaks, day[keep], level[keep])
+        return [int(x) for x in peaks]
+
+    events = [(t, 0, -1) for t in ends] + [(t, 1, 0) for t in marks] + [(t, 2, 1) for t in starts]
+    events.sort()
+    peaks_py = [0] * n_days
+    level_py = 0
+    for t, _, d in events:
+        level_py += d
+        i = (t - t0) // 86400
+        if 0 <= i < n_days and level_py > peaks_py[i]:
+            peaks_py[i] = level_py
+    return peaks_py
+
+def _occupancy_chunk(conn: sqlite3.Connection, d0: date, n_days: int, bin_min: int) -> Dict[str, Any]:
+    """Aggregate days [d0, d0+n_days): person-seconds per (weekday, bin), day counts, daily peaks."""
+    bin_sec = bin_min * 60
+    per_day = 86400 // bin_sec
+    t0 = int(_day_start(d0).timestamp())
+    t1 = t0 + n_days * 86400
+    starts, ends = _session_epochs(conn, t0, t1, int(now_jst().timestamp()))
+    flat = _bin_person_seconds(starts, ends, t0, n_days * per_day, bin_sec)
+    peaks = _daily_peaks(starts, ends, t0, n_days)
+
+    person_sec = [[0] * per_day for _ in range(7)]
+    days = [0] * 7
+    peak_rows = []
+    for i in range(n_days):
+        d = d0 + timedelta(days=i)
+        wd = d.weekday()
+        days[wd] += 1
+        row = person_sec[wd]
+        for k, v in enumerate(flat[i * per_day:(i + 1) * per_day]):
+            row[k] += v
+        peak_rows.append([d.isoformat(), peaks[i]])
+    return {"person_sec": person_sec, "days": days, "peaks": peak_rows}
+
+def _week_is_closed(conn: sqlite3.Connection, week_start: date) -> bool:
+    """
+    A week is final once batch punches can no longer reach it (ended over PUNCH_MAX_AGE_HOURS ago)
+    and no open session started before its end: the same rule as the period snapshots.
+    """
+    return _period_closed(conn.cursor(), week_start + timedelta(days=6))
+
+def _occupancy_report(conn: sqlite3.Connection, d0: date, d1: date, bin_min: int,
+                      cache_conn: Optional[sqlite3.Connection] = None, cache_write: bool = True) -> Dict[str, Any]:
+    """
+    Heatmap + daily peaks for [d0, d1] (inclusive).
+    The range is cut into Monday-based week chunks; complete, closed weeks are read from /
+    written to occupancy_cache, only partial or still-open weeks are computed live.
+    Sessions are read from `conn` (may be the read snapshot); occupancy_cache lives on
+    `cache_conn` (default: conn). cache_write=False when `conn` may be missing recent punches.
+    """
+    per_day = 86400 // (bin_min * 60)
+    person_sec = [[0] * per_day for _ in range(7)]
+    days = [0] * 7
+    peaks: List[List[Any]] = []
+    cached = live = 0
+    cache_conn = cache_conn or conn
+    cur = cache_conn.cursor()
+
+    d = d0
+    while d <= d1:
+        week_start = d - timedelta(days=d.weekday())
+        chunk_end = min(d1, week_start + timedelta(days=6))
+        n_days = (chunk_end - d).days + 1
+        chunk = None
+        full_week = n_days == 7
+        if full_week:
+            cur.execute("SELECT payload FROM occupancy_cache WHERE week_start = ? AND bin_min = ?", (week_start.isoformat(), bin_min))
+            row = cur.fetchone()
+            if row:
+                chunk = json.loads(row["payload"])
+                cached += 1
+        if chunk is None:
+            chunk = _occupancy_chunk(conn, d, n_days, bin_min)
+            live += 1
+            if cache_write and full_week and _week_is_closed(conn, week_start):
+                cur.execute("""
+                    INSERT OR REPLACE INTO occupancy_cache (week_start, bin_min, payload, created_at)
+                    VALUES (?, ?, ?, ?)
+                """, (week_start.isoformat(), bin_min, json.dumps(chunk, separators=(",", ":")), iso(now_jst())))
+                cache_conn.commit()
+        for wd in range(7):
+            days[wd] += chunk["days"][wd]
+            row_acc = person_sec[wd]
+            for k, v in enumerate(chunk["person_sec"][wd]):
+                row_acc[k] += v
+        peaks.extend(chunk["peaks"])
+        d = chunk_end + timedelta(days=1)
+
+    bin_sec = bin_min * 60
+    heatmap = [
+        [round(v / (bin_sec * days[wd]), 2) if days[wd] else 0.0 for v in person_sec[wd]]
+        for wd in range(7)
+    ]
+    return {
+        "start": d0.isoformat(),
+        "end": d1.isoformat(),
+        "bin_min": bin_min,
+        "weekdays": WEEKDAY_LABELS,
+        "heatmap": heatmap,          # [weekday][bin] = average people present
+        "peak": [{"date": p[0], "peak": int(p[1])} for p in peaks],
+        "weeks_cached": cached,
+        "weeks_computed": live,
+        "engine": "numpy" if np is not None else "python",
+    }
+
+def _occupancy_timeline(conn: sqlite3.Connection, d: date) -> Dict[str, Any]:
+    """
+    Per-minute occupancy for one JST day by a sweep over sorted check-in/out events: O(n log n).
+    minutes[k] = max people present during minute k. Today is cut off at the current minute.
+    """
+    t0 = int(_day_start(d).timestamp())
+    now_ts = int(now_jst().timestamp())
+    starts, ends = _session_epochs(conn, t0, t0 + 86400, now_ts)
+    # (time, order, delta): exits before entries at the same second; sessions from before
+    # midnight were clipped to t0, so they enter at minute 0 and carry the level over.
+    events = sorted([(t, 0, -1) for t in ends] + [(t, 1, 1) for t in starts])
+    n_min = 1440 if now_ts >= t0 + 86400 else max(0, (now_ts - t0) // 60 + 1)
+
+    minutes = [0] * n_min
+    level = 0
+    k_cur = 0
+    for t, _, delta in events:
+        k = (t - t0) // 60
+        if k >= n_min:
+            break
+        while k_cur < k:
+            k_cur += 1
+            minutes[k_cur] = level
+        level += delta
+        if level > minutes[k]:
+            minutes[k] = level
+    while k_cur + 1 < n_min:
+        k_cur += 1
+        minutes[k_cur] = level
+
+    peak = max(minutes, default=0)
+    peak_min = minutes.index(peak) if minutes and peak else None
+    return {
+        "date": d.isoformat(),
+        "minutes": minutes,
+        "peak": peak,
+        "peak_at": f"{peak_min // 60:02d}:{peak_min % 60:02d}" if peak_min is not None else None,
+    }
+
+# =========================================================
+# Goal analytics (admin): totals vs weekly_goal, distribution
+# =========================================================
+# One grouped pass over user_day_totals gives every user's closed seconds in the period;
+# open sessions add their overlap live. Distribution stats are vectorized when NumPy is
+# available. Results for closed periods (ending before today) are cached in memory and
+# stay valid until the change log reports a punch touching a day inside the period.
+ANALYTICS_HIST_STEPS_H = (1, 2, 3, 5, 10, 20, 30, 50, 100)
+ANALYTICS_HIST_MAX_BINS = 12
+ANALYTICS_CACHE_SIZE = 64
+_analytics_lock = threading.Lock()
+_analytics_cache: "OrderedDict[Tuple[date, date], Tuple[int, Dict[int, int]]]" = OrderedDict()
+_analytics_stats: Dict[str, int] = {"requests": 0, "hits": 0}
+
+def _period_totals(conn: sqlite3.Connection, d0: date, d1: date) -> Dict[int, int]:
+    """user_id -> seconds studied in [d0, d1] (every user, zeros included)."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT u.id AS user_id, COALESCE(SUM(t.sec), 0) AS sec
+        FROM users u
+        LEFT JOIN user_day_totals t ON t.user_id = u.id AND t.day >= ? AND t.day <= ?
+        GROUP BY u.id
+    """, (d0.isoformat(), d1.isoformat()))
+    totals = {int(r["user_id"]): int(r["sec"]) for r in cur.fetchall()}
+    start, end = _day_start(d0), _day_start(d1) + timedelta(days=1)
+    now = now_jst()
+    for uid, ci in _open_session_starts(cur):
+        if uid in totals and ci < end:
+            totals[uid] += clamp_overlap_sec(ci, now, start, end)
+    return totals
+
+def _period_totals_cached(conn: sqlite3.Connection, version: int, d0: date, d1: date) -> Tuple[Dict[int, int], bool]:
+    """`version`: data version `conn` is known to include (cached results are validated from it)."""
+    closed = d1 < now_jst().date()
+    with _analytics_lock:
+        _analytics_stats["requests"] += 1
+        hit = _analytics_cache.get((d0, d1)) if closed else None
+    if hit is not None:
+        changes = _changes_since(hit[0])
+        if changes is not None and not any(a <= d1 and b >= d0 for _, a, b in changes):
+            with _analytics_lock:
+                _analytics_stats["hits"] += 1
+                _analytics_cache.move_to_end((d0, d1))
+            return hit[1], True
+    totals = _period_totals(conn, d0, d1)
+    if closed:
+        with _analytics_lock:
+            _analytics_cache[(d0, d1)] = (version, totals)
+            _analytics_cache.move_to_end((d0, d1))
+            while len(_analytics_cache) > ANALYTICS_CACHE_SIZE:
+                _analytics_cache.popitem(last=False)
+    return totals, False
+
+def _percentiles(values: List[int], qs: List[float]) -> List[float]:
+    """Linear-interpolated percentiles (same definition as numpy.percentile's default)."""
+    if not values:
+        return [0.0 for _ in qs]
+    if np is not None:
+        return [float(x) for x in np.percentile(np.asarray(values, dtype=np.float64), qs)]
+    xs = sorted(values)
+    out = []
+    for q in qs:
+        pos = q / 100 * (len(xs) - 1)
+        lo = int(math.floor(pos))
+        hi = min(lo + 1, len(xs) - 1)
+        out.append(xs[lo] + (xs[hi] - xs[lo]) * (pos - lo))
+    return out
+
+def _histogram(values: List[int], bin_sec: int) -> List[int]:
+    n_bins = max(1, max(values, default=0) // bin_sec + 1)
+    if np is not None:
+        return [int(x) for x in np.bincount(np.asarray(values, dtype=np.int64) // bin_sec, minlength=n_bins)]
+    counts = [0] * n_bins
+    for v in values:
+        counts[v // bin_sec] += 1
+    return counts
+
+def _goal_report(conn: sqlite3.Connection, version: int, d0: date, d1: date, bin_hours: Optional[int]) -> Dict[str, Any]:
+    totals, cached = _period_totals_cached(conn, version, d0, d1)
+    days = (d1 - d0).days + 1
+    cur = conn.cursor()
+    cur.execute("SELECT id, student_no, nickname, weekly_goal FROM users ORDER BY id")
+    users = []
+    for r in cur.fetchall():
+        uid = int(r["id"])
+        goal_min = r["weekly_goal"] if r["weekly_goal"] is not None else 300
+        goal_sec = int(goal_min * 60 * days / 7)  # weekly goal prorated to the period
+        sec = totals.get(uid, 0)
+        users.append({
+            "user_id": uid,
+            "student_no": r["student_no"],
+            "nickname": r["nickname"],
+            "total_sec": sec,
+            "goal_sec": goal_sec,
+            "rate": round(sec / goal_sec, 3) if goal_sec > 0 else None,
+            "achieved": goal_sec > 0 and sec >= goal_sec,
+        })
+    users.sort(key=lambda u: (u["rate"] is None, -(u["rate"] or 0), -u["total_sec"]))
+
+    secs = [u["total_sec"] for u in users]
+    p25, p50, p75, p90 = _percentiles(secs, [25, 50, 75, 90])
+    if bin_hours is None:
+        top = max(secs, default=0)
+        bin_hours = next((h for h in ANALYTICS_HIST_STEPS_H if top // (h * 3600) + 1 <= ANALYTICS_HIST_MAX_BINS),
+                         ANALYTICS_HIST_STEPS_H[-1])
+    counts = _histogram(secs, bin_hours * 3600)
+    n = len(users)
+    achieved = sum(1 for u in users if u["achieved"])
+    return {
+        "start": d0.isoformat(),
+        "end": d1.isoformat(),
+        "days": days,
+        "closed": d1 < now_jst().date(),
+        "cached": cached,
+        "summary": {
+            "users": n,
+            "achieved": achieved,
+            "attainment_rate": round(achieved / n, 3) if n else 0.0,
+            "active_users": sum(1 for v in secs if v > 0),
+            "mean_sec": round(sum(secs) / n) if n else 0,
+            "median_sec": round(p50),
+            "p25_sec": round(p25),
+            "p75_sec": round(p75),
+            "p90_sec": round(p90),
+            "max_sec": max(secs, default=0),
+        },
+        "histogram": {
+            "bin_hours": bin_hours,
+            "edges_hours": [i * bin_hours for i in range(len(counts) + 1)],
+            "counts": counts,
+        },
+        "users": users,
+    }
+
+def _analytics_metrics() -> Dict[str, int]:
+    with _analytics_lock:
+        return dict(_analytics_stats, cached_periods=len(_analytics_cache))
+
+# =========================================================
+# Columnar session store (NumPy)
+# =========================================================
+# Every session (archive included) as int64 columns: session id, user index, check-in and
+# check-out in epoch microseconds (-1 while open). Loaded once, then kept in step with the
+# punch event log: each read first applies the events after the last seq it has seen
+# (a check-in appends a row, a check-out fills its end), so punches cost nothing here.
+# Range totals are np.clip overlaps + np.bincount per user; day bins split intervals by
+# day offset. Microsecond integers truncated per interval/bin give exactly the same
+# seconds as clamp_overlap_sec, so results equal the row-by-row path.
+# A (re)load reads every session, so it runs in a background thread and is swapped in when
+# done; until then aggregates take the streaming path. Each read syncs the store from the
+# caller's own connection (often the read snapshot); the store only moves forward, so it
+# can be a little newer than that view, and users it knows but the view does not yet are
+# named from the DB file instead of being dropped.
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_US = 1_000_000
+_DAY_US = 86400 * _US
+
+def _epoch_us(dt: datetime) -> int:
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+class _SessionColumns:
+    def __init__(self) -> None:
+        self.n = 0
+        self.seq = 0
+        self.sid = np.empty(0, dtype=np.int64)
+        self.uidx = np.empty(0, dtype=np.int64)
+        self.start = np.empty(0, dtype=np.int64)
+        self.end = np.empty(0, dtype=np.int64)
+        self.user_ids: List[int] = []
+        self.user_index: Dict[int, int] = {}
+        self.load_ms = 0.0
+        self.queries = 0
+
+    def _reserve(self, extra: int) -> None:
+        need = self.n + extra
+        if need <= len(self.sid):
+            return
+        cap = max(1024, need, 2 * len(self.sid))
+        for name in ("sid", "uidx", "start", "end"):
+            grown = np.empty(cap, dtype=np.int64)
+            grown[:self.n] = getattr(self, name)[:self.n]
+            setattr(self, name, grown)
+
+    def _user(self, uid: int) -> int:
+        k = self.user_index.get(uid)
+        if k is None:
+            k = self.user_index[uid] = len(self.user_ids)
+            self.user_ids.append(uid)
+        return k
+
+    def _append(self, rows: List[Tuple[int, int, str, Optional[str]]]) -> None:
+        self._reserve(len(rows))
+        n, m = self.n, len(rows)
+        self.sid[n:n + m] = [int(r[0]) for r in rows]
+        self.uidx[n:n + m] = [self._user(int(r[1])) for r in rows]
+        self.start[n:n + m] = [_epoch_us(parse_iso(r[2])) for r in rows]
+        self.end[n:n + m] = [_epoch_us(parse_iso(r[3])) if r[3] else -1 for r in rows]
+        self.n += m
+
+    def load(self, cur: sqlite3.Cursor) -> None:
+        t0 = pytime.perf_counter()
+        cur.execute("BEGIN")  # sessions and the event seq from one read snapshot
+        try:
+            cur.execute("SELECT COALESCE(MAX(seq), 0) FROM punch_events")
+            self.seq = int(cur.fetchone()[0])
+            has_archive = "sessions_archive" in _table_names(cur)
+            cur.execute(
+                "SELECT id, user_id, checkin_at, checkout_at FROM sessions"
+                + (" UNION ALL SELECT id, user_id, checkin_at, checkout_at FROM sessions_archive" if has_archive else "")
+                + " ORDER BY id"
+            )
+            while True:
+                rows = cur.fetchmany(10000)
+                if not rows:
+                    break
+                self._append([tuple(r) for r in rows])
+        finally:
+            cur.execute("COMMIT")
+        self.load_ms = round((pytime.perf_counter() - t0) * 1000, 1)
+
+    def sync(self, cur: sqlite3.Cursor) -> None:
+        cur.execute("SELECT seq, kind, user_id, session_id, at FROM punch_events WHERE seq > ? ORDER BY seq", (self.seq,))
+        for seq, kind, uid, sid, at in cur.fetchall():
+            self.seq = int(seq)
+            if kind == "in":
+                if self.n == 0 or int(sid) > int(self.sid[self.n - 1]):
+                    self._append([(int(sid), int(uid), at, None)])
+                continue
+            pos = int(np.searchsorted(self.sid[:self.n], int(sid)))  # ids only grow, so sid stays sorted
+            if pos < self.n and int(self.sid[pos]) == int(sid):
+                self.end[pos] = _epoch_us(parse_iso(at))
+
+    def _window(self, start: datetime, end: datetime) -> Tuple[Any, Any, Any]:
+        """Sessions overlapping [start, end) like _fetch_sessions_overlapping: (user idx, start us, end us)."""
+        s, e = self.start[:self.n], self.end[:self.n]
+        is_open = e < 0
+        start_us, end_us = _epoch_us(start), _epoch_us(end)
+        hit = (s < end_us) & (is_open | (e > start_us))
+        e_eff = np.where(is_open[hit], _epoch_us(now_jst()), e[hit])
+        return self.uidx[:self.n][hit], s[hit], e_eff
+
+    def totals(self, start: datetime, end: datetime) -> Dict[int, int]:
+        u, s, e = self._window(start, end)
+        a, b = _epoch_us(start), _epoch_us(end)
+        sec = np.maximum(np.clip(e, a, b) - np.clip(s, a, b), 0) // _US
+        sums = np.bincount(u, weights=sec, minlength=len(self.user_ids)).astype(np.int64)
+        seen = np.bincount(u, minlength=len(self.user_ids)) > 0
+        return {self.user_ids[k]: int(sums[k]) for k in np.flatnonzero(seen)}
+
+    def daily(self, start: datetime, end: datetime, day0: datetime, days: int) -> Dict[int, List[int]]:
+        u, s, e = self._window(start, end)
+        d0 = _epoch_us(day0)
+        first = np.clip((s - d0) // _DAY_US, 0, days - 1)
+        last = np.clip((e - 1 - d0) // _DAY_US, 0, days - 1)
+        span = last - first
+        grid = np.zeros(len(self.user_ids) * days, dtype=np.int64)
+        for k in range(int(span.max()) + 1 if len(span) else 0):
+            sel = span >= k
+            day = first[sel] + k
+            ds = d0 + day * _DAY_US
+            sec = np.maximum(np.minimum(e[sel], ds + _DAY_US) - np.maximum(s[sel], ds), 0) // _US
+            grid += np.bincount(u[sel] * days + day, weights=sec, minlength=len(grid)).astype(np.int64)
+        grid = grid.reshape(len(self.user_ids), days)
+        seen = np.bincount(u, minlength=len(self.user_ids)) > 0
+        return {self.user_ids[k]: grid[k].tolist() for k in np.flatnonzero(seen)}
+
+_columns: Optional[_SessionColumns] = None
+_columns_lock = threading.Lock()
+_columns_gen = 0         # bumped when the store is dropped: a load started before is discarded
+_columns_loading = False
+
+def _columns_enabled() -> bool:
+    return COLUMNAR and np is not None
+
+def _columns_load(gen: int) -> None:
+    global _columns, _columns_loading
+    store: Optional[_SessionColumns] = _SessionColumns()
+    conn = db_connect()
+    try:
+        store.load(conn.cursor())
+    except sqlite3.Error:
+        store = None  # busy: the next aggregate starts another load
+    finally:
+        conn.close()
+    with _columns_lock:
+        _columns_loading = False
+        if store is not None and gen == _columns_gen:
+            _columns = store
+
+def _columns_drop() -> None:
+    """Forget the store after a bulk rewrite; the next aggregate reloads it in the background."""
+    global _columns, _columns_gen
+    with _columns_lock:
+        _columns = None
+        _columns_gen += 1
+
+@contextmanager
+def _columns_synced(conn: sqlite3.Connection):
+    """The store caught up with conn's view (held under its lock), or None while it is being loaded."""
+    global _columns_loading
+    with _columns_lock:
+        if _columns is None:
+            if not _columns_loading:
+                _columns_loading = True
+                threading.Thread(target=_columns_load, args=(_columns_gen,), daemon=True).start()
+            yield None
+            return
+        _columns.sync(conn.cursor())
+        _columns.queries += 1
+        yield _columns
+
+def _columns_nicknames(conn: sqlite3.Connection, user_ids: Iterable[int]) -> Dict[int, str]:
+    """Nicknames from conn, plus the DB file for users newer than conn's view."""
+    nick = _nicknames(conn)
+    missing = [uid for uid in user_ids if uid not in nick]
+    if missing:
+        live = db_connect()
+        try:
+            for i in range(0, len(missing), 500):
+                part = missing[i:i + 500]
+                cur = live.execute(f"SELECT id, nickname FROM users WHERE id IN ({','.join('?' * len(part))})", part)
+                nick.update((int(r[0]), r[1]) for r in cur.fetchall())
+        finally:
+            live.close()
+    return nick
+
+def _columns_totals(conn: sqlite3.Connection, start: datetime, end: datetime) -> Optional[Dict[int, Dict[str, Any]]]:
+    with _columns_synced(conn) as store:
+        if store is None:
+            return None
+        totals = store.totals(start, end)
+    nick = _columns_nicknames(conn, totals)
+    return {uid: {"nickname": nick[uid], "total_sec": sec} for uid, sec in totals.items() if uid in nick}
+
+def _columns_daily(conn: sqlite3.Connection, start: datetime, end: datetime, labels: List[str],
+                   day_starts: List[datetime]) -> Optional[Tuple[List[str], Dict[int, List[int]], Dict[int, str]]]:
+    if not day_starts:
+        return labels, {}, {}
+    with _columns_synced(conn) as store:
+        if store is None:
+            return None
+        series = store.daily(start, end, day_starts[0], len(day_starts))
+    nick = _columns_nicknames(conn, series)
+    series = {uid: secs for uid, secs in series.items() if uid in nick}
+    return labels, series, {uid: nick[uid] for uid in series}
+
+def _columns_metrics() -> Dict[str, Any]:
+    with _columns_lock:
+        if _columns is None:
+            return {"enabled": _columns_enabled(), "loaded": False, "loading": _columns_loading}
+        return {
+            "enabled": _columns_enabled(),
+            "loaded": True,
+            "sessions": _columns.n,
+            "users": len(_columns.user_ids),
+            "bytes": _columns.n * 4 * 8,
+            "load_ms": _columns.load_ms,
+            "event_seq": _columns.seq,
+            "queries": _columns.queries,
+        }
+
 # =========================================================
 # Routes: Pages
 # =========================================================
@@ -513,8 +2607,8 @@ def kiosk_legacy():
 # Routes: Auth
 # =========================================================
 @app.post("/api/login")
-def login(req: LoginReq, response: Response):
-    user = _verify_user(req.student_no, req.pin)
+def login(req: LoginReq, request: Request, response: Response):
+    user = _verify_user_limited(request, req.student_no, req.pin)
     set_session_cookie(response, {"type": "user", "user_id": int(user["id"])})
     return {"ok": True}
 
@@ -560,105 +2654,1101 @@ def admin_login(req: AdminLoginReq, response: Response):
 # =========================================================
 
 @app.post("/api/checkin")
-def checkin(req: CheckReq):
+def checkin(req: CheckReq, request: Request):
     try:
-        user = _verify_user(req.student_no, req.pin)
+        user = _verify_user_limited(request, req.student_no, req.pin)
     except HTTPException as e:
         if e.status_code == 401:
             # 未登録またはPIN違い
             raise HTTPException(status_code=401, detail="未登録の学籍番号です。個人ページで初回登録を行ってください。\n→ /signup")
         raise
-    conn = db_connect()
-    cur = conn.cursor()
-
-    open_sess = _open_session(conn, int(user["id"]))
-    if open_sess:
-        conn.close()
+    opened = _punch(int(user["id"]), "in")
+    if opened is None:
         raise HTTPException(status_code=409, detail="すでに入室中です（退室してから再入室してください）")
-
-    t = now_jst()
-    cur.execute("""
-        INSERT INTO sessions (user_id, checkin_at, checkout_at, duration_sec)
-        VALUES (?, ?, NULL, NULL)
-    """, (int(user["id"]), iso(t)))
-    conn.commit()
-    conn.close()
+    t = opened[1]
+    _after_punch(1, [(int(user["id"]), t, t)])
     return {"ok": True, "message": f"{user['nickname']} 入室: {t.strftime('%H:%M:%S')}"}
 
 
 @app.post("/api/checkout")
-def checkout(req: CheckReq):
+def checkout(req: CheckReq, request: Request):
     try:
-        user = _verify_user(req.student_no, req.pin)
+        user = _verify_user_limited(request, req.student_no, req.pin)
     except HTTPException as e:
         if e.status_code == 401:
             raise HTTPException(status_code=401, detail="未登録の学籍番号です。個人ページで初回登録を行ってください。\n→ /signup")
         raise
-    conn = db_connect()
-    cur = conn.cursor()
-
-    open_sess = _open_session(conn, int(user["id"]))
-    if not open_sess:
-        conn.close()
+    closed = _punch(int(user["id"]), "out")
+    if closed is None:
         raise HTTPException(status_code=409, detail="入室記録が見つかりません（先に入室してください）")
-
-    t = now_jst()
-    checkin_at = parse_iso(open_sess["checkin_at"])
-    dur = max(0, int((t - checkin_at).total_seconds()))
-
-    cur.execute("""
-        UPDATE sessions
-        SET checkout_at = ?, duration_sec = ?
-        WHERE id = ?
-    """, (iso(t), int(dur), int(open_sess["id"])))
-    conn.commit()
-    conn.close()
+    ci, t, dur = closed
+    _after_punch(-1, [(int(user["id"]), ci, t)])
     return {"ok": True, "message": f"{user['nickname']} 退室: {t.strftime('%H:%M:%S')} / {dur//60}分"}
 
-# =========================================================
-# Routes: Leaderboard
-# =========================================================
-@app.get("/api/leaderboard")
-def leaderboard(range: RangeName = "today", top: int = 20):
-    if top < 1: top = 1
-    if top > 100: top = 100
-
-    start, end = _range_start_end(range)
+# 入退室状態確認API
+@app.post("/api/status")
+def status_check(request: Request, data: dict = Body(...)):
+    student_no = data.get("student_no", "").strip()
+    pin = data.get("pin", "").strip()
+    try:
+        user = _verify_user_limited(request, student_no, pin)
+    except HTTPException as e:
+        if e.status_code == 429:
+            raise
+        return {"status": "unknown"}
+    conn = db_connect()
+    open_sess = _open_session(conn, int(user["id"]))
+    conn.close()
+    if open_sess:
+        return {"status": "in"}
+    else:
+        return {"status": "out"}
+
+# =========================================================
+# Badge punches (QR / NFC cards)
+# =========================================================
+# Admins issue a badge token per user: badge_serializer.dumps([user_id, badge_version]),
+# HMAC-signed with SECRET_KEY. A kiosk punch with it costs one signature check and one
+# primary-key lookup instead of a bcrypt verify. Issuing a new badge or revoking bumps
+# users.badge_version, so every older token of that user stops working at once.
+_badge_lock = threading.Lock()
+_badge_stats: Dict[str, float] = {"punches": 0, "rejected": 0, "verify_sec": 0.0}
+
+def _badge_token(user_id: int, version: int) -> str:
+    return badge_serializer.dumps([user_id, version])
+
+def _badge_qr_svg(token: str) -> Optional[str]:
+    """Inline SVG QR code for printing, or None without the optional segno package."""
+    if segno is None:
+        return None
+    return segno.make(token, error="m", micro=False).svg_inline(scale=5, border=2)
+
+def _verify_badge(token: str) -> sqlite3.Row:
+    t0 = pytime.perf_counter()
+    try:
+        user_id, version = badge_serializer.loads(token.strip())
+        user_id, version = int(user_id), int(version)
+    except (BadSignature, ValueError, TypeError):
+        user = None
+    else:
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT id, nickname, badge_version FROM users WHERE id = ?", (user_id,))
+            user = cur.fetchone()
+        finally:
+            conn.close()
+        if user is not None and int(user["badge_version"]) != version:
+            user = None  # revoked or re-issued
+    with _badge_lock:
+        _badge_stats["verify_sec"] += pytime.perf_counter() - t0
+        _badge_stats["punches" if user is not None else "rejected"] += 1
+    if user is None:
+        raise HTTPException(status_code=401, detail="このバッジは使えません（再発行されたか無効です）。管理者に確認してください")
+    return user
+
+def _badge_punch(user_id: int, action: str) -> Optional[Tuple[str, datetime, datetime, int]]:
+    """
+    _punch for badges, plus "toggle" (out if checked in, else in) in the same write transaction.
+    A toggle within BADGE_DEBOUNCE_SEC of the check-in is ignored: the card was read twice.
+    Returns (applied action, checkin time, punch time, duration sec), or None on conflict.
+    """
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        t = now_jst()
+        if action == "toggle":
+            cur.execute("SELECT checkin_at FROM sessions WHERE user_id = ? AND checkout_at IS NULL", (user_id,))
+            r = cur.fetchone()
+            if r is not None and (t - parse_iso(r[0])).total_seconds() < BADGE_DEBOUNCE_SEC:
+                conn.rollback()
+                return None
+            action = "out" if r is not None else "in"
+        if action == "in":
+            res = ("in", t, t, 0) if _checkin_open(cur, user_id, t, "badge") is not None else None
+        else:
+            closed = _checkout_open(cur, user_id, t, "badge")
+            res = ("out", closed[0], t, closed[1]) if closed else None
+        conn.commit()
+        return res
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def _badge_metrics() -> Dict[str, Any]:
+    with _badge_lock:
+        n = int(_badge_stats["punches"] + _badge_stats["rejected"])
+        return {
+            "punches": int(_badge_stats["punches"]),
+            "rejected": int(_badge_stats["rejected"]),
+            "verify_avg_ms": round(_badge_stats["verify_sec"] * 1000 / n, 3) if n else None,
+            "qr": segno is not None,
+        }
+
+# バッジで入退室（action 省略時は入室中なら退室、それ以外は入室）
+@app.post("/api/badge/punch")
+def badge_punch(req: BadgePunchReq, request: Request):
+    wait = _rl_take([_rl_ip_key(request)])
+    if wait:
+        _raise_rate_limited(wait)
+    user = _verify_badge(req.token)
+    uid = int(user["id"])
+    res = _badge_punch(uid, req.action)
+    if res is None:
+        detail = {
+            "in": "すでに入室中です（退室してから再入室してください）",
+            "out": "入室記録が見つかりません（先に入室してください）",
+            "toggle": f"{user['nickname']} は入室したばかりです（{BADGE_DEBOUNCE_SEC}秒以内の読み取りは無視します）",
+        }[req.action]
+        raise HTTPException(status_code=409, detail=detail)
+    action, ci, t, dur = res
+    if action == "in":
+        _after_punch(1, [(uid, t, t)])
+        return {"ok": True, "action": "in", "message": f"{user['nickname']} 入室: {t.strftime('%H:%M:%S')}"}
+    _after_punch(-1, [(uid, ci, t)])
+    return {"ok": True, "action": "out", "message": f"{user['nickname']} 退室: {t.strftime('%H:%M:%S')} / {dur//60}分"}
+
+# =========================================================
+# Batch punches (offline-capable kiosks)
+# =========================================================
+# A kiosk that cannot reach the server queues punches locally as {key, student_no, pin,
+# action, at} and uploads the backlog here in one request:
+# - key is an idempotency key: a replayed key returns the stored result and changes nothing
+# - at is the kiosk clock, shifted by (server now - sent_at) to cancel kiosk clock skew
+# - PINs are checked once per distinct (student_no, pin), before the write lock is taken
+# - everything is applied in one transaction, per user in `at` order
+PUNCH_FUTURE_SLACK = timedelta(minutes=2)
+_punch_lock = threading.Lock()
+_punch_stats: Dict[str, int] = {
+    "batches": 0, "punches": 0, "applied": 0, "duplicates": 0, "conflicts": 0, "rejected": 0, "deferred": 0,
+}
+
+def _parse_client_time(s: str) -> Optional[datetime]:
+    try:
+        dt = datetime.fromisoformat(s.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return dt.replace(tzinfo=JST) if dt.tzinfo is None else dt.astimezone(JST)
+
+def _punch_receipts(cur: sqlite3.Cursor, keys: List[str]) -> Dict[str, Tuple[str, str]]:
+    if not keys:
+        return {}
+    cur.execute(
+        f"SELECT key, status, message FROM punch_receipts WHERE key IN ({','.join('?' * len(keys))})",
+        keys,
+    )
+    return {r["key"]: (r["status"], r["message"]) for r in cur.fetchall()}
+
+def _punch_item_ok(p: PunchItem) -> bool:
+    """Same shape as CheckReq (student_no 1-64, PIN 4-32 characters)."""
+    return 1 <= len(p.student_no) <= 64 and 4 <= len(p.pin) <= 32
+
+def _punch_metrics() -> Dict[str, int]:
+    with _punch_lock:
+        return dict(_punch_stats)
+
+@app.post("/api/punch/batch")
+def punch_batch(req: PunchBatchReq, request: Request):
+    """
+    Apply queued kiosk punches. Every punch gets a result in input order:
+    applied / conflict / rejected are final (stored under the key); retry means "send again later".
+    """
+    wait = _rl_take([_rl_ip_key(request)])
+    if wait:
+        _raise_rate_limited(wait)
+
+    now = now_jst()
+    skew = timedelta(0)
+    if req.sent_at:
+        sent = _parse_client_time(req.sent_at)
+        if sent is None:
+            raise HTTPException(status_code=400, detail="sent_at の形式が不正です")
+        skew = now - sent
+
+    punches = req.punches
+    results: Dict[int, Dict[str, Any]] = {}
+    first_of: Dict[str, int] = {}
+    for i, p in enumerate(punches):
+        first_of.setdefault(p.key, i)
+
+    conn = db_connect()
+    try:
+        stored = _punch_receipts(conn.cursor(), list(first_of))
+    finally:
+        conn.close()
+
+    # credentials: one bcrypt per distinct (student_no, pin); replays never reach bcrypt
+    users: Dict[Tuple[str, str], Optional[sqlite3.Row]] = {}
+    deferred: Dict[str, float] = {}
+    ip_key = _rl_ip_key(request)[0]
+    for key, i in first_of.items():
+        p = punches[i]
+        cred = (p.student_no, p.pin)
+        if key in stored or cred in users or p.student_no in deferred:
+            continue
+        if not _punch_item_ok(p):
+            users[cred] = None  # malformed: rejected without bcrypt and without counting as a failed PIN
+            continue
+        wait = _rl_take([_rl_student_key(p.student_no)], blocked_by=(ip_key,))
+        if wait:
+            deferred[p.student_no] = wait
+            continue
+        try:
+            users[cred] = _verify_user(p.student_no, p.pin)
+            _rl_record(request, p.student_no, True)
+        except HTTPException:
+            users[cred] = None
+            _rl_record(request, p.student_no, False)
+
+    accepted: Dict[int, List[Tuple[datetime, int, sqlite3.Row]]] = {}  # user_id -> [(at, index, user)]
+    for key, i in first_of.items():
+        p = punches[i]
+        if key in stored:
+            continue
+        if p.student_no in deferred and (p.student_no, p.pin) not in users:
+            results[i] = {"key": key, "status": "retry", "message": "混雑のため後で再送します", "retry": True}
+            continue
+        user = users[(p.student_no, p.pin)]
+        if user is None:
+            msg = "学籍番号またはPINが違います" if _punch_item_ok(p) else "学籍番号またはPINの形式が不正です"
+            results[i] = {"key": key, "status": "rejected", "message": msg}
+            continue
+        at = _parse_client_time(p.at)
+        if at is None:
+            results[i] = {"key": key, "status": "rejected", "message": "打刻時刻の形式が不正です"}
+            continue
+        at += skew
+        if at > now + PUNCH_FUTURE_SLACK:
+            results[i] = {"key": key, "status": "rejected", "message": "打刻時刻が未来です"}
+            continue
+        at = min(at, now)
+        if at < now - timedelta(hours=PUNCH_MAX_AGE_HOURS):
+            results[i] = {"key": key, "status": "rejected", "message": f"{PUNCH_MAX_AGE_HOURS}時間より前の打刻は受け付けません"}
+            continue
+        accepted.setdefault(int(user["id"]), []).append((at, i, user))
+
+    touched: List[Tuple[int, datetime, datetime]] = []
+    delta = 0
     conn = db_connect()
-    totals = _compute_totals_in_range(conn, start, end)
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        # a concurrent upload of the same backlog may have committed since the first lookup
+        raced = _punch_receipts(cur, [punches[i].key for items in accepted.values() for _, i, _ in items])
+        stored.update(raced)
+        for uid, items in accepted.items():
+            items.sort(key=lambda x: (x[0], x[1]))
+            open_sess = _open_session(conn, uid)
+            cur.execute("SELECT MAX(checkin_at) AS ci, MAX(checkout_at) AS co FROM sessions WHERE user_id = ?", (uid,))
+            r = cur.fetchone()
+            last = max((parse_iso(v) for v in (r["ci"], r["co"]) if v), default=None)
+            for at, i, user in items:
+                p = punches[i]
+                if p.key in raced:
+                    continue
+                res: Dict[str, Any] = {"key": p.key, "status": "conflict"}
+                if last is not None and at < last:
+                    res["message"] = "これより後の打刻が既に記録されています"
+                elif p.action == "in":
+                    sid = None if open_sess else _checkin_open(cur, uid, at, "batch")
+                    if sid is None:
+                        res["message"] = "すでに入室中です"
+                    else:
+                        open_sess = {"id": sid, "user_id": uid, "checkin_at": iso(at)}
+                        last = at
+                        delta += 1
+                        touched.append((uid, at, at))
+                        res = {"key": p.key, "status": "applied", "message": f"{user['nickname']} 入室: {at.strftime('%H:%M:%S')}"}
+                else:
+                    if not open_sess:
+                        res["message"] = "入室記録が見つかりません"
+                    else:
+                        dur = _close_session(cur, open_sess, at, "batch")
+                        touched.append((uid, parse_iso(open_sess["checkin_at"]), at))
+                        open_sess = None
+                        last = at
+                        delta -= 1
+                        res = {"key": p.key, "status": "applied", "message": f"{user['nickname']} 退室: {at.strftime('%H:%M:%S')} / {dur//60}分"}
+                results[i] = res
+
+        received = iso(now)
+        receipts = []
+        for i, res in results.items():
+            if res["status"] == "retry":
+                continue
+            p = punches[i]
+            user = users.get((p.student_no, p.pin))
+            receipts.append((p.key, int(user["id"]) if user else None, p.action, p.at, res["status"], res["message"], received))
+        cur.executemany("""
+            INSERT OR IGNORE INTO punch_receipts (key, user_id, action, at, status, message, received_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, receipts)
+        # keep receipts well past the acceptance window so an old replay can never apply twice
+        keep = max(timedelta(days=PUNCH_RECEIPT_DAYS), timedelta(hours=2 * PUNCH_MAX_AGE_HOURS))
+        cur.execute("DELETE FROM punch_receipts WHERE received_at < ?", (iso(now - keep),))
+        # back-dated punches may land in a week whose heatmap is already cached as final
+        cur.executemany("DELETE FROM occupancy_cache WHERE week_start BETWEEN ? AND ?", [
+            ((t0.date() - timedelta(days=t0.weekday())).isoformat(), (t1.date() - timedelta(days=t1.weekday())).isoformat())
+            for _, t0, t1 in touched
+        ])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    _after_punch(delta, touched)
+
+    out = []
+    for i, p in enumerate(punches):
+        if i in results and first_of[p.key] == i:
+            out.append(results[i])
+        else:
+            base = results.get(first_of[p.key])
+            if base is None:
+                st, msg = stored[p.key]
+                base = {"key": p.key, "status": st, "message": msg}
+            out.append({**base, "duplicate": True})
+
+    with _punch_lock:
+        _punch_stats["batches"] += 1
+        _punch_stats["punches"] += len(punches)
+        for r in out:
+            if r.get("duplicate"):
+                _punch_stats["duplicates"] += 1
+            else:
+                _punch_stats[{"applied": "applied", "conflict": "conflicts", "rejected": "rejected", "retry": "deferred"}[r["status"]]] += 1
+    body: Dict[str, Any] = {"ok": True, "applied": sum(1 for r in out if r["status"] == "applied" and not r.get("duplicate")),
+                            "results": out, "max_age_hours": PUNCH_MAX_AGE_HOURS}  # the kiosk purges older queued punches
+    if deferred:
+        body["retry_after"] = math.ceil(max(deferred.values()))
+    return body
+
+# =========================================================
+# Group leaderboards (class vs class, grade vs grade)
+# =========================================================
+# One pass over per-user closed totals (a single GROUP BY on user_day_totals, or
+# users.lifetime_sec for "all") folded into every group at once, cached per
+# (data version, group version, range). Open sessions are added when the board is read,
+# touching only the groups of users currently checked in.
+GROUP_CACHE_SIZE = 32
+_group_lock = threading.Lock()
+_group_version = 0  # bumped by the admin group APIs
+_group_cache: "OrderedDict[Tuple[Any, ...], Dict[str, Any]]" = OrderedDict()
+
+def _bump_group_version() -> None:
+    global _group_version
+    with _group_lock:
+        _group_version += 1
+        _group_cache.clear()
+
+def _group_closed(conn: sqlite3.Connection, d0: Optional[date], d1: Optional[date]) -> Dict[str, Any]:
+    """Closed-session aggregate per group; d0 None = all time."""
+    cur = conn.cursor()
+    if d0 is None:
+        cur.execute("SELECT id, lifetime_sec FROM users WHERE lifetime_sec > 0")
+    else:
+        cur.execute("""
+            SELECT user_id, SUM(sec) FROM user_day_totals
+            WHERE day >= ? AND day <= ?
+            GROUP BY user_id HAVING SUM(sec) > 0
+        """, (d0.isoformat(), d1.isoformat()))
+    closed = {int(uid): int(sec) for uid, sec in cur.fetchall()}
+    cur.execute("""
+        SELECT g.id, g.name, g.kind, m.user_id
+        FROM groups g LEFT JOIN user_groups m ON m.group_id = g.id
+        ORDER BY g.id
+    """)
+    groups: Dict[int, Dict[str, Any]] = {}
+    user_groups: Dict[int, List[int]] = {}
+    for gid, name, kind, uid in cur.fetchall():
+        g = groups.get(gid)
+        if g is None:
+            g = groups[gid] = {"group_id": int(gid), "name": name, "kind": kind,
+                               "members": 0, "active": 0, "total_sec": 0}
+        if uid is None:
+            continue
+        sec = closed.get(int(uid), 0)
+        g["members"] += 1
+        g["total_sec"] += sec
+        g["active"] += sec > 0
+        user_groups.setdefault(int(uid), []).append(int(gid))
+    return {"groups": groups, "user_groups": user_groups, "closed": closed}
+
+def _group_board(conn: sqlite3.Connection, version: int, d0: Optional[date], d1: Optional[date]) -> List[Dict[str, Any]]:
+    """Per-group totals incl. live time; `version`: data version `conn` is known to include."""
+    key = (version, _group_version, d0, d1)
+    with _group_lock:
+        base = _group_cache.get(key)
+        if base is not None:
+            _group_cache.move_to_end(key)
+    if base is None:
+        base = _group_closed(conn, d0, d1)
+        with _group_lock:
+            if key[1] == _group_version:
+                _group_cache[key] = base
+                while len(_group_cache) > GROUP_CACHE_SIZE:
+                    _group_cache.popitem(last=False)
+    groups = {gid: dict(g) for gid, g in base["groups"].items()}
+    now = now_jst()
+    start = _day_start(d0) if d0 else datetime(2000, 1, 1, tzinfo=JST)
+    end = _day_start(d1) + timedelta(days=1) if d1 else now
+    for uid, ci in _open_session_starts(conn.cursor()):
+        live = clamp_overlap_sec(ci, now, start, end)
+        if live <= 0:
+            continue
+        for gid in base["user_groups"].get(uid, ()):
+            g = groups[gid]
+            g["total_sec"] += live
+            g["active"] += base["closed"].get(uid, 0) == 0
+    out = []
+    for g in groups.values():
+        n = g["members"]
+        g["avg_sec"] = g["total_sec"] // n if n else 0
+        g["participation"] = round(g["active"] / n, 4) if n else 0.0
+        out.append(g)
+    return out
+
+# =========================================================
+# Closed-period leaderboard snapshots
+# =========================================================
+# A day / week (Monday start) / month can no longer change once it has ended, the batch
+# punch window (PUNCH_MAX_AGE_HOURS) has passed and no session that started inside it is
+# still open. Such a period is frozen once: a header row in period_snapshots and its ranked
+# per-user totals in period_snapshot_users. History views then cost one primary-key range
+# read. Bulk rewrites (replay-events, rebuild-totals) drop the snapshots; the hourly loop and
+# the history API freeze them again.
+PERIODS = ("day", "week", "month")
+PERIOD_FREEZE_SEC = 3600
+_period_stats: Dict[str, Any] = {"frozen": 0, "runs": 0, "last_run_ms": None, "live_reads": 0, "snapshot_reads": 0}
+_period_lock = threading.Lock()
+
+def _period_bounds(period: str, d: date) -> Tuple[date, date]:
+    """(first day, last day) of the period containing d."""
+    if period == "day":
+        return d, d
+    if period == "week":
+        d0 = d - timedelta(days=d.weekday())
+        return d0, d0 + timedelta(days=6)
+    d0 = d.replace(day=1)
+    nxt = d0.replace(year=d0.year + 1, month=1) if d0.month == 12 else d0.replace(month=d0.month + 1)
+    return d0, nxt - timedelta(days=1)
+
+def _period_closed(cur: sqlite3.Cursor, d1: date) -> bool:
+    end = _day_start(d1) + timedelta(days=1)
+    if end > now_jst() - timedelta(hours=PUNCH_MAX_AGE_HOURS):
+        return False
+    cur.execute("SELECT 1 FROM sessions WHERE checkout_at IS NULL AND checkin_at < ? LIMIT 1", (iso(end),))
+    return cur.fetchone() is None
+
+def _period_ranking(conn: sqlite3.Connection, d0: date, d1: date) -> List[Tuple[int, int, int]]:
+    """[(rank, user_id, total_sec)] by total, competition ranks (ties share a rank)."""
+    totals = sorted(((int(v["total_sec"]), uid) for uid, v in _day_range_totals(conn, d0, d1).items()), reverse=True)
+    out = []
+    for i, (sec, uid) in enumerate(totals):
+        rank = out[-1][0] if out and out[-1][2] == sec else i + 1
+        out.append((rank, uid, sec))
+    return out
+
+def _freeze_period(conn: sqlite3.Connection, period: str, d0: date, d1: date) -> bool:
+    """Freeze one closed period (own write transaction). False if it is not closed yet."""
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        if not _period_closed(cur, d1):
+            conn.rollback()
+            return False
+        ranking = _period_ranking(conn, d0, d1)
+        cur.execute("""
+            INSERT OR REPLACE INTO period_snapshots (period, start_day, end_day, users, total_sec, frozen_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (period, d0.isoformat(), d1.isoformat(), len(ranking), sum(r[2] for r in ranking), iso(now_jst())))
+        cur.execute("DELETE FROM period_snapshot_users WHERE period = ? AND start_day = ?", (period, d0.isoformat()))
+        cur.executemany("INSERT INTO period_snapshot_users (period, start_day, rank, user_id, total_sec) VALUES (?, ?, ?, ?, ?)",
+                        [(period, d0.isoformat(), rank, uid, sec) for rank, uid, sec in ranking])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    with _period_lock:
+        _period_stats["frozen"] += 1
+    return True
+
+def _freeze_closed_periods() -> int:
+    """Freeze every closed period not frozen yet, oldest first. Returns how many were frozen."""
+    t0 = pytime.perf_counter()
+    conn = db_connect()
+    n = 0
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT MIN(day) FROM user_day_totals")
+        first = cur.fetchone()[0]
+        if first is None:
+            return 0
+        for period in PERIODS:
+            cur.execute("SELECT start_day FROM period_snapshots WHERE period = ?", (period,))
+            done = {r[0] for r in cur.fetchall()}
+            d0, d1 = _period_bounds(period, date.fromisoformat(first))
+            while _day_start(d1) + timedelta(days=1) <= now_jst():
+                if d0.isoformat() not in done:
+                    if not _freeze_period(conn, period, d0, d1):
+                        break  # a later period cannot be closed either
+                    n += 1
+                d0, d1 = _period_bounds(period, d1 + timedelta(days=1))
+    finally:
+        conn.close()
+    with _period_lock:
+        _period_stats["runs"] += 1
+        _period_stats["last_run_ms"] = round((pytime.perf_counter() - t0) * 1000, 1)
+    return n
+
+def _drop_period_snapshots(cur: sqlite3.Cursor) -> None:
+    """Forget every frozen period (after a bulk rewrite of sessions or totals)."""
+    cur.execute("DELETE FROM period_snapshot_users")
+    cur.execute("DELETE FROM period_snapshots")
+
+def period_freeze_loop():
+    while True:
+        try:
+            _freeze_closed_periods()
+        except sqlite3.Error:
+            pass  # DB busy / locked: next round
+        pytime.sleep(PERIOD_FREEZE_SEC)
+
+def _period_metrics() -> Dict[str, Any]:
+    with _period_lock:
+        out: Dict[str, Any] = dict(_period_stats)
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT period, COUNT(*), MAX(start_day) FROM period_snapshots GROUP BY period")
+        out["periods"] = {r[0]: {"frozen": int(r[1]), "latest": r[2]} for r in cur.fetchall()}
+    finally:
+        conn.close()
+    return out
+
+# =========================================================
+# Bulk session import (CSV / another StudyRoom DB)
+# =========================================================
+# History from paper or spreadsheets (CSV with student_no, checkin_at, checkout_at) or a
+# second room's studyroom.sqlite3 is loaded as closed sessions. Users are matched by
+# student_no; a DB import may also create the users it brings (PIN hashes included), a CSV
+# row of an unknown student is rejected. Everything is validated before the first write:
+# both times parse (no offset = JST), checkout is after checkin and not in the future, and
+# the interval overlaps none of the user's other sessions, existing or imported. An interval
+# that already exists exactly counts as a duplicate, so re-running an import is harmless.
+# Accepted rows go in IMPORT_BATCH-sized transactions (executemany), each session with its
+# in/out events (source "import"), so replaying the log reproduces them. A big load drops the
+# plain secondary indexes of those tables first and builds them once at the end; the DDL is
+# kept in import_runs so an interrupted run is repaired by the next one. The day index,
+# lifetime totals and streaks are rebuilt once at the end, and event snapshots wait until
+# then (one taken mid-import would miss the imported days).
+IMPORT_BATCH = 50000
+IMPORT_DEFER_INDEX_ROWS = 100000  # smaller loads keep the indexes
+IMPORT_TABLES = ("sessions", "punch_events")
+IMPORT_SAMPLES = 20  # rejected rows listed in the report
+IMPORT_TIME_FORMATS = ("%Y/%m/%d %H:%M:%S", "%Y/%m/%d %H:%M")  # spreadsheet style, unpadded allowed
+_import_lock = threading.Lock()
+
+def _import_time(s: str) -> datetime:
+    s = s.strip()
+    try:
+        dt = datetime.fromisoformat(s)
+    except ValueError:
+        for fmt in IMPORT_TIME_FORMATS:
+            try:
+                dt = datetime.strptime(s, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise
+    return dt if dt.tzinfo else dt.replace(tzinfo=JST)
+
+def _us_iso(us: int) -> str:
+    return iso(_EPOCH + timedelta(microseconds=us))
+
+def _csv_import_rows(lines: Iterable[str]) -> Iterator[Tuple[str, str, str, Optional[str]]]:
+    """(where, student_no, checkin_at, checkout_at) per CSV row. ValueError if a column is missing."""
+    reader = csv.DictReader(lines)
+    fields = [f.strip() for f in reader.fieldnames or []]
+    missing = [c for c in ("student_no", "checkin_at", "checkout_at") if c not in fields]
+    if missing:
+        raise ValueError(f"missing column(s): {', '.join(missing)}")
+    reader.fieldnames = fields
+    for row in reader:
+        yield f"line {reader.line_num}", (row["student_no"] or "").strip(), row["checkin_at"] or "", row["checkout_at"] or None
+
+def _db_import_source(path: str) -> Tuple[Dict[str, Tuple[str, str, str, str]], Iterator[Tuple[str, str, str, Optional[str]]]]:
+    """Users (student_no -> name, nickname, pin_hash, created_at) and session rows of another StudyRoom DB (read-only)."""
+    src = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        cur = src.cursor()
+        cur.execute("SELECT id, student_no, name, nickname, pin_hash, created_at FROM users")
+        by_id = {int(r[0]): r[1:] for r in cur.fetchall()}
+        archived = "sessions_archive" in _table_names(cur)
+    except sqlite3.Error as e:
+        src.close()
+        raise ValueError(f"not a StudyRoom database: {e}")
+    users = {r[0]: tuple(r[1:]) for r in by_id.values()}
+
+    def rows() -> Iterator[Tuple[str, str, str, Optional[str]]]:
+        try:
+            cur = src.cursor()
+            cur.execute(
+                "SELECT id, user_id, checkin_at, checkout_at FROM sessions"
+                + (" UNION ALL SELECT id, user_id, checkin_at, checkout_at FROM sessions_archive" if archived else "")
+            )
+            for sid, uid, ci, co in _iter_rows(cur):
+                u = by_id.get(int(uid))
+                yield f"session {sid}", u[0] if u else f"#{uid}", ci, co
+        finally:
+            src.close()
+
+    return users, rows()
+
+def _import_unfinished(cur: sqlite3.Cursor) -> bool:
+    """A run is loading, or was interrupted and not repaired yet (the totals lag the sessions)."""
+    cur.execute("SELECT 1 FROM import_runs WHERE finished_at IS NULL LIMIT 1")
+    return cur.fetchone() is not None
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # exists, owned by someone else
+    return True
+
+def _finish_import_runs(cur: sqlite3.Cursor, run_id: Optional[int] = None) -> int:
+    """
+    Close unfinished runs (caller's transaction): the given one, or every run whose process
+    is gone. Dropped indexes are rebuilt and so are the projections over the loaded sessions.
+    Returns the number of runs closed.
+    """
+    cur.execute("SELECT id, pid, dropped_indexes FROM import_runs WHERE finished_at IS NULL")
+    runs = [r for r in cur.fetchall() if r[0] == run_id or (run_id is None and not _pid_alive(int(r[1])))]
+    if not runs:
+        return 0
+    for rid, _pid, dropped in runs:
+        for name, sql in json.loads(dropped or "[]"):
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+            if cur.fetchone() is None:
+                cur.execute(sql)
+        cur.execute("UPDATE import_runs SET finished_at = ? WHERE id = ?", (iso(now_jst()), rid))
+    _rebuild_day_index(cur)
+    _rebuild_lifetime(cur)
+    _rebuild_streaks(cur)
+    cur.execute("DELETE FROM occupancy_cache")  # derived from sessions
+    _drop_period_snapshots(cur)  # refrozen by the loop from the new totals
+    _bump_write_counter(cur, bulk=True)
+    return len(runs)
+
+def _import_write(conn: sqlite3.Connection, todo: List[Tuple[str, int, int]], uid_of: Dict[str, int],
+                  new_users: Dict[str, Tuple[str, str, str, str]], report: Dict[str, Any], batch: int,
+                  progress: Optional[Callable[[int, int, float], None]]) -> None:
+    """Load validated (student_no, checkin_us, checkout_us) rows, in that order; fills in the report."""
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("SELECT pid FROM import_runs WHERE finished_at IS NULL")
+    if any(_pid_alive(int(r[0])) for r in cur.fetchall()):
+        conn.rollback()
+        raise RuntimeError("another import is running")
+    report["repaired_runs"] = _finish_import_runs(cur)  # interrupted before: indexes and totals first
+    if not todo:
+        conn.commit()
+        return
+    cur.execute("""
+        INSERT INTO import_runs (source, pid, started_at, rows_read, accepted, rejected) VALUES (?, ?, ?, ?, ?, ?)
+    """, (report["source"], os.getpid(), iso(now_jst()), report["rows_read"], len(todo), report["rejected"]))
+    run_id = int(cur.lastrowid)
+    for sno in sorted({sno for sno, _, _ in todo if sno not in uid_of}):
+        cur.execute("INSERT INTO users (student_no, name, nickname, pin_hash, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (sno, *new_users[sno]))
+        uid_of[sno] = int(cur.lastrowid)
+    dropped: List[Tuple[str, str]] = []
+    if len(todo) >= IMPORT_DEFER_INDEX_ROWS:
+        cur.execute(f"""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({", ".join("?" * len(IMPORT_TABLES))})
+        """, IMPORT_TABLES)
+        # unique and partial (open-session) indexes stay: imported rows are closed
+        dropped = [(n, q) for n, q in cur.fetchall() if "UNIQUE" not in q.upper() and " WHERE " not in q.upper()]
+        cur.execute("UPDATE import_runs SET dropped_indexes = ? WHERE id = ?", (json.dumps(dropped), run_id))
+        for name, _ in dropped:
+            cur.execute(f'DROP INDEX "{name}"')
+    report["deferred_indexes"] = [n for n, _ in dropped]
+    conn.commit()
+
+    t0 = pytime.perf_counter()
+    recorded = iso(now_jst())
+    try:
+        for i in range(0, len(todo), batch):
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("""
+                SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'sessions'), 0),
+                           COALESCE((SELECT MAX(id) FROM sessions), 0))
+            """)
+            sid = int(cur.fetchone()[0])  # live punches may have taken ids since the last batch
+            sessions, events = [], []
+            for sno, ci, co in todo[i:i + batch]:
+                sid += 1
+                uid, ci_s, co_s = uid_of[sno], _us_iso(ci), _us_iso(co)
+                sessions.append((sid, uid, ci_s, co_s, co // _US - ci // _US))
+                events.append(("in", uid, sid, ci_s, None, recorded))
+                events.append(("out", uid, sid, co_s, ci_s, recorded))
+            cur.executemany("INSERT INTO sessions (id, user_id, checkin_at, checkout_at, duration_sec) VALUES (?, ?, ?, ?, ?)",
+                            sessions)
+            cur.executemany("""
+                INSERT INTO punch_events (kind, user_id, session_id, at, checkin_at, source, recorded_at)
+                VALUES (?, ?, ?, ?, ?, 'import', ?)
+            """, events)
+            report["inserted"] += len(sessions)
+            cur.execute("UPDATE import_runs SET inserted = ? WHERE id = ?", (report["inserted"], run_id))
+            conn.commit()
+            if progress:
+                progress(report["inserted"], len(todo), pytime.perf_counter() - t0)
+        report["load_sec"] = round(pytime.perf_counter() - t0, 2)
+        report["rows_per_sec"] = round(report["inserted"] / max(pytime.perf_counter() - t0, 1e-9))
+    finally:
+        # after a failure too: the batches that committed stay, indexed and totalled
+        if conn.in_transaction:
+            conn.rollback()
+        t1 = pytime.perf_counter()
+        cur.execute("BEGIN IMMEDIATE")
+        _finish_import_runs(cur, run_id)
+        conn.commit()
+        report["finish_sec"] = round(pytime.perf_counter() - t1, 2)
+
+def _import_sessions(rows: Iterable[Tuple[str, str, str, Optional[str]]], source: str,
+                     new_users: Optional[Dict[str, Tuple[str, str, str, str]]] = None, dry_run: bool = False,
+                     batch: int = IMPORT_BATCH, progress: Optional[Callable[[int, int, float], None]] = None) -> Dict[str, Any]:
+    """
+    Validate rows (where, student_no, checkin_at, checkout_at) and, unless dry_run, load the
+    accepted ones. new_users (student_no -> name, nickname, pin_hash, created_at) are created
+    if missing. progress(inserted, total, seconds) runs after each batch. Returns the report;
+    RuntimeError while another import is running.
+    """
+    new_users = new_users or {}
+    t0 = pytime.perf_counter()
+    now_us = _epoch_us(now_jst())
+    rejected: Dict[str, int] = {}
+    samples: List[Dict[str, str]] = []
+
+    def reject(reason: str, where: str, detail: str) -> None:
+        rejected[reason] = rejected.get(reason, 0) + 1
+        if len(samples) < IMPORT_SAMPLES:
+            samples.append({"where": where, "reason": reason, "detail": detail})
+
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT student_no, id FROM users")
+        uid_of = {r[0]: int(r[1]) for r in cur.fetchall()}
+        wanted: Dict[str, List[Tuple[int, int]]] = {}
+        n_read = 0
+        for where, sno, ci_s, co_s in rows:
+            n_read += 1
+            if sno not in uid_of and sno not in new_users:
+                reject("unknown_user", where, sno)
+                continue
+            if not co_s:
+                reject("open", where, sno)
+                continue
+            try:
+                ci, co = _epoch_us(_import_time(ci_s)), _epoch_us(_import_time(co_s))
+            except ValueError:
+                reject("bad_time", where, f"{ci_s} / {co_s}")
+                continue
+            if co <= ci:
+                reject("not_after_checkin", where, f"{ci_s} / {co_s}")
+            elif co > now_us:
+                reject("future", where, f"{ci_s} / {co_s}")
+            else:
+                wanted.setdefault(sno, []).append((ci, co))
+
+        # the existing sessions of those users, archive included, in one pass (no user index on sessions)
+        sno_of = {uid_of[sno]: sno for sno in wanted if sno in uid_of}
+        existing: Dict[str, List[Tuple[int, float]]] = {}
+        has_archive = "sessions_archive" in _table_names(cur)
+        cur.execute(
+            "SELECT user_id, checkin_at, checkout_at FROM sessions"
+            + (" UNION ALL SELECT user_id, checkin_at, checkout_at FROM sessions_archive" if has_archive else "")
+        )
+        for uid, ci, co in _iter_rows(cur):
+            sno = sno_of.get(int(uid))
+            if sno is not None:
+                end = _epoch_us(parse_iso(co)) if co else math.inf  # open: nothing after its check-in fits
+                existing.setdefault(sno, []).append((_epoch_us(parse_iso(ci)), end))
+
+        duplicates = 0
+        todo: List[Tuple[str, int, int]] = []
+        for sno, ivs in wanted.items():
+            ivs.sort()
+            have = sorted(existing.get(sno, ()))
+            exact = set(have)
+            starts = [a for a, _ in have]
+            reach: List[float] = []  # running max of the ends (old rows may overlap each other)
+            for _, b in have:
+                reach.append(max(b, reach[-1]) if reach else b)
+            last: Optional[Tuple[int, int]] = None
+            for ci, co in ivs:
+                if (ci, co) in exact or (ci, co) == last:
+                    duplicates += 1
+                    continue
+                k = bisect_right(starts, ci)
+                if (k and reach[k - 1] > ci) or (k < len(have) and starts[k] < co) or (last and last[1] > ci):
+                    reject("overlap", sno, f"{_us_iso(ci)} / {_us_iso(co)}")
+                    continue
+                todo.append((sno, ci, co))
+                last = (ci, co)
+        del wanted, existing
+        todo.sort(key=lambda r: r[1])  # check-in order: ids follow time, as with live punches
+
+        report: Dict[str, Any] = {
+            "source": source, "dry_run": dry_run, "rows_read": n_read, "accepted": len(todo),
+            "duplicates": duplicates, "rejected": sum(rejected.values()), "rejected_by_reason": rejected,
+            "samples": samples, "users_created": len({sno for sno, _, _ in todo if sno not in uid_of}),
+            "inserted": 0, "validate_sec": round(pytime.perf_counter() - t0, 2),
+        }
+        if not dry_run:
+            _import_write(conn, todo, uid_of, new_users, report, batch, progress)
+    finally:
+        conn.close()
+    report["seconds"] = round(pytime.perf_counter() - t0, 2)
+    return report
+
+def _import_metrics() -> Dict[str, Any]:
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT source, started_at, finished_at, rows_read, accepted, inserted, rejected, dropped_indexes IS NOT NULL AS deferred_indexes
+            FROM import_runs ORDER BY id DESC LIMIT 1
+        """)
+        last = cur.fetchone()
+        return {"last_run": dict(last) if last else None, "unfinished": _import_unfinished(cur)}
+    finally:
+        conn.close()
+
+# =========================================================
+# Routes: Leaderboard
+# =========================================================
+@app.get("/api/leaderboard")
+def leaderboard(range: RangeName = "today", top: int = 20, start: Optional[str] = None, end: Optional[str] = None):
+    """
+    range=today/week/month/all, or an arbitrary inclusive day range: ?start=2026-04-01&end=2026-07-20
+    (start/end take precedence over range). Served from the cumulative day index.
+    """
+    if top < 1: top = 1
+    if top > 100: top = 100
+
+    if start or end:
+        d0, d1 = _parse_day_range(start, end)
+        range_label = "custom"
+    else:
+        r0, r1 = _range_start_end(range)
+        d0, d1 = r0.date(), (r1 - timedelta(days=1)).date()
+        range_label = range
+    with _read_conn() as (conn, _version):
+        if range_label == "all":
+            totals = _lifetime_totals(conn)
+        else:
+            totals = _day_range_totals(conn, d0, d1)
 
     items = [{"nickname": v["nickname"], "total_sec": int(v["total_sec"])} for v in totals.values()]
     items.sort(key=lambda x: x["total_sec"], reverse=True)
 
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS c FROM sessions WHERE checkout_at IS NULL")
-    occupancy = int(cur.fetchone()["c"])
-    conn.close()
+    occupancy = _occupancy_current()
 
     return {
         "ok": True,
-        "range": range,
-        "start": iso(start),
-        "end": iso(end),
+        "range": range_label,
+        "start": iso(_day_start(d0)),
+        "end": iso(_day_start(d1) + timedelta(days=1)),
         "occupancy": occupancy,
         "items": items[:top],
         "total_users": max(1, len(totals)),
     }
 
+# 過去の日・週・月のランキング（確定済みの期間はスナップショットから読む）
+@app.get("/api/leaderboard/history")
+def leaderboard_history(period: Literal["day", "week", "month"] = "week", start: Optional[str] = None,
+                        top: int = 20, limit: int = 12):
+    """
+    Without start: the latest `limit` frozen periods (start, end, users, total_sec), newest first.
+    With start (any day inside the period): that period's ranking. A period that has ended but
+    is not frozen yet (open sessions, batch punch window) is computed live and says frozen=false.
+    """
+    top = max(1, min(100, top))
+    limit = max(1, min(100, limit))
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        if start is None:
+            cur.execute("""
+                SELECT start_day, end_day, users, total_sec FROM period_snapshots
+                WHERE period = ? ORDER BY start_day DESC LIMIT ?
+            """, (period, limit))
+            return {"ok": True, "period": period, "periods": [dict(r) for r in cur.fetchall()]}
+
+        try:
+            d0, d1 = _period_bounds(period, date.fromisoformat(start))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="日付は YYYY-MM-DD 形式で指定してください")
+        if _day_start(d1) + timedelta(days=1) > now_jst():
+            raise HTTPException(status_code=400, detail="まだ終わっていない期間です（/api/leaderboard を使ってください）")
+        cur.execute("SELECT users, total_sec, frozen_at FROM period_snapshots WHERE period = ? AND start_day = ?",
+                    (period, d0.isoformat()))
+        head = cur.fetchone()
+        if head is None and _freeze_period(conn, period, d0, d1):
+            cur.execute("SELECT users, total_sec, frozen_at FROM period_snapshots WHERE period = ? AND start_day = ?",
+                        (period, d0.isoformat()))
+            head = cur.fetchone()
+        if head is not None:
+            cur.execute("""
+                SELECT s.rank, u.nickname, s.total_sec FROM period_snapshot_users s
+                JOIN users u ON u.id = s.user_id
+                WHERE s.period = ? AND s.start_day = ?
+                ORDER BY s.rank, s.user_id LIMIT ?
+            """, (period, d0.isoformat(), top))
+            items = [dict(r) for r in cur.fetchall()]
+            users, total_sec, frozen_at = int(head["users"]), int(head["total_sec"]), head["frozen_at"]
+        else:
+            ranking = _period_ranking(conn, d0, d1)
+            nick = _nicknames(conn)
+            items = [{"rank": rank, "nickname": nick.get(uid), "total_sec": sec} for rank, uid, sec in ranking[:top]]
+            users, total_sec, frozen_at = len(ranking), sum(r[2] for r in ranking), None
+    finally:
+        conn.close()
+    with _period_lock:
+        _period_stats["snapshot_reads" if frozen_at else "live_reads"] += 1
+    return {
+        "ok": True,
+        "period": period,
+        "start": iso(_day_start(d0)),
+        "end": iso(_day_start(d1) + timedelta(days=1)),
+        "frozen": frozen_at is not None,
+        "frozen_at": frozen_at,
+        "total_users": users,
+        "total_sec": total_sec,
+        "items": items,
+    }
+
+# クラス・学年などのグループ別ランキング
+@app.get("/api/leaderboard/groups")
+def leaderboard_groups(range: RangeName = "today", start: Optional[str] = None, end: Optional[str] = None,
+                       kind: Optional[str] = None, sort: Literal["total", "avg", "participation"] = "avg"):
+    """sort=avg (default, fair across group sizes) / total / participation. kind filters e.g. class or grade."""
+    if start or end:
+        d0, d1 = _parse_day_range(start, end)
+        range_label = "custom"
+    else:
+        r0, r1 = _range_start_end(range)
+        d0, d1 = r0.date(), (r1 - timedelta(days=1)).date()
+        range_label = range
+    version = _current_data_version()
+    conn = db_connect()
+    try:
+        if range_label == "all":
+            items = _group_board(conn, version, None, None)
+        else:
+            items = _group_board(conn, version, d0, d1)
+    finally:
+        conn.close()
+    if kind:
+        items = [g for g in items if g["kind"] == kind]
+    sort_key = {"total": "total_sec", "avg": "avg_sec", "participation": "participation"}[sort]
+    items.sort(key=lambda g: (g[sort_key], g["total_sec"]), reverse=True)
+    return {
+        "ok": True,
+        "range": range_label,
+        "start": iso(_day_start(d0)),
+        "end": iso(_day_start(d1) + timedelta(days=1)),
+        "sort": sort,
+        "items": [{k: g[k] for k in ("group_id", "name", "kind", "members", "active", "participation", "total_sec", "avg_sec")}
+                  for g in items],
+    }
+
 # =========================================================
 # Routes: Me / Dashboard data
 # =========================================================
-@app.get("/api/me")
-def me(request: Request, sess: Dict[str, Any] = Depends(require_user)):
-    user_id = int(sess["user_id"])
-    conn = db_connect()
-    cur = conn.cursor()
+# format=compact: daily series as columns {"start", "offsets", "sec", "rank", "total_users"}
+# plus an opaque "version". Sending it back as ?since=<version> returns only the days that
+# changed (today is always included while sessions are open) and the totals.
+ME_TREND_DAYS = 21
+ME_TREND_DAYS_MAX = 180
+
+def _me_version(user_id: int, window_start: date) -> str:
+    return f"{BOOT_ID}.{user_id}.{_current_data_version()}.{window_start.isoformat()}"
+
+def _me_changes(since: str, user_id: int, window_start: date) -> Optional[Tuple[Optional[date], bool]]:
+    """
+    Decode ?since= and look it up in the change log.
+    Returns (first changed day inside the window or None, user's own sessions changed),
+    or None when a full payload is needed (restart, other user, day rollover, log too short).
+    """
+    try:
+        boot, uid, ver, ws = since.split(".", 3)
+        if boot != BOOT_ID or int(uid) != user_id or date.fromisoformat(ws) != window_start:
+            return None
+        changes = _changes_since(int(ver))
+    except ValueError:
+        return None
+    if changes is None:
+        return None
+    first: Optional[date] = None
+    own = False
+    for uid2, d0, d1 in changes:
+        own = own or uid2 == user_id
+        if d1 < window_start:
+            continue
+        d0 = max(d0, window_start)
+        first = d0 if first is None else min(first, d0)
+    return first, own
 
+def _compact_daily(window_start: date, series: List[Dict[str, Any]], offset0: int) -> Dict[str, Any]:
+    """Columnar form of _rank_series_for_user output; day i is window_start + offsets[i]."""
+    return {
+        "start": window_start.isoformat(),
+        "offsets": list(range(offset0, offset0 + len(series))),
+        "sec": [int(it["sec"]) for it in series],
+        "rank": [int(it["rank"]) for it in series],
+        "total_users": [int(it["total_users"]) for it in series],
+    }
+
+# ---------------------------------------------------------
+# Dashboard cache
+# ---------------------------------------------------------
+# LRU keyed by (user_id, days). Each entry has two independently refreshed parts:
+#   user part : profile, recent sessions, *closed-session* totals and daily seconds
+#               -> rebuilt when this user punches (_user_versions) or the day rolls over
+#   rank part : ranks per range and per day -> rebuilt when the global data version or the
+#               day changes, from a rank context shared by all users
+# The open session's elapsed time is added when the entry is read, so totals stay exact.
+_me_cache_lock = threading.Lock()
+_me_cache: "OrderedDict[Tuple[int, int], Dict[str, Any]]" = OrderedDict()
+_me_cache_stats: Dict[str, int] = {"requests": 0, "hits": 0, "user_refreshes": 0, "rank_refreshes": 0, "evictions": 0}
+_rank_contexts: Dict[int, Dict[str, Any]] = {}  # days -> shared rank context
+
+def _user_closed_sec(cur: sqlite3.Cursor, user_id: int, d0: date, d1: date) -> int:
+    """Closed-session seconds of one user in [d0, d1] from the cumulative day index."""
+    cur.execute("""
+        SELECT COALESCE((SELECT cum_sec FROM user_day_totals WHERE user_id = ? AND day <= ? ORDER BY day DESC LIMIT 1), 0)
+             - COALESCE((SELECT cum_sec FROM user_day_totals WHERE user_id = ? AND day < ? ORDER BY day DESC LIMIT 1), 0)
+    """, (user_id, d1.isoformat(), user_id, d0.isoformat()))
+    return int(cur.fetchone()[0])
+
+def _me_user_part(conn: sqlite3.Connection, user_id: int, window_start: date, days: int) -> Optional[Dict[str, Any]]:
+    cur = conn.cursor()
     cur.execute("SELECT id, student_no, name, nickname, created_at, weekly_goal FROM users WHERE id = ?", (user_id,))
     user = cur.fetchone()
     if not user:
-        conn.close()
-        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+        return None
 
     # recent sessions
     cur.execute("""
@@ -678,35 +3768,290 @@ def me(request: Request, sess: Dict[str, Any] = Depends(require_user)):
             "is_active": s["checkout_at"] is None
         })
 
-    # totals + ranks (today/week/month/all)
-    totals_out: Dict[str, int] = {}
-    ranks_out: Dict[str, Any] = {}
+    closed: Dict[str, int] = {}
+    for rn in ["today", "week", "month"]:
+        start, end = _range_start_end(rn)  # type: ignore[arg-type]
+        closed[rn] = _user_closed_sec(cur, user_id, start.date(), (end - timedelta(days=1)).date())
+    cur.execute("SELECT lifetime_sec FROM users WHERE id = ?", (user_id,))
+    closed["all"] = int(cur.fetchone()[0])
+    cur.execute("SELECT run_start, run_end, longest, best_sec, best_day FROM user_streaks WHERE user_id = ?", (user_id,))
+    st = cur.fetchone()
+
+    cur.execute("""
+        SELECT day, sec FROM user_day_totals
+        WHERE user_id = ? AND day >= ? AND day < ?
+    """, (user_id, window_start.isoformat(), (window_start + timedelta(days=days)).isoformat()))
+    by_day = {r["day"]: int(r["sec"]) for r in cur.fetchall()}
+    daily_closed = [by_day.get((window_start + timedelta(days=i)).isoformat(), 0) for i in range(days)]
+
+    open_sess = _open_session(conn, user_id)
+    return {
+        "user": dict(user),
+        "sessions": sessions,
+        "closed": closed,
+        "daily_closed": daily_closed,
+        "streak": dict(st) if st else None,
+        "open_checkin_at": open_sess["checkin_at"] if open_sess else None,
+    }
+
+def _rank_context(conn: sqlite3.Connection, days: int, window_start: date, key: Tuple[int, date]) -> Dict[str, Any]:
+    """
+    Everyone's totals per range and per day, pre-sorted so one user's rank is a bisect.
+    Computed once per (data version, day) and shared by all dashboard requests.
+    """
+    with _me_cache_lock:
+        ctx = _rank_contexts.get(days)
+        if ctx and ctx["key"] == key:
+            return ctx
 
+    ranges: Dict[str, Dict[str, Any]] = {}
+    for rn in ["today", "week", "month", "all"]:
+        if rn == "all":
+            totals = _lifetime_totals(conn)
+        else:
+            start, end = _range_start_end(rn)  # type: ignore[arg-type]
+            totals = _compute_totals_in_range(conn, start, end)
+        ranges[rn] = {
+            "totals": {uid: int(v["total_sec"]) for uid, v in totals.items()},
+            "sorted": sorted(int(v["total_sec"]) for v in totals.values()),
+        }
+    start_tr = _day_start(window_start)
+    labels, user_to_secs, _ = _daily_series_for_all_users(conn, start_tr, start_tr + timedelta(days=days))
+    ctx = {
+        "key": key,
+        "ranges": ranges,
+        "user_to_secs": user_to_secs,
+        "day_sorted": [sorted(secs[i] for secs in user_to_secs.values()) for i in range(len(labels))],
+    }
+    with _me_cache_lock:
+        _rank_contexts[days] = ctx
+    return ctx
+
+def _me_rank_part(ctx: Dict[str, Any], user_id: int) -> Dict[str, Any]:
+    """Same numbers as _rank_of_user / _rank_series_for_user, via bisect on the shared context."""
+    ranks = {}
+    for rn, r in ctx["ranges"].items():
+        my = r["totals"].get(user_id, 0)
+        ranks[rn] = {
+            "rank": len(r["sorted"]) - bisect_right(r["sorted"], my) + 1,
+            "total_users": max(1, len(r["totals"])),
+            "my_sec": my,
+        }
+    mine = ctx["user_to_secs"].get(user_id)
+    n_users = len(ctx["user_to_secs"]) + (0 if mine is not None else 1)
+    daily_rank = []
+    for i, asc in enumerate(ctx["day_sorted"]):
+        my = mine[i] if mine is not None else 0
+        daily_rank.append(len(asc) - bisect_right(asc, my) + 1)
+    return {"ranks": ranks, "daily_rank": daily_rank, "daily_total_users": [n_users] * len(daily_rank)}
+
+def _me_assemble(up: Dict[str, Any], rp: Dict[str, Any], window_start: date, now: datetime) -> Dict[str, Any]:
+    """Cached parts + live open-session time -> the /api/me numbers."""
+    ci = parse_iso(up["open_checkin_at"]) if up["open_checkin_at"] else None
 
+    def live(a: datetime, b: datetime) -> int:
+        return clamp_overlap_sec(ci, now, a, b) if ci else 0
+
+    totals_out: Dict[str, int] = {}
     for rn in ["today", "week", "month"]:
         start, end = _range_start_end(rn)  # type: ignore[arg-type]
-        totals = _compute_totals_in_range(conn, start, end)
-        my = int(totals.get(user_id, {}).get("total_sec", 0))
-        totals_out[rn] = my
-        ranks_out[rn] = _rank_of_user(totals, user_id)
+        totals_out[rn] = up["closed"][rn] + live(start, end)
+    totals_out["all"] = up["closed"]["all"] + (max(0, int((now - ci).total_seconds())) if ci else 0)
+    ranks_out = {rn: dict(r, my_sec=totals_out[rn]) for rn, r in rp["ranks"].items()}
+
+    series = []
+    for i, closed_sec in enumerate(up["daily_closed"]):
+        d = window_start + timedelta(days=i)
+        ds = _day_start(d)
+        series.append({
+            "date": d.isoformat(),
+            "sec": closed_sec + live(ds, ds + timedelta(days=1)),
+            "rank": rp["daily_rank"][i],
+            "total_users": rp["daily_total_users"][i],
+        })
+
+    # 連続日数（今日まで連続して自習した日数）・最長連続・自己ベスト（1日最大）: 全履歴から
+    st = up["streak"]
+    run = (date.fromisoformat(st["run_start"]), date.fromisoformat(st["run_end"])) if st else None
+    if ci:
+        # the open session makes every day from its check-in to today a study day
+        d_in = ci.astimezone(JST).date()
+        if run and run[1] >= d_in - timedelta(days=1):
+            run = (min(run[0], d_in), now.date())
+        else:
+            run = (d_in, now.date())
+    streak = (run[1] - run[0]).days + 1 if run and run[1] == now.date() else 0
+    longest_streak = max(int(st["longest"]) if st else 0, streak)
+    best_sec, best_day = (int(st["best_sec"]), st["best_day"]) if st else (0, None)
+    for it in series:  # the window includes live time of the open session
+        if it["sec"] > best_sec:
+            best_sec, best_day = it["sec"], it["date"]
 
     # 週目標進捗
+    user = up["user"]
     weekly_goal = user["weekly_goal"] if user["weekly_goal"] is not None else 300
-    week_sec = totals_out["week"]
-    week_progress = min(100, int(week_sec / (weekly_goal*60) * 100))
-
-    totals_out["all"] = _all_time_total_sec(conn, user_id)
-    # all-time rank (optional)
-    start, end = _range_start_end("all")
-    totals_all = _compute_totals_in_range(conn, start, end)
-    ranks_out["all"] = _rank_of_user(totals_all, user_id)
-
-    # daily trends (last 21 days)
-    days = 21
-    end_tr = now_jst().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
-    start_tr = end_tr - timedelta(days=days)
-    labels, user_to_secs, _ = _daily_series_for_all_users(conn, start_tr, end_tr)
-    series = _rank_series_for_user(labels, user_to_secs, user_id)
+    week_progress = min(100, int(totals_out["week"] / (weekly_goal*60) * 100))
+
+    return {
+        "user": user,
+        "sessions": up["sessions"],
+        "totals": totals_out,
+        "ranks": ranks_out,
+        "series": series,
+        "streak": streak,
+        "longest_streak": longest_streak,
+        "best_sec": best_sec,
+        "best_day": best_day,
+        "weekly_goal": weekly_goal,
+        "week_progress": week_progress,
+    }
+
+def _me_dashboard(user_id: int, window_start: date, days: int) -> Dict[str, Any]:
+    now = now_jst()
+    today = now.date()
+    key = (user_id, days)
+    with _data_lock:
+        user_ver = (_user_versions.get(user_id, 0), _foreign_version)
+        rank_key = (_data_version, today)
+    with _me_cache_lock:
+        entry = _me_cache.get(key)
+        if entry is not None:
+            _me_cache.move_to_end(key)
+    user_ok = entry is not None and entry["user_key"] == (user_ver, today)
+    rank_ok = entry is not None and entry["rank_key"] == rank_key
+
+    if user_ok:
+        up = entry["user_part"]
+    else:
+        conn = db_connect()
+        try:
+            up = _me_user_part(conn, user_id, window_start, days)
+        finally:
+            conn.close()
+        if up is None:
+            raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    if rank_ok:
+        rp = entry["rank_part"]
+    else:
+        # the context is cached under rank_key, so the snapshot must include that version
+        with _read_conn(min_version=rank_key[0]) as (conn, _version):
+            rp = _me_rank_part(_rank_context(conn, days, window_start, rank_key), user_id)
+
+    with _me_cache_lock:
+        _me_cache_stats["requests"] += 1
+        if user_ok and rank_ok:
+            _me_cache_stats["hits"] += 1
+        if not user_ok:
+            _me_cache_stats["user_refreshes"] += 1
+        if not rank_ok:
+            _me_cache_stats["rank_refreshes"] += 1
+        _me_cache[key] = {"user_key": (user_ver, today), "user_part": up, "rank_key": rank_key, "rank_part": rp}
+        _me_cache.move_to_end(key)
+        while len(_me_cache) > ME_CACHE_SIZE:
+            _me_cache.popitem(last=False)
+            _me_cache_stats["evictions"] += 1
+    return _me_assemble(up, rp, window_start, now)
+
+def _me_cache_metrics() -> Dict[str, Any]:
+    with _me_cache_lock:
+        out: Dict[str, Any] = dict(_me_cache_stats)
+        out["size"] = len(_me_cache)
+    out["capacity"] = ME_CACHE_SIZE
+    req = out["requests"] or 1
+    out["hit_ratio"] = round(out["hits"] / req, 4)
+    out["user_part_hit_ratio"] = round(1 - out["user_refreshes"] / req, 4)
+    out["rank_part_hit_ratio"] = round(1 - out["rank_refreshes"] / req, 4)
+    return out
+
+# 自分の過去の日・週・月ごとの合計と順位（確定済みの期間のみ）
+@app.get("/api/me/history")
+def me_history(period: Literal["day", "week", "month"] = "week", limit: int = 12,
+               sess: Dict[str, Any] = Depends(require_user)):
+    limit = max(1, min(100, limit))
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT p.start_day, p.end_day, p.users AS total_users, s.rank, COALESCE(s.total_sec, 0) AS total_sec
+            FROM period_snapshots p
+            LEFT JOIN period_snapshot_users s
+              ON s.user_id = ? AND s.period = p.period AND s.start_day = p.start_day
+            WHERE p.period = ?
+            ORDER BY p.start_day DESC LIMIT ?
+        """, (int(sess["user_id"]), period, limit))
+        items = [dict(r) for r in cur.fetchall()]
+    finally:
+        conn.close()
+    return {"ok": True, "period": period, "items": items}
+
+@app.get("/api/me")
+def me(request: Request, start: Optional[str] = None, end: Optional[str] = None,
+       format: Literal["full", "compact"] = "full", since: Optional[str] = None, days: int = ME_TREND_DAYS,
+       sess: Dict[str, Any] = Depends(require_user)):
+    user_id = int(sess["user_id"])
+    # 任意期間（?start=YYYY-MM-DD&end=YYYY-MM-DD）の合計・順位も返す
+    custom = _parse_day_range(start, end) if (start or end) else None
+    compact = format == "compact"
+    days = min(max(days, 7), ME_TREND_DAYS_MAX) if compact else ME_TREND_DAYS
+    window_start = now_jst().date() - timedelta(days=days - 1)
+    version = _me_version(user_id, window_start)
+    delta = _me_changes(since, user_id, window_start) if (compact and since) else None
+
+    dash = _me_dashboard(user_id, window_start, days)
+    totals_out = dash["totals"]
+    ranks_out = dash["ranks"]
+    series = dash["series"]
+
+    if custom:
+        with _read_conn(min_version=_current_data_version()) as (conn, _version):
+            totals_c = _day_range_totals(conn, custom[0], custom[1])
+        totals_out["custom"] = int(totals_c.get(user_id, {}).get("total_sec", 0))
+        ranks_out["custom"] = _rank_of_user(totals_c, user_id)
+    custom_range = {"start": custom[0].isoformat(), "end": custom[1].isoformat()} if custom else None
+
+    if delta is not None:
+        # only the days from the first changed one (at least today) to the end of the window
+        last_day = window_start + timedelta(days=days - 1)
+        first = min(delta[0] or last_day, last_day)
+        offset0 = (first - window_start).days
+        return {
+            "ok": True,
+            "format": "compact",
+            "full": False,
+            "version": version,
+            "user": dash["user"],
+            "totals": totals_out,
+            "ranks": ranks_out,
+            "daily": _compact_daily(window_start, series[offset0:], offset0),
+            "sessions": dash["sessions"] if delta[1] else None,
+            "streak": dash["streak"],
+            "longest_streak": dash["longest_streak"],
+            "best_sec": dash["best_sec"],
+            "best_day": dash["best_day"],
+            "weekly_goal": dash["weekly_goal"],
+            "week_progress": dash["week_progress"],
+            "custom_range": custom_range,
+        }
+
+    if compact:
+        return {
+            "ok": True,
+            "format": "compact",
+            "full": True,
+            "version": version,
+            "user": dash["user"],
+            "totals": totals_out,
+            "ranks": ranks_out,
+            "daily": _compact_daily(window_start, series, 0),  # cumulative: client-side cumsum
+            "sessions": dash["sessions"],
+            "streak": dash["streak"],
+            "longest_streak": dash["longest_streak"],
+            "best_sec": dash["best_sec"],
+            "best_day": dash["best_day"],
+            "weekly_goal": dash["weekly_goal"],
+            "week_progress": dash["week_progress"],
+            "custom_range": custom_range,
+        }
 
     # also cumulative sum for the user (for a smooth "積み上げ推移")
     cum = 0
@@ -715,34 +4060,155 @@ def me(request: Request, sess: Dict[str, Any] = Depends(require_user)):
         cum += int(it["sec"])
         cum_series.append({"date": it["date"], "cum_sec": cum})
 
-
-    # 連続日数（直近21日で連続して自習した日数）
-    streak = 0
-    for it in reversed(series):
-        if it["sec"] > 0:
-            streak += 1
-        else:
-            break
-
-    # 自己ベスト（1日最大時間）
-    best_sec = max((it["sec"] for it in series), default=0)
-
-    conn.close()
-
     return {
         "ok": True,
-        "user": dict(user),
+        "user": dash["user"],
         "totals": totals_out,            # sec
         "ranks": ranks_out,              # per range
         "daily": series,                 # per day: sec + rank
         "daily_cum": cum_series,         # per day: cumulative seconds in window
-        "sessions": sessions,
-        "streak": streak,
-        "best_sec": best_sec,
-        "weekly_goal": weekly_goal,
-        "week_progress": week_progress
+        "sessions": dash["sessions"],
+        "streak": dash["streak"],                  # consecutive study days up to today (full history)
+        "longest_streak": dash["longest_streak"],
+        "best_sec": dash["best_sec"],              # best single day ever
+        "best_day": dash["best_day"],
+        "weekly_goal": dash["weekly_goal"],
+        "week_progress": dash["week_progress"],
+        "custom_range": custom_range,
     }
 
+# =========================================================
+# On-demand profiler (admin)
+# =========================================================
+# POST /api/admin/profile arms one job: profile the next N requests to one route with
+# cProfile ("cpu") or tracemalloc ("memory"). Handlers are sync and run in the threadpool,
+# so the hook wraps the route's endpoint call (an ASGI middleware's profiler would only see
+# the event loop thread). It is swapped in when a job is armed and removed when it ends:
+# with no job there is no extra code on any request path.
+PROFILE_MAX_REQUESTS = 50
+PROFILE_KEEP = 5          # finished results kept in memory
+PROFILE_TOP = 40          # rows in the text summaries
+_profile_lock = threading.Lock()
+_profile_run_lock = threading.Lock()  # sampled requests run one at a time (tracemalloc is process-wide)
+_profile_job: Optional[Dict[str, Any]] = None
+_profile_results: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+class ProfileReq(BaseModel):
+    path: str = Field(min_length=1, max_length=200)
+    kind: Literal["cpu", "memory"] = "cpu"
+    requests: int = Field(default=5, ge=1, le=PROFILE_MAX_REQUESTS)
+
+def _profile_claim(job: Dict[str, Any]) -> bool:
+    with _profile_lock:
+        if _profile_job is not job or job["taken"] >= job["requests"]:
+            return False
+        job["taken"] += 1
+        return True
+
+def _profile_hook(call: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(call)
+    def hook(*args: Any, **kwargs: Any) -> Any:
+        job = _profile_job
+        if job is None or not _profile_claim(job):
+            return call(*args, **kwargs)
+        with _profile_run_lock:
+            if job["kind"] == "cpu":
+                prof = cProfile.Profile()
+                t0 = pytime.perf_counter()
+                prof.enable()
+                try:
+                    return call(*args, **kwargs)
+                finally:
+                    prof.disable()
+                    _profile_record(job, pytime.perf_counter() - t0, prof=prof)
+            was_tracing = tracemalloc.is_tracing()
+            if not was_tracing:
+                tracemalloc.start()  # 1 frame: the summary groups by allocating line
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+            t0 = pytime.perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                elapsed = pytime.perf_counter() - t0
+                after = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                if not was_tracing:
+                    tracemalloc.stop()
+                skip = [tracemalloc.Filter(False, tracemalloc.__file__)]
+                diff = after.filter_traces(skip).compare_to(before.filter_traces(skip), "lineno")
+                _profile_record(job, elapsed, diff=diff, peak=peak)
+    return hook
+
+def _profile_record(job: Dict[str, Any], elapsed: float, prof: Optional[cProfile.Profile] = None,
+                    diff: Optional[List[tracemalloc.StatisticDiff]] = None, peak: int = 0) -> None:
+    with _profile_lock:
+        if "artifacts" in job:
+            return  # stopped while this request was waiting for its turn
+        job["wall_ms"].append(round(elapsed * 1000, 2))
+        if prof is not None:
+            if job["stats"] is None:
+                job["stats"] = pstats.Stats(prof)
+            else:
+                job["stats"].add(prof)
+        if diff is not None:
+            job["peaks"].append(peak)
+            for st in diff:
+                fr = st.traceback[0]
+                acc = job["alloc"].setdefault((fr.filename, fr.lineno), [0, 0])
+                acc[0] += st.size_diff
+                acc[1] += st.count_diff
+        if len(job["wall_ms"]) >= job["requests"]:
+            _profile_finish(job)
+
+def _profile_finish(job: Dict[str, Any]) -> None:
+    """Unhook the route and turn the job into downloadable artifacts (caller holds _profile_lock)."""
+    global _profile_job
+    if _profile_job is job:
+        _profile_job = None
+    for route, call in job.pop("hooked"):
+        route.dependant.call = call
+    walls = sorted(job["wall_ms"])
+    head = [f"{job['kind']} profile of {job['path']}: {len(walls)}/{job['requests']} requests, started {job['started_at']}"]
+    if walls:
+        head.append(f"wall ms: min {walls[0]}  median {walls[len(walls) // 2]}  max {walls[-1]}")
+    artifacts: Dict[str, bytes] = {}
+    if job["kind"] == "cpu":
+        out = io.StringIO()
+        out.write("\n".join(head) + "\n\n")
+        stats = job.pop("stats")
+        if stats is not None:
+            stats.stream = out
+            stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILE_TOP)
+            stats.sort_stats("tottime").print_stats(PROFILE_TOP // 2)
+            artifacts["prof"] = marshal.dumps(stats.stats)  # what Stats.dump_stats writes
+        artifacts["txt"] = out.getvalue().encode("utf-8")
+    else:
+        peaks = job.pop("peaks")
+        if peaks:
+            head.append(f"peak traced KiB per request: max {max(peaks) // 1024}  median {sorted(peaks)[len(peaks) // 2] // 1024}")
+        lines = head + ["", f"{'KiB':>10} {'blocks':>8}  location (net allocation over the profiled requests)"]
+        alloc = sorted(job.pop("alloc").items(), key=lambda kv: -abs(kv[1][0]))[:PROFILE_TOP]
+        for (fn, ln), (size, count) in alloc:
+            lines.append(f"{size / 1024:>+10.1f} {count:>+8d}  {fn}:{ln}")
+        artifacts["txt"] = ("\n".join(lines) + "\n").encode("utf-8")
+    job.pop("alloc", None)
+    job.pop("peaks", None)
+    job.pop("stats", None)
+    job["finished_at"] = iso(now_jst())
+    job["artifacts"] = artifacts
+    _profile_results[job["id"]] = job
+    while len(_profile_results) > PROFILE_KEEP:
+        _profile_results.popitem(last=False)
+
+def _profile_summary(job: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: job.get(k) for k in ("id", "path", "kind", "requests", "started_at", "finished_at")}
+    out["profiled"] = len(job["wall_ms"])
+    out["wall_ms"] = list(job["wall_ms"])
+    if "artifacts" in job:
+        out["downloads"] = {fmt: f"/api/admin/profile/{job['id']}/{fmt}" for fmt in job["artifacts"]}
+    return out
+
 # =========================================================
 # Routes: Admin
 # =========================================================
@@ -795,24 +4261,315 @@ def admin_force_checkout(req: ForceCheckoutReq, request: Request, _: Dict[str, A
         conn.close()
         raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
     user_id = int(u["id"])
+    conn.close()
 
-    cur.execute("""
-        SELECT * FROM sessions
-        WHERE user_id = ? AND checkout_at IS NULL
-        ORDER BY checkin_at DESC LIMIT 1
-    """, (user_id,))
-    s = cur.fetchone()
-    if not s:
-        conn.close()
+    closed = _punch(user_id, "out", "admin")
+    if closed is None:
         raise HTTPException(status_code=409, detail="入室中のセッションがありません")
+    ci, t, dur = closed
+    _after_punch(-1, [(user_id, ci, t)])
+    return {"ok": True, "duration_sec": dur}
+
+# バッジ発行（以前のバッジは無効になる）。segno があれば印刷用のQRコード（SVG）も返す
+@app.post("/api/admin/badge/issue")
+def admin_badge_issue(req: BadgeReq, request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE users SET badge_version = badge_version + 1 WHERE student_no = ?
+            RETURNING id, student_no, name, nickname, badge_version
+        """, (req.student_no.strip(),))
+        rows = cur.fetchall()
+        if not rows:
+            raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+        conn.commit()
+    finally:
+        conn.close()
+    u = rows[0]
+    token = _badge_token(int(u["id"]), int(u["badge_version"]))
+    return {"ok": True, "student_no": u["student_no"], "name": u["name"], "nickname": u["nickname"],
+            "token": token, "qr_svg": _badge_qr_svg(token)}
 
-    t = now_jst()
-    ci = parse_iso(s["checkin_at"])
-    dur = max(0, int((t - ci).total_seconds()))
-    cur.execute("UPDATE sessions SET checkout_at=?, duration_sec=? WHERE id=?", (iso(t), dur, int(s["id"])))
+# バッジ無効化（紛失時など）
+@app.post("/api/admin/badge/revoke")
+def admin_badge_revoke(req: BadgeReq, request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET badge_version = badge_version + 1 WHERE student_no = ?", (req.student_no.strip(),))
+        if cur.rowcount == 0:
+            raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+        conn.commit()
+    finally:
+        conn.close()
+    return {"ok": True}
+
+# 現在入室中リスト取得API
+@app.get("/api/admin/active_sessions")
+def admin_active_sessions(request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT s.id, u.student_no, u.name, u.nickname, s.checkin_at
+        FROM sessions s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.checkout_at IS NULL
+        ORDER BY s.checkin_at ASC
+    """)
+    sessions = [dict(r) for r in cur.fetchall()]
+    conn.close()
+    return {"ok": True, "sessions": sessions}
+
+
+# 一括強制退室API
+@app.post("/api/admin/force_checkout_all")
+def admin_force_checkout_all(request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")  # no punch may close one of these between the SELECT and the UPDATEs
+    cur.execute("SELECT id, user_id, checkin_at FROM sessions WHERE checkout_at IS NULL")
+    now = now_jst()
+    touched = []
+    for s in cur.fetchall():
+        _close_session(cur, s, now, "admin")
+        touched.append((int(s["user_id"]), parse_iso(s["checkin_at"]), now))
     conn.commit()
     conn.close()
-    return {"ok": True, "duration_sec": dur}
+    _after_punch(-len(touched), touched)
+    return {"ok": True, "count": len(touched)}
+
+# グループ一覧（人数つき）
+@app.get("/api/admin/groups")
+def admin_groups(request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT g.id, g.name, g.kind, g.created_at, COUNT(m.user_id) AS members
+            FROM groups g LEFT JOIN user_groups m ON m.group_id = g.id
+            GROUP BY g.id ORDER BY g.kind, g.name
+        """)
+        groups = [dict(r) for r in cur.fetchall()]
+    finally:
+        conn.close()
+    return {"ok": True, "groups": groups}
+
+@app.post("/api/admin/groups/create")
+def admin_group_create(req: GroupCreateReq, request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO groups (name, kind, created_at) VALUES (?, ?, ?)",
+                    (req.name.strip(), req.kind.strip(), iso(now_jst())))
+        group_id = int(cur.lastrowid)
+        _bump_write_counter(cur)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=409, detail="同じ名前のグループがあります")
+    finally:
+        conn.close()
+    _bump_group_version()
+    return {"ok": True, "group_id": group_id}
+
+@app.post("/api/admin/groups/delete")
+def admin_group_delete(req: GroupDeleteReq, request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM user_groups WHERE group_id = ?", (req.group_id,))
+        cur.execute("DELETE FROM groups WHERE id = ?", (req.group_id,))
+        if cur.rowcount == 0:
+            raise HTTPException(status_code=404, detail="グループが見つかりません")
+        _bump_write_counter(cur)
+        conn.commit()
+    finally:
+        conn.close()
+    _bump_group_version()
+    return {"ok": True}
+
+# メンバーの追加・削除（学籍番号で指定）。見つからない学籍番号は unknown で返す
+@app.post("/api/admin/groups/members")
+def admin_group_members(req: GroupMembersReq, request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM groups WHERE id = ?", (req.group_id,))
+        if cur.fetchone() is None:
+            raise HTTPException(status_code=404, detail="グループが見つかりません")
+        wanted = {s.strip() for s in req.add + req.remove if s.strip()}
+        ids: Dict[str, int] = {}
+        for sno in wanted:
+            cur.execute("SELECT id FROM users WHERE student_no = ?", (sno,))
+            r = cur.fetchone()
+            if r:
+                ids[sno] = int(r["id"])
+        cur.executemany("INSERT OR IGNORE INTO user_groups (group_id, user_id) VALUES (?, ?)",
+                        [(req.group_id, ids[s.strip()]) for s in req.add if s.strip() in ids])
+        cur.executemany("DELETE FROM user_groups WHERE group_id = ? AND user_id = ?",
+                        [(req.group_id, ids[s.strip()]) for s in req.remove if s.strip() in ids])
+        _bump_write_counter(cur)
+        conn.commit()
+        cur.execute("""
+            SELECT u.student_no, u.name, u.nickname FROM user_groups m JOIN users u ON u.id = m.user_id
+            WHERE m.group_id = ? ORDER BY u.student_no
+        """, (req.group_id,))
+        members = [dict(r) for r in cur.fetchall()]
+    finally:
+        conn.close()
+    _bump_group_version()
+    return {"ok": True, "members": members, "unknown": sorted(wanted - set(ids))}
+
+# 今すぐバックアップ（完了・検証まで待つ）
+@app.post("/api/admin/backup")
+def admin_backup(request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    try:
+        result = _run_backup()
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=f"バックアップに失敗しました: {e}")
+    return {"ok": True, **result}
+
+# 過去の記録の取り込み（CSV: student_no, checkin_at, checkout_at）。dry_run=true は検証のみ
+# 大きなファイルや別の部屋のDBは python run.py import-sessions で
+@app.post("/api/admin/import")
+def admin_import(req: ImportReq, request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    if not _import_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="別の取り込みを実行中です")
+    try:
+        report = _import_sessions(_csv_import_rows(io.StringIO(req.csv.lstrip("\ufeff"))), "upload", dry_run=req.dry_run)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"CSVを読み込めません: {e}")
+    except RuntimeError:
+        raise HTTPException(status_code=409, detail="別の取り込みを実行中です")
+    finally:
+        _import_lock.release()
+    if report["inserted"] or report.get("repaired_runs"):
+        _invalidate_caches(bulk=True)  # this process's own write: nothing else tells its caches
+    return {"ok": True, **report}
+
+# 混雑ヒートマップAPI（曜日×時間帯の平均在室人数＋日別ピーク）
+@app.get("/api/admin/occupancy/heatmap")
+def admin_occupancy_heatmap(request: Request, start: Optional[str] = None, end: Optional[str] = None, bin: int = 60,
+                            _: Dict[str, Any] = Depends(require_admin)):
+    if bin not in OCCUPANCY_BINS:
+        raise HTTPException(status_code=400, detail=f"bin は {', '.join(map(str, OCCUPANCY_BINS))} 分のいずれかです")
+    if not start:
+        today = now_jst().date()
+        start = (today - timedelta(days=27)).isoformat()
+        end = end or today.isoformat()
+    d0, d1 = _parse_day_range(start, end)
+    if (d1 - d0).days > 366:
+        raise HTTPException(status_code=400, detail="期間は1年以内にしてください")
+    conn = db_connect()
+    try:
+        with _read_conn() as (rconn, version):
+            report = _occupancy_report(rconn, d0, d1, bin, cache_conn=conn,
+                                       cache_write=version >= _current_data_version())
+    finally:
+        conn.close()
+    return {"ok": True, **report}
+
+# 週目標の達成状況と学習時間の分布
+@app.get("/api/admin/analytics/goals")
+def admin_analytics_goals(request: Request, start: Optional[str] = None, end: Optional[str] = None,
+                          bin_hours: Optional[int] = Query(default=None, ge=1, le=100),
+                          _: Dict[str, Any] = Depends(require_admin)):
+    """Period defaults to this week (Monday to today)."""
+    if not start:
+        w0, _w1 = _range_start_end("week")
+        start = w0.date().isoformat()
+        end = end or now_jst().date().isoformat()
+    d0, d1 = _parse_day_range(start, end)
+    if (d1 - d0).days > 366:
+        raise HTTPException(status_code=400, detail="期間は1年以内にしてください")
+    with _read_conn() as (conn, version):
+        report = _goal_report(conn, version, d0, d1, bin_hours)
+    return {"ok": True, **report}
+
+# 在室人数（ライブ）＋1日の分単位推移
+@app.get("/api/admin/occupancy/timeline")
+def admin_occupancy_timeline(request: Request, date_: Optional[str] = Query(default=None, alias="date"),
+                             _: Dict[str, Any] = Depends(require_admin)):
+    d0, _d1 = _parse_day_range(date_ or now_jst().date().isoformat(), date_)
+    with _read_conn() as (conn, _version):
+        timeline = _occupancy_timeline(conn, d0)
+    return {"ok": True, "occupancy": _occupancy_current(), **timeline}
+
+@app.get("/api/admin/metrics")
+def admin_metrics(request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    return {
+        "ok": True,
+        "time_jst": iso(now_jst()),
+        "occupancy": _occupancy_stats(),
+        "me_cache": _me_cache_metrics(),
+        "rate_limit": _rate_limit_metrics(),
+        "auth": _auth_metrics(),
+        "punch_batch": _punch_metrics(),
+        "archive": _archive_metrics(),
+        "analytics": _analytics_metrics(),
+        "snapshot": _snapshot_metrics(),
+        "backup": _backup_metrics(),
+        "events": _event_metrics(),
+        "columnar": _columns_metrics(),
+        "coherence": _coherence_metrics(),
+        "badge": _badge_metrics(),
+        "history": _period_metrics(),
+        "import": _import_metrics(),
+    }
+
+# プロファイル開始（指定ルートへの次のN件を計測）
+@app.post("/api/admin/profile")
+def admin_profile_start(req: ProfileReq, request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    global _profile_job
+    if req.path.startswith("/api/admin/profile"):
+        raise HTTPException(status_code=400, detail="プロファイラ自身は計測できません")
+    routes = [r for r in app.routes if isinstance(r, APIRoute) and r.path == req.path]
+    if not routes:
+        raise HTTPException(status_code=404, detail=f"ルートが見つかりません: {req.path}")
+    with _profile_lock:
+        if _profile_job is not None:
+            raise HTTPException(status_code=409, detail="別のプロファイルが実行中です（停止してから開始してください）")
+        job = {
+            "id": secrets.token_hex(4), "path": req.path, "kind": req.kind, "requests": req.requests,
+            "started_at": iso(now_jst()), "taken": 0, "wall_ms": [],
+            "stats": None, "alloc": {}, "peaks": [], "hooked": [],
+        }
+        for r in routes:
+            job["hooked"].append((r, r.dependant.call))
+            r.dependant.call = _profile_hook(r.dependant.call)
+        _profile_job = job
+    return {"ok": True, "job": _profile_summary(job)}
+
+# 実行中のジョブと結果一覧
+@app.get("/api/admin/profile")
+def admin_profile_status(request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    with _profile_lock:
+        active = _profile_summary(_profile_job) if _profile_job else None
+        results = [_profile_summary(j) for j in reversed(_profile_results.values())]
+    return {"ok": True, "active": active, "results": results}
+
+# 途中で止める（それまでの計測分で結果を作る）
+@app.post("/api/admin/profile/stop")
+def admin_profile_stop(request: Request, _: Dict[str, Any] = Depends(require_admin)):
+    with _profile_run_lock, _profile_lock:  # let a request being profiled finish first
+        job = _profile_job
+        if job is None:
+            raise HTTPException(status_code=409, detail="実行中のプロファイルはありません")
+        _profile_finish(job)
+        return {"ok": True, "job": _profile_summary(job)}
+
+# 結果のダウンロード（txt = 要約, prof = pstats形式: python -m pstats / snakeviz で開ける）
+@app.get("/api/admin/profile/{profile_id}/{fmt}")
+def admin_profile_download(profile_id: str, fmt: Literal["txt", "prof"], request: Request,
+                           _: Dict[str, Any] = Depends(require_admin)):
+    with _profile_lock:
+        job = _profile_results.get(profile_id)
+    if job is None or fmt not in job["artifacts"]:
+        raise HTTPException(status_code=404, detail="プロファイル結果が見つかりません")
+    media = "text/plain; charset=utf-8" if fmt == "txt" else "application/octet-stream"
+    filename = f"profile-{job['kind']}-{profile_id}.{fmt}"
+    return Response(content=job["artifacts"][fmt], media_type=media,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 # =========================================================
 # Health
@@ -820,3 +4577,571 @@ def admin_force_checkout(req: ForceCheckoutReq, request: Request, _: Dict[str, A
 @app.get("/api/health")
 def health():
     return {"ok": True, "time_jst": iso(now_jst())}
+
+
+# =========================================================
+# Management commands: python -m backend.main <command>
+# =========================================================
+def _calibrate_bcrypt(target_ms: float, samples: int, min_rounds: int, max_rounds: int) -> int:
+    """Measure verify latency per cost on this host; return the highest cost within target_ms."""
+    print(f"bcrypt verify latency on this host (median of {samples}, target <= {target_ms:.0f} ms)")
+    print(f"{'rounds':>6}  {'median ms':>10}  {'punches/s':>9}")
+    best = None
+    for rounds in range(min_rounds, max_rounds + 1):
+        ctx = _make_pwd_ctx(rounds)
+        h = ctx.hash("0000")
+        times = []
+        for _ in range(samples):
+            t0 = pytime.perf_counter()
+            ctx.verify("0000", h)
+            times.append(pytime.perf_counter() - t0)
+        times.sort()
+        med_ms = times[len(times) // 2] * 1000
+        mark = " *" if rounds == BCRYPT_ROUNDS else ""
+        print(f"{rounds:>6}  {med_ms:>10.1f}  {1000 / med_ms:>9.1f}{mark}")
+        if med_ms <= target_ms:
+            best = rounds
+        else:
+            break  # cost doubles per round; higher ones will not fit either
+    return best if best is not None else min_rounds
+
+def _stress_punch(users: int, threads: int, punches: int, legacy: bool, seed: int = 1) -> Dict[str, Any]:
+    """
+    Hammer live check-in/out from `threads` threads on a scratch copy of the schema.
+    legacy=True replays the old SELECT-then-write flow without idx_sessions_user_open, for comparison.
+    PIN verification and caches are left out: this measures the DB write path only.
+    """
+    global DB_PATH
+    import random
+    import tempfile
+    saved = DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        DB_PATH = os.path.join(tmp, "stress.sqlite3")
+        try:
+            init_db()
+            conn = db_connect()
+            cur = conn.cursor()
+            now = iso(now_jst())
+            cur.executemany("INSERT INTO users (student_no, name, nickname, pin_hash, created_at) VALUES (?, ?, ?, '', ?)",
+                            [(f"X{i:05d}", f"u{i}", f"u{i}", now) for i in range(users)])
+            if legacy:
+                cur.execute("DROP INDEX idx_sessions_user_open")
+            conn.commit()
+            conn.close()
+
+            counts = {"applied": 0, "conflict": 0, "error": 0}
+            lock = threading.Lock()
+            # what the kiosks last saw per user; threads read it unlocked, like two kiosks tapped at once
+            seen: Dict[int, str] = {}
+
+            def legacy_punch(uid: int, action: str, t: datetime) -> Optional[Tuple[datetime, int]]:
+                c = db_connect()
+                try:
+                    cur = c.cursor()
+                    sess = _open_session(c, uid)
+                    if action == "in":
+                        if sess:
+                            return None
+                        cur.execute("INSERT INTO sessions (user_id, checkin_at, checkout_at, duration_sec) VALUES (?, ?, NULL, NULL)",
+                                    (uid, iso(t)))
+                        c.commit()
+                        return t, 0
+                    if not sess:
+                        return None
+                    dur = _close_session(cur, sess, t, "stress")
+                    c.commit()
+                    return parse_iso(sess["checkin_at"]), dur
+                finally:
+                    c.close()
+
+            def worker(k: int) -> None:
+                rnd = random.Random(seed * 1000 + k)
+                local = {"applied": 0, "conflict": 0, "error": 0}
+                for _ in range(punches):
+                    uid = rnd.randint(1, users)
+                    action = "out" if seen.get(uid) == "in" else "in"
+                    try:
+                        res = legacy_punch(uid, action, now_jst()) if legacy else _punch(uid, action)
+                    except (sqlite3.Error, RuntimeError):
+                        local["error"] += 1  # legacy: a concurrent checkout closed the session first
+                        continue
+                    local["applied" if res is not None else "conflict"] += 1
+                    # a conflict means the other state is current: "in" refused = already in
+                    seen[uid] = action if res is not None else ("in" if action == "in" else "out")
+                with lock:
+                    for key, v in local.items():
+                        counts[key] += v
+
+            t0 = pytime.perf_counter()
+            ths = [threading.Thread(target=worker, args=(k,)) for k in range(threads)]
+            for th in ths:
+                th.start()
+            for th in ths:
+                th.join()
+            elapsed = pytime.perf_counter() - t0
+
+            conn = db_connect()
+            cur = conn.cursor()
+            # any two sessions of one user that overlap = a check-in that slipped past an open one
+            cur.execute("""
+                SELECT COUNT(*) FROM sessions a JOIN sessions b
+                  ON b.user_id = a.user_id AND b.id > a.id
+                 AND b.checkin_at < COALESCE(a.checkout_at, '9999')
+                 AND a.checkin_at < COALESCE(b.checkout_at, '9999')
+            """)
+            overlaps = int(cur.fetchone()[0])
+            cur.execute("SELECT COALESCE(SUM(sec), 0) FROM user_day_totals")
+            indexed = int(cur.fetchone()[0])
+            cur.execute("SELECT COALESCE(SUM(lifetime_sec), 0) FROM users")
+            lifetime = int(cur.fetchone()[0])
+            conn.close()
+        finally:
+            DB_PATH = saved
+    total = threads * punches
+    return {
+        **counts,
+        "punches": total,
+        "seconds": round(elapsed, 3),
+        "punches_per_sec": round(total / elapsed, 1) if elapsed > 0 else None,
+        "overlapping_sessions": overlaps,
+        "totals_consistent": indexed == lifetime,
+    }
+
+def _bench_memory_seed(path: str, sessions: int, users: int, seed: int = 1) -> None:
+    """Scratch DB with `users` users and `sessions` closed sessions, one per user per day up to yesterday."""
+    global DB_PATH
+    import random
+    saved = DB_PATH
+    DB_PATH = path
+    try:
+        init_db()
+    finally:
+        DB_PATH = saved
+    rnd = random.Random(seed)
+    per_user = -(-sessions // users)
+    day0 = _day_start(now_jst().date()) - timedelta(days=per_user + 1)
+
+    def rows() -> Iterator[Tuple[int, str, str, int]]:
+        for i in range(sessions):
+            uid = i % users + 1
+            ci = day0 + timedelta(days=i // users, seconds=rnd.randint(8 * 3600, 18 * 3600))
+            dur = rnd.randint(600, 5 * 3600)
+            yield uid, iso(ci), iso(ci + timedelta(seconds=dur)), dur
+
+    conn = sqlite3.connect(path)
+    now = iso(now_jst())
+    conn.executemany("INSERT INTO users (student_no, name, nickname, pin_hash, created_at) VALUES (?, ?, ?, '', ?)",
+                     [(f"B{i:06d}", f"u{i}", f"u{i}", now) for i in range(users)])
+    conn.executemany("INSERT INTO sessions (user_id, checkin_at, checkout_at, duration_sec) VALUES (?, ?, ?, ?)", rows())
+    conn.commit()
+    conn.close()
+
+def _bench_memory_run(path: str, mode: str, workload: str, trace: bool) -> Dict[str, Any]:
+    """
+    One measurement, in a fresh process (see _bench_memory): peak RSS is a per-process high-water mark.
+    mode "legacy" feeds the aggregation from the previous fetchall of sqlite3.Rows, "stream" is the
+    current fetchmany pipeline; the per-row arithmetic is shared, so only the row handling differs.
+    "columnar" is the default when NumPy is installed: the timed part loads the store, the resident
+    memory that stays for the life of the process, and runs the query once; warm_seconds is a repeat.
+    """
+    global DB_PATH, COLUMNAR
+    DB_PATH, COLUMNAR = path, mode == "columnar"
+
+    def legacy_fetch(conn: sqlite3.Connection, start: datetime, end: datetime,
+                     user_id: Optional[int] = None) -> Iterator[Tuple[int, str, Optional[str]]]:
+        # the previous query: every row materialized as a sqlite3.Row, nickname joined per row
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT u.id AS user_id, u.nickname AS nickname,
+                   s.checkin_at AS checkin_at, s.checkout_at AS checkout_at
+            FROM {_sessions_source(cur, start)} s
+            JOIN users u ON u.id = s.user_id
+            WHERE s.checkin_at < ?
+              AND (s.checkout_at IS NULL OR s.checkout_at > ?)
+        """, (iso(end), iso(start)))
+        rows = cur.fetchall()
+        return ((r["user_id"], r["checkin_at"], r["checkout_at"]) for r in rows)
+
+    if mode == "legacy":
+        global _fetch_sessions_overlapping
+        _fetch_sessions_overlapping = legacy_fetch  # this process only runs the one measurement
+    if workload == "totals":
+        start, end = _range_start_end("all")
+    else:
+        end = _day_start(now_jst().date())
+        start = end - timedelta(days=365)
+    conn = db_connect()
+    try:
+        resource = None
+        if not trace:
+            try:
+                import resource
+            except ImportError:  # Windows: no getrusage
+                pass
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+        if trace:
+            tracemalloc.start()
+        def query() -> Tuple[Dict[int, Any], int]:
+            if workload == "totals":
+                out = _compute_totals_in_range(conn, start, end)
+                return out, sum(v["total_sec"] for v in out.values())
+            out = _daily_series_for_all_users(conn, start, end)[1]
+            return out, sum(sum(v) for v in out.values())
+
+        t0 = pytime.perf_counter()
+        if COLUMNAR:
+            _columns_load(_columns_gen)  # in line: normally a background thread on first use
+        out, check = query()
+        elapsed = pytime.perf_counter() - t0
+        res: Dict[str, Any] = {"seconds": round(elapsed, 2), "users": len(out), "total_sec": check}
+        if COLUMNAR:
+            t0 = pytime.perf_counter()
+            query()
+            res["warm_seconds"] = round(pytime.perf_counter() - t0, 3)
+        if trace:
+            res["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if resource:
+            unit = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes on macOS, KiB on Linux
+            rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            res["rss_base"], res["rss_peak"] = rss0 * unit, rss1 * unit
+        return res
+    finally:
+        conn.close()
+
+def _bench_memory(sessions: int, users: int, workloads: List[str], modes: List[str]) -> List[Dict[str, Any]]:
+    """
+    Peak RSS and tracemalloc peak of the range aggregations on a scratch DB of `sessions` sessions.
+    Every measurement runs in its own interpreter; tracemalloc slows and inflates the process,
+    so it gets a separate run from the RSS / timing one.
+    """
+    import subprocess
+    import tempfile
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.sqlite3")
+        t0 = pytime.perf_counter()
+        _bench_memory_seed(path, sessions, users)
+        print(f"seeded {sessions} sessions / {users} users in {pytime.perf_counter() - t0:.1f} s", file=sys.stderr)
+        for workload in workloads:
+            for mode in modes:
+                r: Dict[str, Any] = {"workload": workload, "mode": mode}
+                for trace in (False, True):
+                    cmd = [sys.executable, "-m", "backend.main", "bench-memory", "--child", path, mode, workload]
+                    if trace:
+                        cmd.append("trace")
+                    proc = subprocess.run(cmd, cwd=root, capture_output=True, text=True, check=True)
+                    res = json.loads(proc.stdout.strip().splitlines()[-1])
+                    r.update({"tracemalloc_peak": res["tracemalloc_peak"]} if trace else res)
+                out.append(r)
+    return out
+
+def _check_coherence() -> List[Tuple[str, bool, str]]:
+    """
+    Writes by a second process must reach this process's caches. On a scratch DB, each step runs
+    a child interpreter that writes (a punch, a bulk import) and then checks what this process noticed.
+    Returns (step, ok, detail) per step.
+    """
+    global DB_PATH, COLUMNAR, _watch_conn
+    import subprocess
+    import tempfile
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    saved, saved_columnar = DB_PATH, COLUMNAR
+    steps: List[Tuple[str, bool, str]] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        DB_PATH = os.path.join(tmp, "coherence.sqlite3")
+        env = {**os.environ, "STUDYROOM_DB_PATH": DB_PATH}
+
+        def child(*cmd: str) -> None:
+            subprocess.run([sys.executable, "-m", "backend.main", *cmd], cwd=root, env=env,
+                           capture_output=True, text=True, check=True)
+
+        def totals(columnar: bool) -> Dict[int, int]:
+            global COLUMNAR
+            COLUMNAR = columnar
+            conn = db_connect()
+            try:
+                return {uid: v["total_sec"] for uid, v in _compute_totals_in_range(conn, *_range_start_end("all")).items()}
+            finally:
+                conn.close()
+
+        try:
+            init_db()
+            conn = db_connect()
+            conn.execute("INSERT INTO users (student_no, name, nickname, pin_hash, created_at) VALUES ('C00001', 'c', 'c', '', ?)",
+                         (iso(now_jst()),))
+            conn.commit()
+            conn.close()
+            _check_foreign_writes()  # baseline
+            columnar = _columns_enabled()
+            if columnar:
+                _columns_load(_columns_gen)
+
+            _punch(1, "in")
+            _punch(1, "out")
+            steps.append(("own write", not _check_foreign_writes(), "this process's punches are not foreign"))
+
+            v0 = _data_version
+            child("check-coherence", "--child", "punch")
+            seen = _check_foreign_writes()
+            ok = seen and _data_version > v0 and _foreign_version == _data_version
+            detail = f"data_version {v0} -> {_data_version}"
+            if columnar:
+                ok = ok and _columns is not None and totals(True) == totals(False)
+                detail += ", columnar store kept and caught up"
+            steps.append(("foreign punch", bool(ok), detail))
+
+            before = totals(False).get(1, 0)
+            csv_path = os.path.join(tmp, "import.csv")
+            with open(csv_path, "w", encoding="utf-8") as f:
+                f.write("student_no,checkin_at,checkout_at\nC00001,2024-01-01 09:00,2024-01-01 10:00\n")
+            bulk0 = _coherence["bulk"]
+            child("import-sessions", csv_path)
+            seen = _check_foreign_writes()
+            ok = seen and _coherence["bulk"] == bulk0 + 1 and (not columnar or _columns is None)
+            ok = ok and totals(False).get(1, 0) == before + 3600
+            detail = "bulk seen" + (", columnar store dropped" if columnar else "")
+            if columnar:
+                _columns_load(_columns_gen)
+                ok = ok and totals(True) == totals(False)
+                detail += " and reloaded"
+            steps.append(("foreign import", bool(ok), detail))
+
+            child("check-coherence", "--child", "punch")
+            holder = sqlite3.connect(DB_PATH)
+            holder.execute("BEGIN EXCLUSIVE")
+            t0 = pytime.perf_counter()
+            seen = _check_foreign_writes()
+            ms = (pytime.perf_counter() - t0) * 1000
+            holder.rollback()
+            holder.close()
+            ok = not seen and ms < 100 and _check_foreign_writes()
+            steps.append(("locked file", bool(ok), f"check returned in {ms:.1f} ms under a write lock, caught up after"))
+        finally:
+            if _watch_conn is not None:
+                _watch_conn.close()
+                _watch_conn = None
+            DB_PATH, COLUMNAR = saved, saved_columnar
+    return steps
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m backend.main", description="StudyRoom management commands")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    cal = sub.add_parser("calibrate-bcrypt", help="measure PIN verify latency and recommend STUDYROOM_BCRYPT_ROUNDS")
+    cal.add_argument("--target-ms", type=float, default=250.0, help="acceptable verify time per punch")
+    cal.add_argument("--samples", type=int, default=5)
+    cal.add_argument("--min-rounds", type=int, default=8)
+    cal.add_argument("--max-rounds", type=int, default=15)
+
+    arc = sub.add_parser("archive-sessions", help="move old closed sessions into sessions_archive")
+    arc.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS or 365)
+    arc.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to shrink the DB file")
+
+    sub.add_parser("rebuild-totals", help="recompute user_day_totals, lifetime totals and streaks from all sessions")
+
+    sub.add_parser("backup", help="take a verified online backup now (same as the scheduled job)")
+
+    ev = sub.add_parser("replay-events", help="rebuild sessions and totals from the punch event log")
+    ev.add_argument("--full", action="store_true", help="replay the whole log instead of the latest snapshot onwards")
+    ev.add_argument("--check", action="store_true", help="only compare the replay with the live tables (no changes)")
+    sub.add_parser("snapshot-events", help="snapshot the projections now (replays start from here)")
+
+    st = sub.add_parser("stress-punch", help="concurrent check-in/out on a scratch DB: duplicates and throughput")
+    st.add_argument("--users", type=int, default=20, help="few users = many collisions")
+    st.add_argument("--threads", type=int, default=8)
+    st.add_argument("--punches", type=int, default=300, help="per thread")
+    st.add_argument("--mode", choices=["both", "current", "legacy"], default="both")
+
+    cc = sub.add_parser("check-coherence", help="a second process writes to a scratch DB; check that this process's caches notice")
+    cc.add_argument("--child", choices=["punch"], help=argparse.SUPPRESS)
+
+    imp = sub.add_parser("import-sessions", help="load closed sessions from a CSV (student_no, checkin_at, checkout_at) "
+                                                 "or another StudyRoom DB")
+    imp.add_argument("path", help="CSV file (UTF-8) or studyroom.sqlite3; the format is detected")
+    imp.add_argument("--create-users", action="store_true", help="DB source: also add its users missing here (PIN hashes included)")
+    imp.add_argument("--dry-run", action="store_true", help="validate and report only")
+    imp.add_argument("--batch", type=int, default=IMPORT_BATCH, help="sessions per transaction")
+
+    bm = sub.add_parser("bench-memory", help="peak memory of the range aggregations (previous, streaming, columnar) on a scratch DB")
+    bm.add_argument("--sessions", type=int, default=1_000_000)
+    bm.add_argument("--users", type=int, default=1000)
+    bm.add_argument("--workload", choices=["both", "totals", "daily"], default="both",
+                    help="totals = all-time totals, daily = 365 day bins")
+    bm.add_argument("--mode", choices=["all", "legacy", "stream", "columnar"], default="all",
+                    help="columnar = the default deployment when NumPy is installed")
+    bm.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+
+    args = ap.parse_args(argv)
+    if args.command == "bench-memory":
+        if args.child:
+            path, mode, workload, *rest = args.child
+            print(json.dumps(_bench_memory_run(path, mode, workload, trace=rest == ["trace"])))
+            return 0
+        workloads = ["totals", "daily"] if args.workload == "both" else [args.workload]
+        modes = ["legacy", "stream", "columnar"] if args.mode == "all" else [args.mode]
+        if np is None and "columnar" in modes:
+            if args.mode == "columnar":
+                print("columnar mode needs NumPy", file=sys.stderr)
+                return 1
+            modes.remove("columnar")
+
+        def mb(b: Optional[int]) -> str:
+            return f"{b / 2**20:8.1f} MB" if b is not None else "       n/a"
+
+        results = _bench_memory(args.sessions, max(1, args.users), workloads, modes)
+        print(f"{'workload':>8} {'mode':>8} {'seconds':>8} {'warm':>6} {'RSS peak':>11} {'RSS growth':>11} {'tracemalloc':>11}")
+        for r in results:
+            growth = r["rss_peak"] - r["rss_base"] if "rss_peak" in r else None
+            warm = r.get("warm_seconds", "")
+            print(f"{r['workload']:>8} {r['mode']:>8} {r['seconds']:>8} {warm:>6} {mb(r.get('rss_peak'))} {mb(growth)}"
+                  f" {mb(r['tracemalloc_peak'])}   (users {r['users']}, total {r['total_sec'] // 3600} h)")
+        return 0
+    if args.command in ("replay-events", "snapshot-events"):
+        init_db()
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            if args.command == "snapshot-events":
+                _finish_import_runs(cur)
+                if _import_unfinished(cur):
+                    conn.commit()
+                    print("an import is running: snapshot after it finishes", file=sys.stderr)
+                    return 1
+                snap_id = _take_event_snapshot(cur)
+                conn.commit()
+                print(f"snapshot {snap_id} taken")
+                return 0
+            before = _projection_fingerprint(cur) if args.check else None
+            r = _replay_events(cur, use_snapshot=not args.full)
+            print(f"replayed {r['replayed']} events after seq {r['from_seq']}"
+                  + (f" (snapshot {r['snapshot_id']})" if r["snapshot_id"] else " (full log)"))
+            if args.check:
+                after = _projection_fingerprint(cur)
+                conn.rollback()
+                diff = [k for k in before if before[k] != after[k]]
+                print("projections match the log" if not diff else f"differs from the log: {', '.join(diff)}")
+                return 1 if diff else 0
+            _drop_period_snapshots(cur)
+            _bump_write_counter(cur, bulk=True)  # running servers drop their caches
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return 0
+    if args.command == "import-sessions":
+        init_db()
+        new_users = None
+        f = None
+        try:
+            with open(args.path, "rb") as head:
+                is_db = head.read(16) == b"SQLite format 3\x00"
+            if is_db:
+                users, rows = _db_import_source(args.path)
+                new_users = users if args.create_users else None
+            else:
+                f = open(args.path, newline="", encoding="utf-8-sig")
+                rows = _csv_import_rows(f)
+
+            def progress(done: int, total: int, sec: float) -> None:
+                print(f"\r{done}/{total} sessions, {done / max(sec, 1e-9):,.0f} rows/s", end="", file=sys.stderr, flush=True)
+
+            source = ("db:" if is_db else "csv:") + os.path.basename(args.path)
+            r = _import_sessions(rows, source, new_users, args.dry_run, max(1, args.batch), progress)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"\nimport failed: {e}", file=sys.stderr)
+            return 1
+        finally:
+            if f:
+                f.close()
+        if r["inserted"]:
+            print(file=sys.stderr)
+        reasons = ", ".join(f"{k} {v}" for k, v in sorted(r["rejected_by_reason"].items()))
+        print(f"read {r['rows_read']} rows in {r['validate_sec']} s: {r['accepted']} accepted, {r['duplicates']} duplicates, "
+              f"{r['rejected']} rejected" + (f" ({reasons})" if reasons else ""))
+        for x in r["samples"]:
+            print(f"  {x['where']}: {x['reason']} {x['detail']}")
+        if r["dry_run"]:
+            print("dry run: nothing written" + (f" ({r['users_created']} users would be created)" if r["users_created"] else ""))
+            return 0
+        if r.get("repaired_runs"):
+            print(f"repaired {r['repaired_runs']} interrupted import(s)")
+        if r["inserted"]:
+            print(f"inserted {r['inserted']} sessions in {r['load_sec']} s ({r['rows_per_sec']:,} rows/s)"
+                  + (f", created {r['users_created']} users" if r["users_created"] else "")
+                  + (f"; deferred indexes {', '.join(r['deferred_indexes'])}" if r["deferred_indexes"] else "")
+                  + f"; indexes and totals rebuilt in {r['finish_sec']} s; total {r['seconds']} s")
+        return 0
+    if args.command == "check-coherence":
+        if args.child:
+            _punch(1, "in")
+            pytime.sleep(1.1)
+            _punch(1, "out")
+            return 0
+        steps = _check_coherence()
+        for name, ok, detail in steps:
+            print(f"{'ok' if ok else 'FAIL':>4}  {name}: {detail}")
+        return 0 if all(ok for _, ok, _ in steps) else 1
+    if args.command == "stress-punch":
+        modes = ["legacy", "current"] if args.mode == "both" else [args.mode]
+        dup = 0
+        for mode in modes:
+            r = _stress_punch(args.users, args.threads, args.punches, legacy=(mode == "legacy"))
+            print(f"{mode:>7}: {r['punches']} punches in {r['seconds']} s = {r['punches_per_sec']}/s "
+                  f"(applied {r['applied']}, conflict {r['conflict']}, error {r['error']}); "
+                  f"overlapping sessions: {r['overlapping_sessions']}; "
+                  f"totals consistent: {r['totals_consistent']}")
+            if mode == "current":
+                dup = r["overlapping_sessions"] + r["error"] + (not r["totals_consistent"])
+        return 1 if dup else 0
+    if args.command == "backup":
+        init_db()
+        try:
+            r = _run_backup()
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            return 1
+        print(f"{os.path.join(BACKUP_DIR, r['file'])}: {r['bytes']} bytes, {r['pages']} pages in {r['duration_ms']} ms "
+              f"({r['pages_per_sec']} pages/s), integrity ok" + (f", removed {len(r['removed'])} old" if r["removed"] else ""))
+    if args.command == "rebuild-totals":
+        init_db()
+        conn = db_connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            _rebuild_day_index(cur)
+            _rebuild_lifetime(cur)
+            _rebuild_streaks(cur)
+            _drop_period_snapshots(cur)
+            _bump_write_counter(cur)
+            conn.commit()
+            cur.execute("SELECT COUNT(*), COALESCE(SUM(lifetime_sec), 0) FROM users")
+            n, total = cur.fetchone()
+        finally:
+            conn.close()
+        print(f"rebuilt totals for {n} users ({total // 3600} h in closed sessions)")
+    if args.command == "archive-sessions":
+        init_db()
+        try:
+            moved = _archive_sessions(now_jst() - timedelta(days=args.older_than_days))
+        except ValueError as e:
+            ap.error(str(e))
+        print(f"archived {moved} sessions closed more than {args.older_than_days} days ago")
+        if args.vacuum:
+            conn = db_connect()
+            conn.execute("VACUUM")
+            conn.close()
+            print("vacuumed")
+    if args.command == "calibrate-bcrypt":
+        rounds = _calibrate_bcrypt(args.target_ms, max(1, args.samples), max(4, args.min_rounds), min(31, args.max_rounds))
+        print(f"\nrecommended (current {BCRYPT_ROUNDS} marked *):")
+        print(f"STUDYROOM_BCRYPT_ROUNDS={rounds}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
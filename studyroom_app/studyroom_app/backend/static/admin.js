@@ -14,6 +14,32 @@ async function refreshActive(){
   }catch(e){
     msg.textContent = e.message;
   }
+  await refreshTimeline();
+}
+
+// 本日の在室人数（分単位）
+async function refreshTimeline(){
+  const msg = document.getElementById("timeline_msg");
+  const canvas = document.getElementById("timeline_chart");
+  try{
+    const data = await get("/api/admin/occupancy/timeline");
+    msg.textContent = `在室 ${data.occupancy}人 / 本日ピーク ${data.peak}人` + (data.peak_at ? `（${data.peak_at}）` : "");
+    const ctx = canvas.getContext("2d");
+    const w = canvas.width, h = canvas.height;
+    ctx.clearRect(0,0,w,h);
+    ctx.fillStyle = "rgba(0,0,0,0.02)";
+    ctx.fillRect(0,0,w,h);
+    const max = Math.max(1, data.peak);
+    ctx.fillStyle = "rgba(0,0,0,0.75)";
+    data.minutes.forEach((v,k)=>{
+      const bh = (h-16) * v / max;
+      ctx.fillRect(w * k / 1440, h - 14 - bh, Math.max(1, w/1440), bh);
+    });
+    ctx.font = "11px system-ui, sans-serif";
+    for(let hr=0; hr<=24; hr+=3) ctx.fillText(`${hr}`, Math.min(w-14, w*hr/24), h-2);
+  }catch(e){
+    msg.textContent = e.message;
+  }
 }
 
 document.getElementById("refresh_active").addEventListener("click", refreshActive);
@@ -74,6 +100,7 @@ document.getElementById("admin_login").addEventListener("click", async ()=>{
     adminArea.style.display = "block";
     loginMsg.textContent = "";
     await refreshUsers();
+    await refreshGroups();
   }catch(e){
     loginMsg.textContent = e.message;
   }
@@ -117,6 +144,208 @@ document.getElementById("force_checkout").addEventListener("click", async ()=>{
   }
 });
 
+// バッジ発行: QRコード（サーバに segno がある場合）とトークン文字列を表示して印刷できるようにする
+const badgeMsg = document.getElementById("badge_msg");
+const badgeCard = document.getElementById("badge_card");
+const badgePrint = document.getElementById("badge_print");
+
+document.getElementById("badge_issue").addEventListener("click", async ()=>{
+  badgeMsg.textContent = "通信中…";
+  badgeCard.innerHTML = "";
+  badgePrint.disabled = true;
+  try{
+    const student_no = document.getElementById("b_student").value.trim();
+    const data = await post("/api/admin/badge/issue", {student_no});
+    badgeCard.innerHTML = `<div style="display:inline-block;padding:12px;border:1px solid #999;text-align:center">`
+      + (data.qr_svg ?? "")
+      + `<div><b>${data.nickname}</b>（${data.student_no}）</div>`
+      + `<div style="font-family:monospace;font-size:11px;word-break:break-all;max-width:240px">${data.token}</div></div>`;
+    badgeMsg.textContent = "発行しました" + (data.qr_svg ? "" : "（QRコードの表示には segno が必要です: pip install segno）");
+    badgePrint.disabled = false;
+  }catch(e){
+    badgeMsg.textContent = e.message;
+  }
+});
+
+document.getElementById("badge_revoke").addEventListener("click", async ()=>{
+  const student_no = document.getElementById("b_student").value.trim();
+  if(!student_no || !confirm(`${student_no} のバッジを無効にしますか？`)) return;
+  badgeMsg.textContent = "通信中…";
+  try{
+    await post("/api/admin/badge/revoke", {student_no});
+    badgeCard.innerHTML = "";
+    badgePrint.disabled = true;
+    badgeMsg.textContent = "無効にしました";
+  }catch(e){
+    badgeMsg.textContent = e.message;
+  }
+});
+
+badgePrint.addEventListener("click", ()=>{
+  const w = window.open("", "_blank");
+  w.document.write(`<!doctype html><title>バッジ</title><body>${badgeCard.innerHTML}</body>`);
+  w.document.close();
+  w.print();
+});
+
+async function loadHeatmap(){
+  const msg = document.getElementById("hm_msg");
+  const tbody = document.querySelector("#hm_table tbody");
+  const start = document.getElementById("hm_start").value;
+  const end = document.getElementById("hm_end").value;
+  const bin = document.getElementById("hm_bin").value;
+  msg.textContent = "通信中…";
+  tbody.innerHTML = "";
+  try{
+    let url = `/api/admin/occupancy/heatmap?bin=${bin}`;
+    if(start) url += `&start=${start}`;
+    if(end) url += `&end=${end}`;
+    const data = await get(url);
+    const max = Math.max(1, ...data.heatmap.flat());
+    const perHour = 60 / data.bin_min;
+    let head = "<tr><th></th>";
+    for(let k=0;k<data.heatmap[0].length;k+=perHour) head += `<th colspan="${perHour}">${k/perHour}</th>`;
+    tbody.insertAdjacentHTML("beforeend", head + "</tr>");
+    data.heatmap.forEach((row, wd)=>{
+      const cells = row.map(v=>`<td title="${v}人" style="padding:0;min-width:6px;background:rgba(0,0,0,${(v/max*0.85).toFixed(2)})"></td>`).join("");
+      tbody.insertAdjacentHTML("beforeend", `<tr><th>${data.weekdays[wd]}</th>${cells}</tr>`);
+    });
+    const peak = data.peak.reduce((a,b)=> b.peak > a.peak ? b : a, {date:"—", peak:0});
+    msg.textContent = `${data.start}〜${data.end} / 最大在室 ${peak.peak}人（${peak.date}）/ 平均の最大 ${max}人`;
+  }catch(e){
+    msg.textContent = e.message;
+  }
+}
+
+document.getElementById("hm_load").addEventListener("click", loadHeatmap);
+
+function hours(sec){
+  return (sec/3600).toFixed(1) + "h";
+}
+
+async function loadGoals(){
+  const msg = document.getElementById("ga_msg");
+  const hist = document.querySelector("#ga_hist tbody");
+  const tbody = document.querySelector("#ga_table tbody");
+  const start = document.getElementById("ga_start").value;
+  const end = document.getElementById("ga_end").value;
+  msg.textContent = "通信中…";
+  hist.innerHTML = "";
+  tbody.innerHTML = "";
+  try{
+    let url = "/api/admin/analytics/goals";
+    const q = [];
+    if(start) q.push(`start=${start}`);
+    if(end) q.push(`end=${end}`);
+    if(q.length) url += "?" + q.join("&");
+    const data = await get(url);
+    const s = data.summary;
+    msg.textContent = `${data.start}〜${data.end}（${data.days}日）/ 達成 ${s.achieved}/${s.users}人（${Math.round(s.attainment_rate*100)}%）`
+      + ` / 中央値 ${hours(s.median_sec)}・上位10% ${hours(s.p90_sec)}・平均 ${hours(s.mean_sec)}`;
+    const h = data.histogram;
+    const max = Math.max(1, ...h.counts);
+    h.counts.forEach((n, i)=>{
+      const bar = `<div style="height:10px;width:${Math.round(n/max*100)}%;background:var(--text)"></div>`;
+      hist.insertAdjacentHTML("beforeend", `<tr><th>${h.edges_hours[i]}〜${h.edges_hours[i+1]}h</th><td style="width:70%">${bar}</td><td>${n}人</td></tr>`);
+    });
+    data.users.forEach(u=>{
+      const rate = u.rate === null ? "—" : `${Math.round(u.rate*100)}%`;
+      tbody.insertAdjacentHTML("beforeend", `<tr><td>${u.student_no}</td><td>${u.nickname}</td><td>${hours(u.total_sec)}</td><td>${hours(u.goal_sec)}</td><td>${u.achieved ? "✓ " : ""}${rate}</td></tr>`);
+    });
+  }catch(e){
+    msg.textContent = e.message;
+  }
+}
+
+document.getElementById("ga_load").addEventListener("click", loadGoals);
+
+const kindLabel = {class: "クラス", grade: "学年"};
+
+async function refreshGroups(){
+  const tbody = document.querySelector("#g_table tbody");
+  const sel = document.getElementById("g_select");
+  const keep = sel.value;
+  const data = await get("/api/admin/groups");
+  tbody.innerHTML = "";
+  sel.innerHTML = "";
+  data.groups.forEach(g=>{
+    tbody.insertAdjacentHTML("beforeend", `<tr><td>${g.name}</td><td>${kindLabel[g.kind] ?? g.kind}</td><td>${g.members}人</td></tr>`);
+    sel.insertAdjacentHTML("beforeend", `<option value="${g.id}">${g.name}</option>`);
+  });
+  if(keep) sel.value = keep;
+}
+
+async function editMembers(field){
+  const msg = document.getElementById("g_msg");
+  msg.textContent = "通信中…";
+  try{
+    const group_id = Number(document.getElementById("g_select").value);
+    const list = document.getElementById("g_students").value.split(/[\s,]+/).filter(Boolean);
+    const data = await post("/api/admin/groups/members", {group_id, [field]: list});
+    msg.textContent = `メンバー ${data.members.length}人` + (data.unknown.length ? ` / 見つからない学籍番号: ${data.unknown.join(", ")}` : "");
+    await refreshGroups();
+  }catch(e){
+    msg.textContent = e.message;
+  }
+}
+
+document.getElementById("g_create").addEventListener("click", async ()=>{
+  const msg = document.getElementById("g_msg");
+  msg.textContent = "通信中…";
+  try{
+    const name = document.getElementById("g_name").value.trim();
+    const kind = document.getElementById("g_kind").value;
+    await post("/api/admin/groups/create", {name, kind});
+    msg.textContent = "作成しました";
+    await refreshGroups();
+  }catch(e){
+    msg.textContent = e.message;
+  }
+});
+document.getElementById("g_add").addEventListener("click", ()=>editMembers("add"));
+document.getElementById("g_remove").addEventListener("click", ()=>editMembers("remove"));
+document.getElementById("g_delete").addEventListener("click", async ()=>{
+  const msg = document.getElementById("g_msg");
+  const sel = document.getElementById("g_select");
+  if(!sel.value || !confirm(`${sel.selectedOptions[0].textContent} を削除しますか？`)) return;
+  try{
+    await post("/api/admin/groups/delete", {group_id: Number(sel.value)});
+    msg.textContent = "削除しました";
+    await refreshGroups();
+  }catch(e){
+    msg.textContent = e.message;
+  }
+});
+
+// 過去の記録の取り込み: まず検証（dry_run）で件数と却下理由を確認してから取り込む
+const importReasons = {unknown_user: "未登録の学籍番号", open: "退室時刻なし", bad_time: "時刻の形式",
+  not_after_checkin: "退室が入室より前", future: "未来の時刻", overlap: "他の記録と重複"};
+
+async function runImport(dry_run){
+  const msg = document.getElementById("im_msg");
+  const tbody = document.querySelector("#im_table tbody");
+  const file = document.getElementById("im_file").files[0];
+  if(!file){ msg.textContent = "CSVファイルを選んでください"; return; }
+  if(!dry_run && !confirm(`${file.name} を取り込みますか？`)) return;
+  msg.textContent = dry_run ? "検証中…" : "取り込み中…";
+  tbody.innerHTML = "";
+  try{
+    const data = await post("/api/admin/import", {csv: await file.text(), dry_run});
+    const reasons = Object.entries(data.rejected_by_reason).map(([k, n])=>`${importReasons[k] ?? k} ${n}`).join("・");
+    msg.textContent = `${data.rows_read}行: 取り込み${dry_run ? "可" : ""} ${dry_run ? data.accepted : data.inserted}件`
+      + ` / 登録済み ${data.duplicates}件 / 却下 ${data.rejected}件` + (reasons ? `（${reasons}）` : "")
+      + (dry_run ? "" : ` / ${data.seconds}秒`);
+    data.samples.forEach(x=>{
+      tbody.insertAdjacentHTML("beforeend", `<tr><td>${x.where}</td><td>${importReasons[x.reason] ?? x.reason}</td><td>${x.detail}</td></tr>`);
+    });
+  }catch(e){
+    msg.textContent = e.message;
+  }
+}
+
+document.getElementById("im_check").addEventListener("click", ()=>runImport(true));
+document.getElementById("im_run").addEventListener("click", ()=>runImport(false));
+
 document.getElementById("refresh_users").addEventListener("click", async ()=>{
   try{ await refreshUsers(); }catch(e){ alert(e.message); }
 });
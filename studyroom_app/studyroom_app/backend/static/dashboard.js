@@ -106,10 +106,59 @@ function drawLineChart(canvas, labels, values, opts={}){
 }
 
 
-async function load(){
-  const res = await fetch("/api/me");
+// compact /api/me: keep the last payload and ask only for what changed since its version
+const ME_CACHE_KEY = "studyroom_me_compact";
+
+function readMeCache(){
+  try{ return JSON.parse(localStorage.getItem(ME_CACHE_KEY) || "null"); }catch{ return null; }
+}
+
+function mergeCompact(prev, data){
+  if(data.full || !prev || prev.daily.start !== data.daily.start) return data;
+  const merged = Object.assign({}, prev, data);
+  const daily = {
+    start: prev.daily.start,
+    offsets: prev.daily.offsets,
+    sec: [...prev.daily.sec],
+    rank: [...prev.daily.rank],
+    total_users: [...prev.daily.total_users],
+  };
+  data.daily.offsets.forEach((off, i)=>{
+    daily.sec[off] = data.daily.sec[i];
+    daily.rank[off] = data.daily.rank[i];
+    daily.total_users[off] = data.daily.total_users[i];
+  });
+  merged.daily = daily;
+  if(data.sessions === null) merged.sessions = prev.sessions;
+  return merged;
+}
+
+function expandDaily(daily){
+  const [y, m, d] = daily.start.split("-").map(Number);
+  const base = Date.UTC(y, m-1, d);
+  return daily.offsets.map((off, i)=>({
+    date: new Date(base + off*86400000).toISOString().slice(0,10),
+    sec: daily.sec[i],
+    rank: daily.rank[i],
+    total_users: daily.total_users[i],
+  }));
+}
+
+async function fetchMe(){
+  const prev = readMeCache();
+  let url = "/api/me?format=compact";
+  if(prev && prev.version) url += `&since=${encodeURIComponent(prev.version)}`;
+  const res = await fetch(url);
   const data = await res.json().catch(()=>({}));
-  if(!res.ok){
+  if(!res.ok) return null;
+  const merged = mergeCompact(prev, data);
+  try{ localStorage.setItem(ME_CACHE_KEY, JSON.stringify(merged)); }catch{}
+  return Object.assign({}, merged, {daily: expandDaily(merged.daily)});
+}
+
+async function load(){
+  const data = await fetchMe();
+  if(!data){
     location.href = "/login";
     return;
   }
@@ -120,6 +169,7 @@ async function load(){
   // バッジ・称号
   const badges = [];
   if(data.streak >= 2) badges.push(`🔥 連続${data.streak}日`);
+  if(data.longest_streak >= 7 && data.longest_streak > data.streak) badges.push(`🏆 最長連続${data.longest_streak}日`);
   if(data.best_sec >= 60*60*3) badges.push(`🏅 自己ベスト ${fmt(data.best_sec)}`);
   if(badges.length === 0) badges.push("—");
   document.getElementById("badges").innerHTML = badges.join("<br>");
@@ -198,10 +248,34 @@ async function load(){
   );
 }
 
+async function loadCustom(){
+  const start = document.getElementById("c_start").value;
+  const end = document.getElementById("c_end").value || start;
+  const t_custom = document.getElementById("t_custom");
+  const r_custom = document.getElementById("r_custom");
+  if(!start){
+    r_custom.textContent = "開始日を指定してください";
+    return;
+  }
+  r_custom.textContent = "通信中…";
+  const res = await fetch(`/api/me?start=${start}&end=${end}`);
+  const data = await res.json().catch(()=>({}));
+  if(!res.ok){
+    r_custom.textContent = data.detail ?? "エラー";
+    return;
+  }
+  t_custom.textContent = fmt(data.totals.custom);
+  r_custom.textContent = `順位: ${data.ranks.custom.rank} / ${data.ranks.custom.total_users}`;
+}
+
+document.getElementById("c_apply").addEventListener("click", loadCustom);
+
 document.getElementById("logout").addEventListener("click", async (e)=>{
   e.preventDefault();
+  localStorage.removeItem(ME_CACHE_KEY);
   await fetch("/api/logout", {method:"POST"});
   location.href = "/";
 });
 
 load();
+setInterval(load, 60_000);
@@ -24,7 +24,12 @@ async function post(url, payload){
     method: "POST",
     headers: {"Content-Type":"application/json"},
     body: JSON.stringify(payload)
-  });
+  }).catch(()=>null);
+  if(PunchQueue.isOffline(res)){
+    const e = new Error("サーバに接続できません");
+    e.offline = true;
+    throw e;
+  }
   const data = await res.json().catch(()=>({}));
   if(!res.ok) throw new Error(data.detail ?? "エラー");
   return data;
@@ -85,34 +90,38 @@ recallBtn.addEventListener("click", ()=>{
 // 入室中状態表示・ガード
 let isIn = false;
 async function checkStatus(student_no, pin) {
-  // APIで入室中か確認
+  // APIで入室中か確認（サーバに届かないときは null = 不明）
   try {
     const res = await fetch("/api/status", {
       method: "POST",
       headers: {"Content-Type": "application/json"},
       body: JSON.stringify({student_no, pin})
     });
+    if(PunchQueue.isOffline(res)) return null;
     const data = await res.json().catch(()=>({}));
     if(res.ok && data.status === "in") return true;
-  } catch {}
+  } catch {
+    return null;
+  }
   return false;
 }
 
 async function doCheck(kind){
   showMsg(msg, "通信中…");
+  const student_no = studentInput.value.trim();
+  const pin = pinInput.value.trim();
   try{
-    const student_no = studentInput.value.trim();
-    const pin = pinInput.value.trim();
+    const status = await checkStatus(student_no, pin);
     // 入室時は入室中なら退室を促す
     if(kind==="in"){
-      if(await checkStatus(student_no, pin)){
+      if(status === true){
         showMsg(msg, "すでに入室中です。退室を先に行ってください。", true);
         return;
       }
     }
     // 退室時は未入室ならガード
     if(kind==="out"){
-      if(!(await checkStatus(student_no, pin))){
+      if(status === false){
         showMsg(msg, "入室記録がありません。先に入室してください。", true);
         return;
       }
@@ -123,6 +132,18 @@ async function doCheck(kind){
     pinInput.value = "";
     await loadLeaderboard();
   }catch(e){
+    if(e.offline){
+      // サーバに届かない: 端末に保存して復帰後にまとめて送る
+      const err = PunchQueue.check(student_no, pin);
+      if(err){
+        showMsg(msg, err, true);
+        return;
+      }
+      const n = PunchQueue.enqueue(student_no, pin, kind);
+      showMsg(msg, `サーバに接続できないため打刻を端末に保存しました（未送信 ${n}件）。復旧後に自動で送信します。`);
+      pinInput.value = "";
+      return;
+    }
     showMsg(msg, e.message, true);
   }
 }
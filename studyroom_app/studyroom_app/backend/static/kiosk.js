@@ -11,7 +11,12 @@ async function post(url, payload){
     method: "POST",
     headers: {"Content-Type":"application/json"},
     body: JSON.stringify(payload)
-  });
+  }).catch(()=>null);
+  if(PunchQueue.isOffline(res)){
+    const e = new Error("offline");
+    e.offline = true;
+    throw e;
+  }
   const data = await res.json().catch(()=>({}));
   if(!res.ok){
     throw new Error(data.detail ?? "エラー");
@@ -19,13 +24,24 @@ async function post(url, payload){
   return data;
 }
 
+// サーバに届かないときは端末に保存して、復帰後にまとめて送る
+async function punch(action, student_no, pin){
+  try{
+    const data = await post(action === "in" ? "/api/checkin" : "/api/checkout", {student_no, pin});
+    show(data.message);
+  }catch(e){
+    if(!e.offline) throw e;
+    const n = PunchQueue.enqueue(student_no, pin, action);
+    show(`サーバに接続できないため打刻を端末に保存しました（未送信 ${n}件）。復旧後に自動で送信します。`);
+  }
+}
+
 document.getElementById("btn_in").addEventListener("click", async ()=>{
   show("通信中…");
   try{
     const student_no = document.getElementById("in_student").value.trim();
     const pin = document.getElementById("in_pin").value.trim();
-    const data = await post("/api/checkin", {student_no, pin});
-    show(data.message);
+    await punch("in", student_no, pin);
   }catch(e){
     show(e.message, true);
   }
@@ -36,9 +52,24 @@ document.getElementById("btn_out").addEventListener("click", async ()=>{
   try{
     const student_no = document.getElementById("out_student").value.trim();
     const pin = document.getElementById("out_pin").value.trim();
-    const data = await post("/api/checkout", {student_no, pin});
-    show(data.message);
+    await punch("out", student_no, pin);
   }catch(e){
     show(e.message, true);
   }
 });
+
+// バッジ読み取り機はキーボードとしてトークンを入力し、最後に Enter を送る
+const badge = document.getElementById("badge");
+badge.addEventListener("keydown", async (ev)=>{
+  if(ev.key !== "Enter") return;
+  const token = badge.value.trim();
+  badge.value = "";
+  if(!token) return;
+  show("通信中…");
+  try{
+    const data = await post("/api/badge/punch", {token});
+    show(data.message);
+  }catch(e){
+    show(e.offline ? "サーバに接続できません。学籍番号とPINで打刻してください（端末に保存されます）。" : e.message, true);
+  }
+});
@@ -1,6 +1,11 @@
 
 const rangeSel = document.getElementById("range");
+const customBox = document.getElementById("custom_range");
+const startInput = document.getElementById("start");
+const endInput = document.getElementById("end");
 const viewSel = document.getElementById("viewmode");
+const boardSel = document.getElementById("board");
+const thead = document.querySelector("#table thead");
 const meta = document.getElementById("meta");
 const tbody = document.querySelector("#table tbody");
 
@@ -13,6 +18,66 @@ function fmt(sec){
 }
 
 
+// クラス・学年対抗（1人あたりの時間順）
+async function loadGroups(range){
+  thead.innerHTML = "<tr><th>#</th><th>グループ</th><th>1人あたり</th><th>合計</th><th>参加率</th></tr>";
+  let url = `/api/leaderboard/groups?range=${encodeURIComponent(range)}&kind=${boardSel.value}`;
+  if(range === "custom"){
+    if(!startInput.value){
+      meta.textContent = "開始日を指定してください";
+      return;
+    }
+    url = `/api/leaderboard/groups?start=${startInput.value}&end=${endInput.value || startInput.value}&kind=${boardSel.value}`;
+  }
+  const res = await fetch(url);
+  const data = await res.json().catch(()=>({}));
+  if(!res.ok){
+    meta.textContent = data.detail ?? "エラー";
+    return;
+  }
+  meta.textContent = `${data.items.length}グループ`;
+  data.items.forEach((g, idx)=>{
+    const tr = document.createElement("tr");
+    tr.innerHTML = `<td>${idx+1}</td><td>${g.name}（${g.members}人）</td><td>${fmt(g.avg_sec)}</td><td>${fmt(g.total_sec)}</td><td>${Math.round(g.participation*100)}%</td>`;
+    tbody.appendChild(tr);
+  });
+}
+
+const historyBox = document.getElementById("history_box");
+const hPeriod = document.getElementById("h_period");
+const hStart = document.getElementById("h_start");
+
+// 過去の日・週・月（確定済みの記録）
+async function loadHistory(top, view){
+  if(!hStart.options.length || hStart.dataset.period !== hPeriod.value){
+    const res = await fetch(`/api/leaderboard/history?period=${hPeriod.value}&limit=24`);
+    const data = await res.json().catch(()=>({}));
+    if(!res.ok){
+      meta.textContent = data.detail ?? "エラー";
+      return;
+    }
+    hStart.innerHTML = data.periods.map(p=>`<option value="${p.start_day}">${p.start_day === p.end_day ? p.start_day : `${p.start_day}〜${p.end_day}`}</option>`).join("");
+    hStart.dataset.period = hPeriod.value;
+  }
+  if(!hStart.value){
+    meta.textContent = "確定した記録はまだありません";
+    return;
+  }
+  const res = await fetch(`/api/leaderboard/history?period=${hPeriod.value}&start=${hStart.value}&top=${top}`);
+  const data = await res.json().catch(()=>({}));
+  if(!res.ok){
+    meta.textContent = data.detail ?? "エラー";
+    return;
+  }
+  meta.textContent = `ユーザー ${data.total_users}人 / 合計 ${fmt(data.total_sec)}`;
+  data.items.forEach((it, idx)=>{
+    const tr = document.createElement("tr");
+    const name = view === "anon" ? "匿名" + (idx+1) : it.nickname;
+    tr.innerHTML = `<td>${it.rank}</td><td>${name}</td><td>${fmt(it.total_sec)}</td>`;
+    tbody.appendChild(tr);
+  });
+}
+
 async function load(){
   tbody.innerHTML = "";
   meta.textContent = "通信中…";
@@ -22,7 +87,22 @@ async function load(){
   if(view === "top") top = 15;
   if(view === "all") top = 100;
   if(view === "anon") top = 100;
-  const res = await fetch(`/api/leaderboard?range=${encodeURIComponent(range)}&top=${top}`);
+  customBox.style.display = range === "custom" ? "" : "none";
+  historyBox.style.display = range === "history" ? "" : "none";
+  boardSel.style.display = range === "history" ? "none" : "";
+  viewSel.style.display = boardSel.value === "user" || range === "history" ? "" : "none";
+  thead.innerHTML = "<tr><th>#</th><th>表示名</th><th>時間</th></tr>";
+  if(range === "history") return loadHistory(top, view);
+  if(boardSel.value !== "user") return loadGroups(range);
+  let url = `/api/leaderboard?range=${encodeURIComponent(range)}&top=${top}`;
+  if(range === "custom"){
+    if(!startInput.value){
+      meta.textContent = "開始日を指定してください";
+      return;
+    }
+    url = `/api/leaderboard?start=${startInput.value}&end=${endInput.value || startInput.value}&top=${top}`;
+  }
+  const res = await fetch(url);
   const data = await res.json().catch(()=>({}));
   if(!res.ok){
     meta.textContent = data.detail ?? "エラー";
@@ -42,6 +122,11 @@ async function load(){
 document.getElementById("refresh").addEventListener("click", load);
 rangeSel.addEventListener("change", load);
 viewSel.addEventListener("change", load);
+boardSel.addEventListener("change", load);
+startInput.addEventListener("change", load);
+endInput.addEventListener("change", load);
+hPeriod.addEventListener("change", load);
+hStart.addEventListener("change", load);
 
 load();
 setInterval(load, 30_000);
@@ -0,0 +1,107 @@
+// オフライン打刻キュー（入口端末用）
+// サーバに届かなかった打刻を端末に保存し、復帰後に /api/punch/batch でまとめて送信する。
+// 各打刻には一意のキーを付けるので、同じ打刻を何度送っても二重には記録されない。
+// PINを平文で保存するので、サーバが受け付けない古さ（既定72時間、サーバの応答で更新）を過ぎた打刻は捨てる。
+const PunchQueue = (() => {
+  const KEY = "studyroom_punch_queue";
+  const AGE_KEY = "studyroom_punch_max_age_hours";
+  const CHUNK = 100;
+  let flushing = false;
+
+  function maxAgeMs(){
+    return (Number(localStorage.getItem(AGE_KEY)) || 72) * 3600 * 1000;
+  }
+  function load(){
+    let q;
+    try{ q = JSON.parse(localStorage.getItem(KEY) || "[]"); }catch{ q = []; }
+    const oldest = Date.now() - maxAgeMs();
+    const fresh = q.filter(p => Date.parse(p.at) >= oldest);
+    if(fresh.length !== q.length) save(fresh);
+    return fresh;
+  }
+  function save(q){
+    if(q.length) localStorage.setItem(KEY, JSON.stringify(q));
+    else localStorage.removeItem(KEY);
+  }
+  function newKey(){
+    if(window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+  }
+
+  // fetch が投げた例外・ゲートウェイ系エラーは「サーバに届かなかった」とみなす
+  function isOffline(res){
+    return !res || [502, 503, 504].includes(res.status);
+  }
+  // 429 以外の 4xx: 何度送っても受け付けられない
+  function isBad(res){
+    return res && res.status >= 400 && res.status < 500 && res.status !== 429;
+  }
+
+  // 保存できない入力ならメッセージを返す（空文字 = OK）
+  function check(student_no, pin){
+    if(!student_no || student_no.length > 64) return "学籍番号を入力してください";
+    if(pin.length < 4 || pin.length > 32) return "PINは4〜32文字で入力してください";
+    return "";
+  }
+
+  function enqueue(student_no, pin, action){
+    const err = check(student_no, pin);
+    if(err) throw new Error(err);
+    const q = load();
+    q.push({key: newKey(), student_no, pin, action, at: new Date().toISOString()});
+    save(q);
+    return q.length;
+  }
+
+  function size(){
+    return load().length;
+  }
+
+  function send(punches){
+    return fetch("/api/punch/batch", {
+      method: "POST",
+      headers: {"Content-Type":"application/json"},
+      body: JSON.stringify({sent_at: new Date().toISOString(), punches})
+    }).catch(() => null);
+  }
+
+  // 1回で最大 CHUNK 件送る。確定した打刻（applied / conflict / rejected）はキューから消す
+  async function flush(){
+    if(flushing) return null;
+    const q = load();
+    if(!q.length) return null;
+    flushing = true;
+    try{
+      const chunk = q.slice(0, CHUNK);
+      const res = await send(chunk);
+      if(isBad(res)){
+        // 要求ごと受け付けられなかった: 1件ずつ送り直し、それでも駄目な打刻だけ捨てて後ろを詰まらせない
+        const drop = new Set();
+        for(const p of chunk){
+          const r = await send([p]);
+          if(isBad(r)) drop.add(p.key);
+          else if(!r || !r.ok) break;
+        }
+        save(load().filter(p => !drop.has(p.key)));
+        return null;
+      }
+      if(!res || !res.ok) return null;
+      const data = await res.json();
+      if(data.max_age_hours) localStorage.setItem(AGE_KEY, String(data.max_age_hours));
+      const done = new Set(data.results.filter(r => !r.retry).map(r => r.key));
+      save(load().filter(p => !done.has(p.key)));  // 送信中に追加された分は残す
+      if(done.size && size() && !data.retry_after) setTimeout(flush, 0);
+      return data;
+    }catch{
+      return null;
+    }finally{
+      flushing = false;
+    }
+  }
+
+  window.addEventListener("online", () => flush());
+  setInterval(flush, 30_000);
+  flush();
+
+  return {enqueue, flush, size, check, isOffline};
+})();
@@ -5,15 +5,20 @@ One-command runner for StudyRoom App.
 ✅ Works on Linux/macOS/Windows (including GitHub Codespaces).
 ✅ No venv activation needed.
 ✅ Creates .venv, installs deps, loads .env, and runs uvicorn.
+✅ Skips pip entirely when requirements.txt is unchanged since the last install.
 
 Usage:
   python run.py
   python run.py --port 8000
+  python run.py --wheelhouse wheelhouse   # offline install from pre-downloaded wheels
+  python run.py --reinstall               # force pip install even if up to date
+  python run.py calibrate-bcrypt          # management command (python -m backend.main ...)
 """
 
 from __future__ import annotations
 
 import argparse
+import hashlib
 import os
 import platform
 import subprocess
@@ -28,6 +33,9 @@ BACKEND = ROOT / "backend"
 REQ = BACKEND / "requirements.txt"
 VENV_DIR = ROOT / ".venv"
 ENV_FILE = ROOT / ".env"
+WHEELHOUSE_DIR = ROOT / "wheelhouse"
+# sha256 of the requirements that were last installed successfully into .venv
+REQ_STAMP = VENV_DIR / ".requirements.sha256"
 
 
 def eprint(*a):
@@ -73,40 +81,92 @@ def venv_python() -> Path:
     return VENV_DIR / "bin" / "python"
 
 
-def ensure_venv() -> None:
+def ensure_venv() -> bool:
+    """Create .venv if missing. Returns True when it was created just now."""
+    created = False
     if not VENV_DIR.exists():
         print("Creating .venv ...")
         venv.create(VENV_DIR, with_pip=True)
+        created = True
     py = venv_python()
     if not py.exists():
         raise RuntimeError("venv python not found; delete .venv and try again.")
+    return created
 
 
-def pip_install() -> None:
+def requirements_digest() -> str:
+    """Hash of requirements.txt + interpreter version (a new Python needs a reinstall)."""
+    h = hashlib.sha256()
+    h.update(REQ.read_bytes())
+    h.update(platform.python_version().encode("ascii"))
+    return h.hexdigest()
+
+
+def resolve_wheelhouse(arg: str | None) -> Path | None:
+    """--wheelhouse > STUDYROOM_WHEELHOUSE > ./wheelhouse (if present)."""
+    raw = arg or os.environ.get("STUDYROOM_WHEELHOUSE", "")
+    if raw:
+        p = Path(raw)
+        if not p.is_absolute():
+            p = ROOT / p
+        if not p.is_dir():
+            raise FileNotFoundError(f"wheelhouse not found: {p}")
+        return p
+    if WHEELHOUSE_DIR.is_dir():
+        return WHEELHOUSE_DIR
+    return None
+
+
+def pip_install(wheelhouse: Path | None = None, fresh_venv: bool = False, force: bool = False) -> None:
     if not REQ.exists():
         raise FileNotFoundError(f"requirements not found: {REQ}")
-    py = venv_python()
-    print("Installing/Updating dependencies ...")
-    subprocess.check_call([str(py), "-m", "pip", "install", "--upgrade", "pip"])
-    subprocess.check_call([str(py), "-m", "pip", "install", "-r", str(REQ)])
-
+    digest = requirements_digest()
+    if not force and REQ_STAMP.exists() and REQ_STAMP.read_text(encoding="utf-8").strip() == digest:
+        print("Dependencies are up to date (skip install).")
+        return
 
-def run_uvicorn(port: int) -> None:
     py = venv_python()
-
+    base = [str(py), "-m", "pip", "install", "--disable-pip-version-check"]
+    if wheelhouse:
+        print(f"Installing dependencies offline from {wheelhouse} ...")
+        base += ["--no-index", "--find-links", str(wheelhouse)]
+    else:
+        print("Installing/Updating dependencies ...")
+        if fresh_venv:
+            # only once per venv: the bundled pip may be too old for current wheels
+            subprocess.check_call([str(py), "-m", "pip", "install", "--upgrade", "pip"])
+    subprocess.check_call(base + ["-r", str(REQ)])
+    REQ_STAMP.write_text(digest + "\n", encoding="utf-8")
+
+
+def app_env() -> dict:
     # Load .env and merge with current env (current env wins)
     ensure_env_file()
     file_env = read_env_file(ENV_FILE)
     env = os.environ.copy()
     for k, v in file_env.items():
         env.setdefault(k, v)
+    return env
+
+
+def run_command(argv: list[str]) -> int:
+    """Run a management command (backend/main.py) inside the venv with .env loaded."""
+    cmd = [str(venv_python()), "-m", "backend.main", *argv]
+    return subprocess.call(cmd, env=app_env(), cwd=str(ROOT))
+
+
+def run_uvicorn(port: int, reload: bool = True) -> None:
+    py = venv_python()
+    env = app_env()
 
     # Safety: warn if admin password unchanged
     if env.get("STUDYROOM_ADMIN_PASSWORD", "") in ("change-me", "your_admin_password", ""):
         eprint("\n⚠️ STUDYROOM_ADMIN_PASSWORD is not set or still default.")
         eprint("   Edit .env and set a strong password before real use.\n")
 
-    cmd = [str(py), "-m", "uvicorn", "backend.main:app", "--reload", "--port", str(port)]
+    cmd = [str(py), "-m", "uvicorn", "backend.main:app", "--port", str(port)]
+    if reload:
+        cmd.append("--reload")
     print("\nRunning:", " ".join(cmd))
     print("Open:")
     print(f"  Home   : http://localhost:{port}/")
@@ -116,9 +176,15 @@ def run_uvicorn(port: int) -> None:
 
 
 def main():
+    # `python run.py <command> ...` -> management command; options stay with the runner
+    command = sys.argv[1:] if len(sys.argv) > 1 and not sys.argv[1].startswith("-") else None
+
     ap = argparse.ArgumentParser()
     ap.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
-    args = ap.parse_args()
+    ap.add_argument("--wheelhouse", default=None, help="install from local wheels only (offline)")
+    ap.add_argument("--reinstall", action="store_true", help="run pip install even if requirements are unchanged")
+    ap.add_argument("--no-reload", action="store_true", help="disable uvicorn auto-reload (kiosk / production)")
+    args = ap.parse_args([] if command else None)
 
     # quick project sanity checks
     if not (ROOT / "backend" / "main.py").exists():
@@ -126,9 +192,11 @@ def main():
         eprint(f"Expected at: {ROOT / 'backend' / 'main.py'}")
         sys.exit(2)
 
-    ensure_venv()
-    pip_install()
-    run_uvicorn(args.port)
+    fresh = ensure_venv()
+    pip_install(resolve_wheelhouse(args.wheelhouse), fresh_venv=fresh, force=args.reinstall)
+    if command:
+        sys.exit(run_command(command))
+    run_uvicorn(args.port, reload=not args.no_reload)
 
 
 if __name__ == "__main__":